@@ -0,0 +1,226 @@
+"""
+Benchmark of crawl-scoped lookups with and without the indexes declared in flaskapp.models.
+
+Builds a synthetic database with the row counts of a full human kinome (~520 DBEntries, each with
+UniProt, NCBI Gene, Ensembl, PDB, BindingDB and cBioPortal rows) for two crawls (the working db
+holds the safe and current crawls), times the lookups done by views.py and the gather stages
+with all ix_* indexes dropped, then adds the indexes with migrate.create_missing_indexes and
+times them again.
+
+Usage: python devtools/benchmarks/benchmark_indexes.py [--nentries 520] [--nlookups 200]
+"""
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from targetexplorer.flaskapp import app, db, models
+from targetexplorer.migrate import create_missing_indexes
+
+
+def populate(nentries, ncrawls, rows_per_entry):
+    id_counters = {}
+
+    def next_id(table_name):
+        id_counters[table_name] = id_counters.get(table_name, 0) + 1
+        return id_counters[table_name]
+
+    def insert(table_class, rows):
+        db.engine.execute(table_class.__table__.insert(), rows)
+
+    for crawl_number in range(ncrawls):
+        rows = {table_class: [] for table_class in [
+            models.DBEntry, models.UniProtEntry, models.UniProtDomain, models.UniProtIsoform,
+            models.NCBIGeneEntry, models.NCBIGenePublication, models.EnsemblGene,
+            models.EnsemblTranscript, models.PDBEntry, models.BindingDBBioassay,
+            models.CbioportalMutation,
+        ]}
+        for i in range(nentries):
+            db_entry_id = next_id('db_entries')
+            rows[models.DBEntry].append({'id': db_entry_id, 'crawl_number': crawl_number})
+            uniprot_id = next_id('uniprot_entries')
+            rows[models.UniProtEntry].append({
+                'id': uniprot_id, 'crawl_number': crawl_number, 'db_entry_id': db_entry_id,
+                'ac': 'P{0:05d}'.format(i), 'entry_name': 'KIN{0}_HUMAN'.format(i),
+            })
+            for j in range(rows_per_entry['domains']):
+                rows[models.UniProtDomain].append({
+                    'id': next_id('uniprot_domains'), 'crawl_number': crawl_number,
+                    'db_entry_id': db_entry_id, 'uniprot_id': uniprot_id,
+                    'target_id': 'KIN{0}_HUMAN_D{1}'.format(i, j),
+                })
+            for j in range(rows_per_entry['isoforms']):
+                rows[models.UniProtIsoform].append({
+                    'id': next_id('uniprot_isoforms'), 'crawl_number': crawl_number,
+                    'db_entry_id': db_entry_id, 'uniprot_id': uniprot_id,
+                    'ac': 'P{0:05d}-{1}'.format(i, j + 1),
+                })
+            ncbi_gene_entry_id = next_id('ncbi_gene_entries')
+            rows[models.NCBIGeneEntry].append({
+                'id': ncbi_gene_entry_id, 'crawl_number': crawl_number,
+                'db_entry_id': db_entry_id, 'gene_id': 1000 + i,
+            })
+            for j in range(rows_per_entry['publications']):
+                rows[models.NCBIGenePublication].append({
+                    'crawl_number': crawl_number, 'ncbi_gene_entry_id': ncbi_gene_entry_id,
+                    'pmid': random.randint(1, 30000000),
+                })
+            ensembl_gene_id = next_id('ensembl_genes')
+            rows[models.EnsemblGene].append({
+                'id': ensembl_gene_id, 'crawl_number': crawl_number,
+                'db_entry_id': db_entry_id, 'gene_id': 'ENSG{0:011d}'.format(i),
+            })
+            for j in range(rows_per_entry['transcripts']):
+                rows[models.EnsemblTranscript].append({
+                    'crawl_number': crawl_number, 'ensembl_gene_id': ensembl_gene_id,
+                    'transcript_id': 'ENST{0:09d}{1:02d}'.format(i, j),
+                })
+            for j in range(rows_per_entry['pdbs']):
+                rows[models.PDBEntry].append({
+                    'crawl_number': crawl_number, 'db_entry_id': db_entry_id,
+                    'pdb_id': '{0}{1:03X}'.format(j % 10, i),
+                })
+            for j in range(rows_per_entry['bioassays']):
+                rows[models.BindingDBBioassay].append({
+                    'crawl_number': crawl_number, 'db_entry_id': db_entry_id,
+                    'kd_value': random.uniform(0.1, 10000.),
+                })
+            for j in range(rows_per_entry['mutations']):
+                rows[models.CbioportalMutation].append({
+                    'crawl_number': crawl_number, 'db_entry_id': db_entry_id,
+                    'oncotator_aa_pos': random.randint(1, 1000),
+                })
+        for table_class, table_rows in rows.items():
+            insert(table_class, table_rows)
+
+
+def drop_indexes():
+    inspector = db.inspect(db.engine)
+    for table_name in inspector.get_table_names():
+        for index in inspector.get_indexes(table_name):
+            if index['name'].startswith('ix_'):
+                db.engine.execute('DROP INDEX {0}'.format(index['name']))
+    db.engine.execute('ANALYZE')
+
+
+def get_lookups(nentries, crawl_number):
+    """
+    Returns a list of (name, function) tuples, each function doing one lookup for entry i.
+    """
+    def uniprot_by_ac(i):
+        return models.UniProtEntry.query.filter_by(
+            crawl_number=crawl_number, ac='P{0:05d}'.format(i)
+        ).first()
+
+    def uniprot_by_entry_name(i):
+        return models.UniProtEntry.query.filter_by(
+            crawl_number=crawl_number, entry_name='KIN{0}_HUMAN'.format(i)
+        ).first()
+
+    def db_entry_id(i):
+        return uniprot_by_ac(i).db_entry_id
+
+    def domains_by_db_entry(i):
+        return models.UniProtDomain.query.filter_by(
+            crawl_number=crawl_number, db_entry_id=db_entry_id(i)
+        ).all()
+
+    def pdbs_by_db_entry(i):
+        return models.PDBEntry.query.filter_by(
+            crawl_number=crawl_number, db_entry_id=db_entry_id(i)
+        ).count()
+
+    def potent_bioassays_by_db_entry(i):
+        return models.BindingDBBioassay.query.filter(
+            models.BindingDBBioassay.db_entry_id == db_entry_id(i),
+            models.BindingDBBioassay.kd_value < 100,
+        ).count()
+
+    def mutations_by_db_entry(i):
+        return models.CbioportalMutation.query.filter_by(
+            crawl_number=crawl_number, db_entry_id=db_entry_id(i)
+        ).count()
+
+    def transcript_by_transcript_id(i):
+        return models.EnsemblTranscript.query.filter_by(
+            crawl_number=crawl_number, transcript_id='ENST{0:09d}{1:02d}'.format(i, 0)
+        ).first()
+
+    def publications_by_gene_id(i):
+        ncbi_gene_entry = models.NCBIGeneEntry.query.filter_by(
+            crawl_number=crawl_number, gene_id=1000 + i
+        ).first()
+        return ncbi_gene_entry.publications.count()
+
+    return [
+        ('UniProtEntry by (crawl_number, ac)', uniprot_by_ac),
+        ('UniProtEntry by (crawl_number, entry_name)', uniprot_by_entry_name),
+        ('UniProtDomains by (crawl_number, db_entry_id)', domains_by_db_entry),
+        ('count PDBEntries by (crawl_number, db_entry_id)', pdbs_by_db_entry),
+        ('count Kd < 100 nM bioassays by db_entry_id', potent_bioassays_by_db_entry),
+        ('count mutations by (crawl_number, db_entry_id)', mutations_by_db_entry),
+        ('EnsemblTranscript by (crawl_number, transcript_id)', transcript_by_transcript_id),
+        ('count publications by (crawl_number, gene_id)', publications_by_gene_id),
+    ]
+
+
+def time_lookups(lookups, entry_indices):
+    timings = []
+    for name, lookup in lookups:
+        lookup(entry_indices[0])   # warm up the page cache
+        start = time.time()
+        for i in entry_indices:
+            lookup(i)
+        timings.append((time.time() - start) / len(entry_indices))
+        db.session.remove()
+    return timings
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    argparser.add_argument('--nentries', type=int, default=520)
+    argparser.add_argument('--ncrawls', type=int, default=2)
+    argparser.add_argument('--nlookups', type=int, default=200)
+    args = argparser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(temp_dir, 'benchmark.db')
+        )
+        db.create_all()
+        random.seed(0)
+        start = time.time()
+        populate(args.nentries, args.ncrawls, rows_per_entry={
+            'domains': 1, 'isoforms': 3, 'publications': 300, 'transcripts': 4, 'pdbs': 50,
+            'bioassays': 400, 'mutations': 300,
+        })
+        print 'Populated database with {0} DBEntries x {1} crawls in {2:.1f} s ({3:.0f} MB)'.format(
+            args.nentries, args.ncrawls, time.time() - start,
+            os.path.getsize(os.path.join(temp_dir, 'benchmark.db')) / 1024. / 1024.
+        )
+
+        lookups = get_lookups(args.nentries, crawl_number=args.ncrawls - 1)
+        entry_indices = [random.randrange(args.nentries) for _ in range(args.nlookups)]
+        drop_indexes()
+        timings_without_indexes = time_lookups(lookups, entry_indices)
+        start = time.time()
+        create_missing_indexes()
+        print 'Created indexes in {0:.1f} s'.format(time.time() - start)
+        timings_with_indexes = time_lookups(lookups, entry_indices)
+
+        print ''
+        print '{0:<52s} {1:>12s} {2:>12s} {3:>8s}'.format(
+            'lookup', 'no index/ms', 'indexed/ms', 'speedup'
+        )
+        for (name, _), without, with_ in zip(lookups, timings_without_indexes, timings_with_indexes):
+            print '{0:<52s} {1:>12.3f} {2:>12.3f} {3:>7.0f}x'.format(
+                name, without * 1000, with_ * 1000, without / with_
+            )
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,15 @@ from targetexplorer.bindingdb import GatherBindingDB
 argparser = argparse.ArgumentParser(description='Gather BindingDB data')
 argparser.add_argument(
     '--use_existing_bindingdb_data',
-    help='Do not download a new BindingDB_All.tab file. Only works if an existing file is present.',
+    help='Do not download a new BindingDB data file. Only works if an existing BindingDB_All.tab '
+         'or BindingDB_All.tsv.zip file is present.',
+    action='store_true',
+    default=False
+)
+argparser.add_argument(
+    '--no_artifact_cache',
+    help='Extract data from the raw data file even if extracted data from a previous run with '
+         'the same inputs is present in external-data/artifacts.',
     action='store_true',
     default=False
 )
@@ -18,5 +26,6 @@ args = argparser.parse_args()
 
 GatherBindingDB(
     use_existing_bindingdb_data=args.use_existing_bindingdb_data,
+    use_artifact_cache=not args.no_artifact_cache,
     commit_to_db=not args.nocommit
 )
@@ -8,6 +8,13 @@ argparser.add_argument(
     action='store_true',
     default=False
 )
+argparser.add_argument(
+    '--no_artifact_cache',
+    help='Extract data from the raw data file even if extracted data from a previous run with '
+         'the same inputs is present in external-data/artifacts.',
+    action='store_true',
+    default=False
+)
 argparser.add_argument(
     '--nocommit',
     help='Run script, but do not commit to database.',
@@ -18,5 +25,6 @@ args = argparser.parse_args()
 
 GatherNCBIGene(
     use_existing_gene2pubmed=args.use_existing_gene2pubmed,
+    use_artifact_cache=not args.no_artifact_cache,
     commit_to_db=not args.nocommit
 )
@@ -9,6 +9,36 @@ argparser.add_argument(
     action='store_true',
     default=False
 )
+argparser.add_argument(
+    '--oncotator_nthreads',
+    help='Maximum number of concurrent requests to the Oncotator server (default: 8).',
+    type=int,
+    default=8
+)
+argparser.add_argument(
+    '--cbioportal_nthreads',
+    help='Maximum number of concurrent requests to the cBioPortal server (default: 4).',
+    type=int,
+    default=4
+)
+argparser.add_argument(
+    '--transcript_gtf',
+    help='GTF file of Ensembl transcript models. If given together with --cds_fasta, missense '
+         'mutations are annotated locally instead of using the Oncotator web service.',
+    default=None
+)
+argparser.add_argument(
+    '--cds_fasta',
+    help='FASTA file of Ensembl CDS sequences (e.g. Homo_sapiens.GRCh37.75.cds.all.fa.gz).',
+    default=None
+)
+argparser.add_argument(
+    '--full_refresh',
+    help='Download all studies, even those which are unchanged since they were last '
+         'downloaded, and extract all mutation data rather than copying it from the safe crawl.',
+    action='store_true',
+    default=False
+)
 argparser.add_argument(
     '--nocommit',
     help='Run script, but do not commit anything to database.',
@@ -20,5 +50,10 @@ args = argparser.parse_args()
 GatherCbioportalData(
     use_existing_cbioportal_data=args.use_existing_data,
     use_existing_oncotator_data=args.use_existing_data,
+    oncotator_nthreads=args.oncotator_nthreads,
+    cbioportal_nthreads=args.cbioportal_nthreads,
+    transcript_gtf_filepath=args.transcript_gtf,
+    cds_fasta_filepath=args.cds_fasta,
+    incremental=not args.full_refresh,
     commit_to_db=not args.nocommit
 )
@@ -10,13 +10,19 @@ def parse_arguments():
         argparser.add_argument(
             '--db_name', type=str, required=False, help='Database name, without extension'
         )
+        argparser.add_argument(
+            '--sqlalchemy_database_uri', type=str, required=False,
+            help='SQLAlchemy URI of an existing database to use instead of a SQLite file, '
+                 'e.g. postgresql://user@host/dbname (requires psycopg2)'
+        )
         return argparser.parse_args()
 
 args = parse_arguments()
 
 InitProject(
     db_name=args.db_name,
-    project_path=os.getcwd()
+    project_path=os.getcwd(),
+    sqlalchemy_database_uri=args.sqlalchemy_database_uri
 )
 print(
     'Please now edit the UniProt search options in {0} before running the '
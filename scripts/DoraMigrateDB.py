@@ -0,0 +1,29 @@
+import sys
+import argparse
+from targetexplorer.migrate import add_missing_columns, create_missing_indexes
+from targetexplorer.migrate import SchemaMigrationError
+
+argparser = argparse.ArgumentParser(
+    description='Add the columns and indexes declared in the current version of TargetExplorer '
+                'to an existing project database'
+)
+argparser.add_argument(
+    '--drop_undeclared_indexes',
+    help='Also drop indexes which are no longer declared, e.g. single-column crawl_number '
+         'indexes superseded by composite indexes.',
+    action='store_true',
+    default=False
+)
+args = argparser.parse_args()
+
+try:
+    added_column_names = add_missing_columns()
+except SchemaMigrationError as e:
+    print 'ERROR: {0}'.format(e)
+    sys.exit(1)
+created_index_names, dropped_index_names = create_missing_indexes(
+    drop_undeclared_indexes=args.drop_undeclared_indexes
+)
+print 'Added {0} columns; created {1} indexes; dropped {2} indexes.'.format(
+    len(added_column_names), len(created_index_names), len(dropped_index_names)
+)
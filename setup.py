@@ -115,7 +115,7 @@ setup(
             'resources/testdir'
         ]
     },
-    scripts = ['scripts/DoraInit.py', 'scripts/DoraGatherUniProt.py', 'scripts/DoraGatherPDB.py', 'scripts/DoraGatherNCBIGene.py', 'scripts/DoraGatherBindingDB.py', 'scripts/DoraGathercBioPortal.py', 'scripts/DoraCommit.py'],
+    scripts = ['scripts/DoraInit.py', 'scripts/DoraGatherUniProt.py', 'scripts/DoraGatherPDB.py', 'scripts/DoraGatherNCBIGene.py', 'scripts/DoraGatherBindingDB.py', 'scripts/DoraGathercBioPortal.py', 'scripts/DoraCommit.py', 'scripts/DoraMigrateDB.py'],
     entry_points = {'nose.plugins.0.10':
         [
             'setup_tmp_db_plugin = targetexplorer.tests.noseplugins:SetUpTmpDbPlugin'
@@ -0,0 +1,192 @@
+import os
+import sys
+import glob
+import gzip
+import json
+import hashlib
+import cPickle as pickle
+from targetexplorer.core import external_data_dirpath, logger
+from targetexplorer.core import read_project_config, read_manual_overrides
+
+artifact_cache_dirpath = os.path.join(external_data_dirpath, 'artifacts')
+
+# project config values which determine the set of targets in the db, and so the records
+# extracted by every stage
+artifact_project_config_keys = ['uniprot_query', 'uniprot_domain_regex']
+
+
+def hash_file(filepath, blocksize=1024*1024):
+    """
+    Returns the SHA-1 hex digest of a file's contents.
+    """
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as file_obj:
+        while True:
+            block = file_obj.read(blocksize)
+            if not block:
+                break
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def get_code_version(module_names):
+    """
+    Returns a SHA-1 hex digest of the source files of the given (imported) modules, so that
+    artifacts are invalidated when the code which produced them changes.
+    """
+    sha1 = hashlib.sha1()
+    for module_name in sorted(module_names):
+        source_filepath = os.path.splitext(sys.modules[module_name].__file__)[0] + '.py'
+        sha1.update(module_name)
+        sha1.update(hash_file(source_filepath))
+    return sha1.hexdigest()
+
+
+def get_project_config_fingerprint():
+    """
+    Returns the parts of the project config and manual overrides on which extracted records
+    depend, as a dict.
+    """
+    project_config = read_project_config()
+    return {
+        'project_config': {
+            key: project_config.get(key) for key in artifact_project_config_keys
+        },
+        'manual_overrides': read_manual_overrides(),
+    }
+
+
+class ArtifactCache(object):
+    """
+    Stores the parsed, filtered intermediate records of a gather stage, so that re-running the
+    stage on unchanged inputs does not repeat the parsing.
+
+    Each artifact is keyed by a hash of the raw input files, the relevant project config (see
+    get_project_config_fingerprint), any stage-specific parameters, and the source code of the
+    modules which produce it. Artifacts are stored as gzipped pickles in
+    external-data/artifacts/<stage>/<key>.pkl.gz.
+
+    >>> cache = ArtifactCache('ncbi_gene')
+    >>> key = cache.get_key([gene2pubmed_filepath], params={'gene_ids': gene_ids}, module_names=['targetexplorer.ncbi_gene'])
+    >>> records = cache.get(key)
+    >>> if records is None:
+    >>>     records = read_gene2pubmed(...)
+    >>>     cache.store(key, records)
+
+    File hashes are stored alongside the artifacts with each file's size and modification time,
+    so that a large input file is only hashed again after it changes. Each stage has its own
+    file-hashes.json, so that stages run concurrently do not overwrite each other's hashes.
+    """
+    def __init__(self, stage, dirpath=artifact_cache_dirpath, max_artifacts=2):
+        """
+        Parameters
+        ----------
+        stage: str
+            e.g. 'bindingdb'
+        dirpath: str
+        max_artifacts: int
+            Number of artifacts kept for the stage; older artifacts are removed when a new one
+            is stored
+        """
+        self.stage = stage
+        self.stage_dirpath = os.path.join(dirpath, stage)
+        self.file_hashes_filepath = os.path.join(self.stage_dirpath, 'file-hashes.json')
+        self.max_artifacts = max_artifacts
+        if not os.path.exists(self.stage_dirpath):
+            os.makedirs(self.stage_dirpath)
+
+    def _artifact_filepath(self, key):
+        return os.path.join(self.stage_dirpath, key + '.pkl.gz')
+
+    def _read_file_hashes(self):
+        if not os.path.exists(self.file_hashes_filepath):
+            return dict()
+        with open(self.file_hashes_filepath) as file_hashes_file:
+            return json.load(file_hashes_file)
+
+    def _write_file_hashes(self, file_hashes):
+        # unique to this process, so that concurrent writers do not write to the same file
+        partial_filepath = '{0}.{1}.part'.format(self.file_hashes_filepath, os.getpid())
+        with open(partial_filepath, 'w') as file_hashes_file:
+            json.dump(file_hashes, file_hashes_file, indent=1, sort_keys=True)
+        os.rename(partial_filepath, self.file_hashes_filepath)
+
+    def hash_input_file(self, filepath):
+        """
+        Returns the SHA-1 hex digest of a file, reusing the stored hash if the file's size and
+        modification time are unchanged.
+        """
+        file_hashes = self._read_file_hashes()
+        abs_filepath = os.path.abspath(filepath)
+        stat = os.stat(filepath)
+        signature = [stat.st_size, stat.st_mtime]
+        stored = file_hashes.get(abs_filepath)
+        if stored is not None and stored['signature'] == signature:
+            return stored['sha1']
+        file_sha1 = hash_file(filepath)
+        file_hashes[abs_filepath] = {'signature': signature, 'sha1': file_sha1}
+        self._write_file_hashes(file_hashes)
+        return file_sha1
+
+    def get_key(self, input_filepaths, params=None, module_names=None):
+        """
+        Parameters
+        ----------
+        input_filepaths: list of str
+        params: dict or None
+            Stage-specific parameters which determine the artifact (must be JSON-serializable)
+        module_names: list of str or None
+            Modules whose source is included in the key
+
+        Returns
+        -------
+        key: str
+        """
+        key_data = {
+            'stage': self.stage,
+            'input_files': [self.hash_input_file(filepath) for filepath in input_filepaths],
+            'config': get_project_config_fingerprint(),
+            'params': params,
+            'code_version': get_code_version(module_names or []),
+        }
+        return hashlib.sha1(json.dumps(key_data, sort_keys=True)).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the stored artifact, or None if there is no artifact for this key.
+        """
+        artifact_filepath = self._artifact_filepath(key)
+        if not os.path.exists(artifact_filepath):
+            return None
+        logger.info('Using cached {0} artifact {1}'.format(self.stage, key))
+        with gzip.open(artifact_filepath, 'rb') as artifact_file:
+            return pickle.load(artifact_file)
+
+    def store(self, key, artifact):
+        """
+        Writes the artifact to a temporary file which is only moved into place once complete,
+        then removes the oldest artifacts for the stage beyond max_artifacts.
+        """
+        artifact_filepath = self._artifact_filepath(key)
+        partial_filepath = artifact_filepath + '.part'
+        with gzip.open(partial_filepath, 'wb') as artifact_file:
+            pickle.dump(artifact, artifact_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(partial_filepath, artifact_filepath)
+
+        artifact_filepaths = sorted(
+            glob.glob(os.path.join(self.stage_dirpath, '*.pkl.gz')),
+            key=os.path.getmtime, reverse=True
+        )
+        for old_artifact_filepath in artifact_filepaths[self.max_artifacts:]:
+            if old_artifact_filepath != artifact_filepath:
+                os.remove(old_artifact_filepath)
+
+    def get_or_create(self, key, create_fn):
+        """
+        Returns the stored artifact for this key, or calls create_fn() and stores the result.
+        """
+        artifact = self.get(key)
+        if artifact is None:
+            artifact = create_fn()
+            self.store(key, artifact)
+        return artifact
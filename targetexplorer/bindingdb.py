@@ -1,34 +1,58 @@
 import urllib2
-import subprocess
+import re
 import os
+import shutil
+import sqlite3
+import zipfile
 import datetime
+import multiprocessing
+from Bio import bgzf
 from targetexplorer.flaskapp import models, db
-from targetexplorer.core import external_data_dirpath, logger
+from targetexplorer.core import external_data_dirpath, logger, int_else_none
+from targetexplorer.artifacts import ArtifactCache
+from targetexplorer.bulkload import bulk_insert_mappings
 
 bindingdb_data_dir = os.path.join(external_data_dirpath, 'BindingDB')
 bindingdb_all_data_filepath = os.path.join(bindingdb_data_dir, 'BindingDB_All.tab')
+# BindingDB is downloaded as a zip archive, which is read without being decompressed to disk
+bindingdb_archive_filepath = os.path.join(bindingdb_data_dir, 'BindingDB_All.tsv.zip')
+bindingdb_url = 'http://bindingdb.org/bind/downloads/BindingDB_All_2015m5.tsv.zip'
 bindingdb_matches_filepath = os.path.join(bindingdb_data_dir, 'bindingdb-matches.tab')
 
 
 class GatherBindingDB(object):
     def __init__(self,
                  use_existing_bindingdb_data=False,
+                 nprocesses=None,
+                 use_artifact_cache=True,
                  run_main=True,
                  commit_to_db=True
                  ):
+        """
+        Parameters
+        ----------
+        use_existing_bindingdb_data: bool
+        nprocesses: int
+            Number of processes used to scan the BindingDB data file (default: one per CPU)
+        use_artifact_cache: bool
+            Reuse the bioassay data extracted by a previous run, if the BindingDB data file,
+            the UniProt ACs in the db and the code are unchanged (see artifacts.ArtifactCache)
+        run_main: bool
+        commit_to_db: bool
+        """
         self.commit_to_db = commit_to_db
+        self.nprocesses = nprocesses
+        self.use_artifact_cache = use_artifact_cache
         self.use_existing_bindingdb_data = use_existing_bindingdb_data
         self.now = datetime.datetime.utcnow()
+        db.use_sqlite_profile('gather')
         crawldata_row = models.CrawlData.query.first()
         self.current_crawl_number = crawldata_row.current_crawl_number
         if run_main:
             self.setup()
             self.get_bindingdb_data_file()
             self.get_uniprot_acs_from_db()
-            extracted_bindingdb_data = extract_bindingdb_data(
-                bindingdb_all_data_filepath,
-                self.db_uniprot_acs
-            )
+            extracted_bindingdb_data = self.get_extracted_bindingdb_data()
             self.create_db_rows(extracted_bindingdb_data)
             self.commit()
 
@@ -37,12 +61,23 @@ class GatherBindingDB(object):
             os.mkdir(bindingdb_data_dir)
 
     def get_bindingdb_data_file(self):
-        # Unless use_existing_bindingdb_data is set to True, retrieve a new file from BindingDB
-        if os.path.exists(bindingdb_all_data_filepath) and self.use_existing_bindingdb_data:
-            logger.info('BindingDB data file found at: {0}'.format(bindingdb_all_data_filepath))
-        else:
-            logger.info('Retrieving new BindingDB data file from BindingDB server...')
-            retrieve_all_BindingDB_data(bindingdb_all_data_filepath, decompress=False)
+        # Unless use_existing_bindingdb_data is set to True, retrieve a new file from BindingDB.
+        # An existing decompressed TSV file is preferred, since it can be scanned in parallel.
+        # Downloaded archives are converted to BGZF files when they are first used, and again
+        # whenever the archive changes, so the archive is preferred to a BGZF file converted
+        # from it.
+        for existing_filepath in [
+                bindingdb_all_data_filepath,
+                bindingdb_archive_filepath,
+                get_bgzf_filepath(bindingdb_archive_filepath),
+                ]:
+            if os.path.exists(existing_filepath) and self.use_existing_bindingdb_data:
+                logger.info('BindingDB data file found at: {0}'.format(existing_filepath))
+                self.bindingdb_data_filepath = existing_filepath
+                return
+        logger.info('Retrieving new BindingDB data file from BindingDB server...')
+        retrieve_all_BindingDB_data(bindingdb_archive_filepath)
+        self.bindingdb_data_filepath = bindingdb_archive_filepath
 
     def get_uniprot_acs_from_db(self):
         self.db_uniprot_acs = [
@@ -51,41 +86,147 @@ class GatherBindingDB(object):
             ).values(models.UniProtEntry.ac)
         ]
 
+    def get_extracted_bindingdb_data(self):
+        def extract():
+            return extract_bindingdb_data(
+                self.bindingdb_data_filepath,
+                self.db_uniprot_acs,
+                nprocesses=self.nprocesses,
+            )
+        if not self.use_artifact_cache:
+            return extract()
+        artifact_cache = ArtifactCache('bindingdb')
+        key = artifact_cache.get_key(
+            [self.bindingdb_data_filepath],
+            params={'uniprot_acs': sorted(self.db_uniprot_acs)},
+            module_names=['targetexplorer.bindingdb'],
+        )
+        return artifact_cache.get_or_create(key, extract)
+
     def create_db_rows(self, extracted_bindingdb_data):
-        # for bindingdb_data_tuple in extracted_bindingdb_data:
-        for ac, bioassays_data in extracted_bindingdb_data.iteritems():
-            # ac, bioassays_data = bindingdb_data_tuple
-            db_uniprot_row = models.UniProtEntry.query.filter_by(
-                crawl_number=self.current_crawl_number, ac=ac
-            ).first()
-            db_entry_id = db_uniprot_row.db_entry_id
-            db_entry_row = models.DBEntry.query.filter_by(id=db_entry_id).first()
-            db_entry_row.nbioassays = len(bioassays_data)
+        self.delete_current_crawl_rows()
+        db_entry_ids = self.get_db_entry_ids(extracted_bindingdb_data.keys())
+        ligand_ids = self.create_ligand_rows(extracted_bindingdb_data)
+        bulk_insert_mappings(
+            models.BindingDBBioassay,
+            [
+                self.build_bioassay_mapping(
+                    bioassay_data,
+                    db_entry_ids[ac],
+                    ligand_ids.get(int_else_none(bioassay_data['ligand_BindingDB_ID'])),
+                )
+                for ac, bioassays_data in extracted_bindingdb_data.iteritems()
+                for bioassay_data in bioassays_data
+            ]
+        )
+        self.update_nbioassays()
 
+    def delete_current_crawl_rows(self):
+        """
+        Deletes any BindingDB rows already added in the current crawl (e.g. by a previous run
+        of this gather stage), so that the stage can be rerun without violating the unique
+        (crawl_number, bindingdb_id) index on ligands. Bioassays are deleted first, since they
+        refer to the ligands.
+        """
+        for model in [models.BindingDBBioassay, models.BindingDBLigand]:
+            table = model.__table__
+            result = db.session.execute(
+                table.delete().where(table.c.crawl_number == self.current_crawl_number)
+            )
+            if result.rowcount:
+                logger.info('Deleted {0} {1} rows from a previous run in crawl {2}'.format(
+                    result.rowcount, table.name, self.current_crawl_number
+                ))
+        db_entries_table = models.DBEntry.__table__
+        db.session.execute(db_entries_table.update().where(
+            db_entries_table.c.crawl_number == self.current_crawl_number
+        ).values(nbioassays=None))
+
+    def create_ligand_rows(self, extracted_bindingdb_data):
+        """
+        Adds one BindingDBLigand row for each distinct BindingDB monomer ID in the extracted data.
+
+        Returns
+        -------
+        dict of {bindingdb_id: ligand_id}
+        """
+        ligand_mappings = {}
+        for bioassays_data in extracted_bindingdb_data.itervalues():
             for bioassay_data in bioassays_data:
-                bindingdb_bioassay_obj = models.BindingDBBioassay(
+                bindingdb_id = int_else_none(bioassay_data['ligand_BindingDB_ID'])
+                if bindingdb_id is None or bindingdb_id in ligand_mappings:
+                    continue
+                ligand_mappings[bindingdb_id] = dict(
                     crawl_number=self.current_crawl_number,
-                    bindingdb_source=bioassay_data['BindingDB_source'],
-                    doi=bioassay_data['DOI'],
-                    pmid=bioassay_data['PMID'],
-                    temperature=bioassay_data['temperature'],
-                    ph=bioassay_data['pH'],
-                    target_name=bioassay_data['target_name'],
-                    ligand_bindingdb_id=bioassay_data['ligand_BindingDB_ID'],
-                    ligand_chembl_id=bioassay_data['ligand_ChEMBL_ID'],
-                    ligand_smiles_string=bioassay_data['ligand_SMILES_string'],
-                    ligand_zinc_id=bioassay_data['ligand_zinc_id'],
-
-                    ki=bioassay_data['Ki'],
-                    ic50=bioassay_data['IC50'],
-                    kd=bioassay_data['Kd'],
-                    ec50=bioassay_data['EC50'],
-                    kon=bioassay_data['kon'],
-                    koff=bioassay_data['koff'],
-
-                    db_entry=db_entry_row,
+                    bindingdb_id=bindingdb_id,
+                    chembl_id=bioassay_data['ligand_ChEMBL_ID'],
+                    smiles_string=bioassay_data['ligand_SMILES_string'],
+                    zinc_id=bioassay_data['ligand_zinc_id'],
                 )
-                db.session.add(bindingdb_bioassay_obj)
+        bulk_insert_mappings(models.BindingDBLigand, ligand_mappings.values())
+        return dict(
+            db.session.query(models.BindingDBLigand.bindingdb_id, models.BindingDBLigand.id).filter_by(
+                crawl_number=self.current_crawl_number
+            )
+        )
+
+    def get_db_entry_ids(self, uniprot_acs):
+        """
+        Returns
+        -------
+        dict of {uniprot_ac: db_entry_id}
+            resolved with a single query for the current crawl
+        """
+        uniprot_acs = set(uniprot_acs)
+        return {
+            ac: db_entry_id for ac, db_entry_id in db.session.query(
+                models.UniProtEntry.ac, models.UniProtEntry.db_entry_id
+            ).filter_by(crawl_number=self.current_crawl_number)
+            if ac in uniprot_acs
+        }
+
+    def build_bioassay_mapping(self, bioassay_data, db_entry_id, ligand_id):
+        bioassay_mapping = dict(
+            crawl_number=self.current_crawl_number,
+            bindingdb_source=bioassay_data['BindingDB_source'],
+            doi=bioassay_data['DOI'],
+            pmid=bioassay_data['PMID'],
+            temperature=bioassay_data['temperature'],
+            ph=bioassay_data['pH'],
+            target_name=bioassay_data['target_name'],
+            ligand_id=ligand_id,
+
+            ki=bioassay_data['Ki'],
+            ic50=bioassay_data['IC50'],
+            kd=bioassay_data['Kd'],
+            ec50=bioassay_data['EC50'],
+            kon=bioassay_data['kon'],
+            koff=bioassay_data['koff'],
+
+            db_entry_id=db_entry_id,
+        )
+        bioassay_mapping.update(parse_bioassay_measurements(bioassay_data))
+        return bioassay_mapping
+
+    def update_nbioassays(self):
+        """
+        Sets DBEntry.nbioassays for all DBEntries with bioassays in the current crawl, with a
+        single UPDATE.
+        """
+        db_entries_table = models.DBEntry.__table__
+        bioassays_table = models.BindingDBBioassay.__table__
+        current_crawl_bioassays = bioassays_table.c.crawl_number == self.current_crawl_number
+        db.session.execute(db_entries_table.update().where(db.and_(
+            db_entries_table.c.crawl_number == self.current_crawl_number,
+            db_entries_table.c.id.in_(
+                db.select([bioassays_table.c.db_entry_id]).where(current_crawl_bioassays)
+            ),
+        )).values(
+            nbioassays=db.select([db.func.count(bioassays_table.c.id)]).where(db.and_(
+                current_crawl_bioassays,
+                bioassays_table.c.db_entry_id == db_entries_table.c.id,
+            )).as_scalar()
+        ))
 
     def commit(self):
         current_crawl_datestamp_row = models.DateStamps.query.filter_by(
@@ -97,24 +238,37 @@ class GatherBindingDB(object):
         print 'Done.'
 
 
-def retrieve_all_BindingDB_data(bindingdb_all_data_filepath, decompress=True):
+def retrieve_all_BindingDB_data(bindingdb_archive_filepath, url=bindingdb_url,
+                                blocksize=1024*1024):
     """
-    Retrieves all BindingDB data in compressed tab-separated format, then decompresses and writes to file.
-    Uses gunzip for decompression.
+    Retrieves all BindingDB data as a zip archive of a tab-separated file. The download is
+    streamed to disk in blocks of blocksize bytes, and only moved to bindingdb_archive_filepath
+    once complete.
     """
-    print 'Downloading BindingDB_All.tab.gz...'
-    url = 'http://bindingdb.org/bind/downloads/BindingDB_All_2015m5.tsv.zip'
+    logger.info('Downloading {0}...'.format(url))
+    partial_filepath = bindingdb_archive_filepath + '.part'
     response = urllib2.urlopen(url)
-    page = response.read(1000000000)
-    with open(bindingdb_all_data_filepath+'.gz', 'wb') as ofile:
-        ofile.write(page)
-    print 'Finished downloading BindingDB_All.tab.gz'
+    with open(partial_filepath, 'wb') as ofile:
+        shutil.copyfileobj(response, ofile, blocksize)
+    os.rename(partial_filepath, bindingdb_archive_filepath)
+    logger.info('Finished downloading {0}'.format(bindingdb_archive_filepath))
+
+
+def open_bindingdb_archive_member(bindingdb_archive_filepath):
+    """
+    Returns a file-like object which decompresses the TSV file in a BindingDB zip archive as
+    it is read.
+    """
+    archive = zipfile.ZipFile(bindingdb_archive_filepath)
+    member_names = [
+        name for name in archive.namelist() if name.endswith('.tsv') or name.endswith('.tab')
+    ]
+    if len(member_names) != 1:
+        raise Exception('Expected a single TSV file in {0}; found {1}'.format(
+            bindingdb_archive_filepath, archive.namelist()
+        ))
+    return archive.open(member_names[0])
 
-    # decompress
-    if decompress:
-        print 'Decompressing BindingDB_All.tab.gz...'
-        subprocess.call('gunzip -f %s' % bindingdb_all_data_filepath+'.gz', shell=True)
-        print 'Finished decompressing BindingDB_All.tab.gz'
 
 def get_acs(line):
     words = line.split('\t')
@@ -169,25 +323,410 @@ def get_bioassay_data(bioassay_data_line_tsplit):
     return bioassay_data
 
 
+# e.g. ' 12.5', '>10000', '<0.1', '1.2e+4'
+bindingdb_measurement_regex = re.compile(
+    '^\\s*([<>])?\\s*([0-9]*\\.?[0-9]+(?:[eE][+-]?[0-9]+)?)\\s*$'
+)
+
+# bioassay_data key => BindingDBBioassay column prefix
+bindingdb_measurement_names = [
+    ('Ki', 'ki'), ('IC50', 'ic50'), ('Kd', 'kd'), ('EC50', 'ec50'), ('kon', 'kon'), ('koff', 'koff')
+]
+
+
+def parse_bindingdb_measurement(measurement_string):
+    """
+    Parses a measurement value from the BindingDB data file. Ki, IC50, Kd and EC50 values are
+    given in nM, kon values in M-1 s-1, and koff values in s-1; values are not converted.
+
+    Returns
+    -------
+    (value, qualifier): (float, str) or (None, None) if there is no (numeric) value
+        qualifier is '=' for exact values, or '<' or '>' for bounds
+
+    >>> parse_bindingdb_measurement('>10000')
+    (10000.0, '>')
+    """
+    match = re.match(bindingdb_measurement_regex, measurement_string)
+    if match is None:
+        return None, None
+    qualifier, value = match.groups()
+    return float(value), qualifier or '='
+
+
+def parse_bioassay_measurements(bioassay_data):
+    """
+    Returns a dict of parsed measurement values and qualifiers for a bioassay, keyed by
+    BindingDBBioassay column names (e.g. 'kd_value', 'kd_qualifier').
+    """
+    measurements = dict()
+    for measurement_name, column_prefix in bindingdb_measurement_names:
+        value, qualifier = parse_bindingdb_measurement(bioassay_data[measurement_name])
+        measurements[column_prefix + '_value'] = value
+        measurements[column_prefix + '_qualifier'] = qualifier
+    return measurements
+
+
 def extract_bindingdb_data(
         bindingdb_data_filepath,
-        uniprot_acs
+        uniprot_acs,
+        nprocesses=None,
+        chunksize=64*1024*1024,
+        use_index=True,
     ):
-    bindingdb_data_dict = dict()
-    with open(bindingdb_data_filepath) as bindingdb_data_file:
-        first_line = True
-        for line in bindingdb_data_file:
-            if first_line:
-                first_line = False
-                continue
-            words = line.split('\t')
-            ac_field = words[20]
-            ac = ac_field.split(' ')[0]
-            if ac in uniprot_acs:
-                if ac not in bindingdb_data_dict:
-                    bindingdb_data_dict[ac] = []
-                bindingdb_data_dict[ac].append(
-                    get_bioassay_data(words)   # returns a dict
+    """
+    Extracts bioassay data for the given UniProt ACs from a BindingDB TSV file, a BindingDB
+    zip archive (a filepath ending in '.zip'), or a BGZF copy of the TSV file (ending in
+    '.bgz').
+
+    If use_index is True, the rows for the given ACs are read directly using a
+    BindingDBIndex, which is built the first time a data file is used (or when it has changed).
+    A zip archive is first converted to a BGZF-compressed copy (see
+    convert_bindingdb_archive_to_bgzf), which can be read at arbitrary offsets. The conversion
+    is repeated if the archive changes, e.g. when it is downloaded again.
+
+    Otherwise, the whole file is scanned. A TSV file is split into byte ranges of approximately
+    chunksize bytes, aligned on line boundaries, which are scanned in a pool of nprocesses
+    processes (by default one per CPU). Files no larger than a single chunk are scanned in the
+    current process. Compressed files are read through a streaming decompressor in the current
+    process, since the compressed stream can not be split into byte ranges.
+
+    Returns
+    -------
+    dict of {ac: [bioassay_data, ...]}, with bioassays in the order they appear in the file
+    """
+    uniprot_acs = frozenset(uniprot_acs)
+    if use_index:
+        if bindingdb_data_filepath.endswith('.zip'):
+            bgzf_filepath = get_bgzf_filepath(bindingdb_data_filepath)
+            bindingdb_index = BindingDBIndex(
+                bgzf_filepath, source_filepath=bindingdb_data_filepath
+            )
+            if not bindingdb_index.is_current():
+                logger.info('Converting {0} to {1}...'.format(bindingdb_data_filepath, bgzf_filepath))
+                bindingdb_index.write(
+                    convert_bindingdb_archive_to_bgzf(bindingdb_data_filepath, bgzf_filepath)
                 )
+        else:
+            bindingdb_index = BindingDBIndex(bindingdb_data_filepath)
+            if not bindingdb_index.is_current():
+                logger.info('Indexing {0}...'.format(bindingdb_data_filepath))
+                if bindingdb_data_filepath.endswith('.bgz'):
+                    bindingdb_index.write(index_bgzf_file(bindingdb_data_filepath))
+                else:
+                    bindingdb_index.write(index_bindingdb_data_file(
+                        bindingdb_data_filepath, nprocesses=nprocesses, chunksize=chunksize
+                    ))
+        return bindingdb_index.extract_bindingdb_data(uniprot_acs)
+
+    if bindingdb_data_filepath.endswith('.zip') or bindingdb_data_filepath.endswith('.bgz'):
+        if bindingdb_data_filepath.endswith('.zip'):
+            bindingdb_data_file = open_bindingdb_archive_member(bindingdb_data_filepath)
+        else:
+            bindingdb_data_file = bgzf.BgzfReader(bindingdb_data_filepath, 'rb')
+        try:
+            # skip header line
+            bindingdb_data_file.readline()
+            return _extract_bindingdb_data_from_lines(bindingdb_data_file, uniprot_acs)
+        finally:
+            bindingdb_data_file.close()
+
+    results = map_line_aligned_byte_ranges(
+        _extract_bindingdb_data_from_byte_range,
+        bindingdb_data_filepath,
+        uniprot_acs,
+        nprocesses=nprocesses,
+        chunksize=chunksize,
+    )
+
+    bindingdb_data_dict = dict()
+    for result in results:
+        for ac, bioassays_data in result.iteritems():
+            if ac not in bindingdb_data_dict:
+                bindingdb_data_dict[ac] = []
+            bindingdb_data_dict[ac].extend(bioassays_data)
 
     return bindingdb_data_dict
+
+
+def map_line_aligned_byte_ranges(func, filepath, arg, nprocesses=None, chunksize=64*1024*1024):
+    """
+    Calls func((filepath, start, end, arg)) for each byte range returned by
+    plan_line_aligned_byte_ranges, using a pool of nprocesses processes if there is more than
+    one byte range. Returns the results in the order of the byte ranges.
+    """
+    byte_ranges = plan_line_aligned_byte_ranges(filepath, chunksize)
+    func_args = [(filepath, start, end, arg) for start, end in byte_ranges]
+    if len(func_args) <= 1 or nprocesses == 1:
+        return map(func, func_args)
+    pool = multiprocessing.Pool(nprocesses)
+    try:
+        return pool.map(func, func_args)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def plan_line_aligned_byte_ranges(filepath, chunksize):
+    """
+    Splits a text file (excluding the header line) into consecutive (start, end) byte ranges
+    of approximately chunksize bytes, each starting at the beginning of a line and ending
+    after a newline (or at the end of the file).
+    """
+    filesize = os.path.getsize(filepath)
+    byte_ranges = []
+    with open(filepath, 'rb') as text_file:
+        text_file.readline()
+        start = text_file.tell()
+        while start < filesize:
+            text_file.seek(min(start + chunksize, filesize))
+            if text_file.tell() < filesize:
+                # move to the start of the next line
+                text_file.readline()
+            end = text_file.tell()
+            byte_ranges.append((start, end))
+            start = end
+    return byte_ranges
+
+
+def _extract_bindingdb_data_from_byte_range(args):
+    bindingdb_data_filepath, start, end, uniprot_acs = args
+    with open(bindingdb_data_filepath, 'rb') as bindingdb_data_file:
+        bindingdb_data_file.seek(start)
+        return _extract_bindingdb_data_from_lines(
+            iter_lines_in_byte_range(bindingdb_data_file, start, end), uniprot_acs
+        )
+
+
+def iter_lines_in_byte_range(text_file, start, end):
+    position = start
+    for line in text_file:
+        if position >= end:
+            break
+        position += len(line)
+        yield line
+
+
+def _extract_bindingdb_data_from_lines(lines, uniprot_acs):
+    bindingdb_data_dict = dict()
+    for line in lines:
+        words = line.split('\t')
+        ac_field = words[20]
+        ac = ac_field.split(' ')[0]
+        if ac in uniprot_acs:
+            if ac not in bindingdb_data_dict:
+                bindingdb_data_dict[ac] = []
+            bindingdb_data_dict[ac].append(
+                get_bioassay_data(words)   # returns a dict
+            )
+    return bindingdb_data_dict
+
+
+def get_row_ac(line):
+    """
+    Returns the first UniProt AC for a row of a BindingDB TSV file. Only the first 21 fields
+    are split, since this is done for every row.
+    """
+    words = line.split('\t', 21)
+    if len(words) < 21:
+        return ''
+    return words[20].split(' ')[0]
+
+
+def index_bindingdb_data_file(bindingdb_data_filepath, nprocesses=None, chunksize=64*1024*1024):
+    """
+    Returns a list of (ac, offset) tuples for all rows of a BindingDB TSV file.
+    """
+    ac_offsets = []
+    for result in map_line_aligned_byte_ranges(
+            _index_byte_range, bindingdb_data_filepath, None,
+            nprocesses=nprocesses, chunksize=chunksize
+            ):
+        ac_offsets.extend(result)
+    return ac_offsets
+
+
+def _index_byte_range(args):
+    bindingdb_data_filepath, start, end, _ = args
+    ac_offsets = []
+    offset = start
+    with open(bindingdb_data_filepath, 'rb') as bindingdb_data_file:
+        bindingdb_data_file.seek(start)
+        for line in iter_lines_in_byte_range(bindingdb_data_file, start, end):
+            ac = get_row_ac(line)
+            if ac != '':
+                ac_offsets.append((ac, offset))
+            offset += len(line)
+    return ac_offsets
+
+
+def index_bgzf_file(bgzf_filepath):
+    """
+    Returns a list of (ac, virtual_offset) tuples for all rows of a BGZF-compressed BindingDB
+    TSV file.
+    """
+    ac_offsets = []
+    bgzf_reader = bgzf.BgzfReader(bgzf_filepath, 'rb')
+    try:
+        bgzf_reader.readline()
+        while True:
+            offset = bgzf_reader.tell()
+            line = bgzf_reader.readline()
+            if line == '':
+                break
+            ac = get_row_ac(line)
+            if ac != '':
+                ac_offsets.append((ac, offset))
+    finally:
+        bgzf_reader.close()
+    return ac_offsets
+
+
+def get_bgzf_filepath(bindingdb_archive_filepath):
+    # BindingDB_All.tsv.zip => BindingDB_All.tsv.bgz
+    return os.path.splitext(bindingdb_archive_filepath)[0] + '.bgz'
+
+
+def convert_bindingdb_archive_to_bgzf(bindingdb_archive_filepath, bgzf_filepath,
+                                      remove_archive=False):
+    """
+    Writes the TSV file in a BindingDB zip archive to a BGZF (blocked gzip) file, which is
+    about the same size as the archive, but which can be read from any row using the virtual
+    offsets returned by BgzfWriter.tell. The archive is kept unless remove_archive is True.
+
+    Returns
+    -------
+    list of (ac, virtual_offset) tuples for all rows
+    """
+    ac_offsets = []
+    partial_filepath = bgzf_filepath + '.part'
+    archive_member = open_bindingdb_archive_member(bindingdb_archive_filepath)
+    bgzf_writer = bgzf.BgzfWriter(partial_filepath, 'wb')
+    try:
+        bgzf_writer.write(archive_member.readline())
+        for line in archive_member:
+            ac = get_row_ac(line)
+            if ac != '':
+                ac_offsets.append((ac, bgzf_writer.tell()))
+            bgzf_writer.write(line)
+    finally:
+        bgzf_writer.close()
+        archive_member.close()
+    os.rename(partial_filepath, bgzf_filepath)
+    if remove_archive:
+        os.remove(bindingdb_archive_filepath)
+    return ac_offsets
+
+
+def get_file_signature(filepath):
+    file_stat = os.stat(filepath)
+    return '{0} {1}'.format(file_stat.st_size, int(file_stat.st_mtime))
+
+
+class BindingDBIndex(object):
+    """
+    Sidecar index for a BindingDB data file (TSV or BGZF), stored in an SQLite file alongside
+    it, which maps the UniProt AC of each row to the offset of the row. The index covers all
+    rows, so it can be reused for any set of ACs, as long as the data file is unchanged (as
+    determined by its size and modification time).
+
+    For a data file converted from another file, such as a BGZF copy of a zip archive, the
+    source file is given as source_filepath, and the index is also out of date once the source
+    file has changed. A missing source file is ignored.
+
+    >>> bindingdb_index = BindingDBIndex('external-data/BindingDB/BindingDB_All.tab')
+    >>> bindingdb_index.write(index_bindingdb_data_file(bindingdb_index.data_filepath))
+    >>> bindingdb_index.extract_bindingdb_data(['P00519'])
+    """
+    def __init__(self, data_filepath, source_filepath=None):
+        self.data_filepath = data_filepath
+        self.source_filepath = source_filepath
+        self.index_filepath = data_filepath + '.index.db'
+
+    def _get_file_signatures(self):
+        file_signatures = {'data_file_signature': get_file_signature(self.data_filepath)}
+        if self.source_filepath is not None and os.path.exists(self.source_filepath):
+            file_signatures['source_file_signature'] = get_file_signature(self.source_filepath)
+        return file_signatures
+
+    def is_current(self):
+        if not os.path.exists(self.index_filepath) or not os.path.exists(self.data_filepath):
+            return False
+        connection = sqlite3.connect(self.index_filepath)
+        try:
+            metadata = dict(connection.execute('SELECT key, value FROM metadata').fetchall())
+        except sqlite3.Error:
+            return False
+        finally:
+            connection.close()
+        for key, file_signature in self._get_file_signatures().iteritems():
+            if metadata.get(key) != file_signature:
+                return False
+        return True
+
+    def write(self, ac_offsets):
+        """
+        Parameters
+        ----------
+        ac_offsets: iterable of (ac, offset) tuples
+        """
+        partial_filepath = self.index_filepath + '.part'
+        if os.path.exists(partial_filepath):
+            os.remove(partial_filepath)
+        connection = sqlite3.connect(partial_filepath)
+        try:
+            with connection:
+                connection.execute('CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)')
+                connection.execute('CREATE TABLE rows (ac TEXT NOT NULL, offset INTEGER NOT NULL)')
+                connection.executemany('INSERT INTO rows (ac, offset) VALUES (?, ?)', ac_offsets)
+                connection.execute('CREATE INDEX rows_ac ON rows (ac)')
+                connection.executemany(
+                    'INSERT INTO metadata (key, value) VALUES (?, ?)',
+                    self._get_file_signatures().items()
+                )
+        finally:
+            connection.close()
+        os.rename(partial_filepath, self.index_filepath)
+
+    def get_offsets(self, uniprot_acs, batchsize=500):
+        """
+        Returns a list of (offset, ac) tuples for rows matching the given ACs, sorted by offset.
+        """
+        uniprot_acs = list(uniprot_acs)
+        offsets = []
+        connection = sqlite3.connect(self.index_filepath)
+        try:
+            # stay below the SQLite limit on the number of query parameters
+            for b in range(0, len(uniprot_acs), batchsize):
+                batch_acs = uniprot_acs[b:b+batchsize]
+                offsets += connection.execute(
+                    'SELECT offset, ac FROM rows WHERE ac IN ({0})'.format(
+                        ', '.join(['?'] * len(batch_acs))
+                    ),
+                    batch_acs
+                ).fetchall()
+        finally:
+            connection.close()
+        return sorted(offsets)
+
+    def open_data_file(self):
+        if self.data_filepath.endswith('.bgz'):
+            return bgzf.BgzfReader(self.data_filepath, 'rb')
+        return open(self.data_filepath, 'rb')
+
+    def extract_bindingdb_data(self, uniprot_acs):
+        """
+        Returns bioassay data in the same form as extract_bindingdb_data.
+        """
+        bindingdb_data_dict = dict()
+        data_file = self.open_data_file()
+        try:
+            for offset, ac in self.get_offsets(uniprot_acs):
+                data_file.seek(offset)
+                words = data_file.readline().split('\t')
+                if ac not in bindingdb_data_dict:
+                    bindingdb_data_dict[ac] = []
+                bindingdb_data_dict[ac].append(get_bioassay_data(words))
+        finally:
+            data_file.close()
+        return bindingdb_data_dict
@@ -0,0 +1,98 @@
+import datetime
+from targetexplorer.flaskapp import db
+
+
+def bulk_insert_mappings(table_class, mappings, session=None):
+    """
+    Inserts rows given as dicts of column values into the table of a model class, within the
+    current transaction of the session.
+
+    On PostgreSQL the rows are streamed to the server with COPY FROM STDIN, which is several
+    times faster than a multi-row INSERT. Other databases use Session.bulk_insert_mappings.
+    Columns missing from a mapping are set to NULL.
+
+    Parameters
+    ----------
+    table_class: model class
+    mappings: list of dict
+    session: sqlalchemy Session or None
+        default: db.session
+    """
+    if session is None:
+        session = db.session
+    mappings = list(mappings)
+    if len(mappings) == 0:
+        return
+    connection = session.connection()
+    if connection.dialect.name != 'postgresql':
+        session.bulk_insert_mappings(table_class, mappings)
+        return
+
+    # rows added through the ORM must be inserted first, e.g. for foreign keys
+    session.flush()
+    table = table_class.__table__
+    mapping_keys = set()
+    for mapping in mappings:
+        mapping_keys.update(mapping.keys())
+    column_names = [column.name for column in table.columns if column.name in mapping_keys]
+    quote = connection.dialect.identifier_preparer.quote
+    copy_sql = 'COPY {0} ({1}) FROM STDIN'.format(
+        quote(table.name), ', '.join([quote(column_name) for column_name in column_names])
+    )
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(copy_sql, CopyRowStream(mappings, column_names))
+    finally:
+        cursor.close()
+
+
+def format_copy_value(value):
+    """
+    Formats a value for the text format of the PostgreSQL COPY command.
+    """
+    if value is None:
+        return '\\N'
+    elif value is True:
+        return 't'
+    elif value is False:
+        return 'f'
+    elif isinstance(value, float):
+        return repr(value)
+    elif isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    elif isinstance(value, datetime.date):
+        return value.isoformat()
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        return str(value)
+    return value.replace(
+        '\\', '\\\\'
+    ).replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def format_copy_row(mapping, column_names):
+    return '\t'.join([
+        format_copy_value(mapping.get(column_name)) for column_name in column_names
+    ]) + '\n'
+
+
+class CopyRowStream(object):
+    """
+    File-like object passed to cursor.copy_expert, which formats rows as they are read, so the
+    COPY payload is never held in memory as a whole.
+    """
+    def __init__(self, mappings, column_names):
+        self.lines = (format_copy_row(mapping, column_names) for mapping in mappings)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.lines)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
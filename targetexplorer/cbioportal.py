@@ -1,21 +1,34 @@
 import urllib2
 import re
 import os
-import datetime
 import json
 import gzip
+import hashlib
+import datetime
+import itertools
+import collections
+from multiprocessing.pool import ThreadPool
 from lxml import etree
 import numpy as np
 import pandas as pd
 from targetexplorer.core import int_else_none, xml_parser, external_data_dirpath, logger
-from targetexplorer.utils import json_dump_pretty, set_loglevel
+from targetexplorer.core import datestamp_format_string
+from targetexplorer.utils import set_loglevel, json_dump_pretty
 from targetexplorer.oncotator import retrieve_oncotator_mutation_data_as_json, build_oncotator_search_string
+from targetexplorer.oncotator import OncotatorCache, retrieve_oncotator_mutation_data_concurrently
+from targetexplorer.variant_annotation import SNVAnnotator
 from targetexplorer.flaskapp import models, db
+from targetexplorer.bulkload import bulk_insert_mappings
 
 
 external_data_dir = os.path.join(external_data_dirpath, 'cBioPortal')
 external_cbioportal_data_filepath = os.path.join(external_data_dir, 'cbioportal-mutations.xml')
-external_oncotator_data_filepath = os.path.join(external_data_dir, 'oncotator-data.json.gz')
+external_oncotator_data_filepath = os.path.join(external_data_dir, 'oncotator-data.db')
+# Oncotator data was previously stored as a single JSON document; this is imported into the
+# cache the first time it is opened
+legacy_oncotator_data_filepath = os.path.join(external_data_dir, 'oncotator-data.json.gz')
+# Raw responses and metadata for each study, used to avoid downloading unchanged studies
+external_study_data_dir = os.path.join(external_data_dir, 'studies')
 
 ensembl_transcript_id_regex = re.compile('(ENS[A-Z]{0,3}T[0-9]{11})')
 
@@ -25,33 +38,82 @@ class GatherCbioportalData(object):
                  use_existing_cbioportal_data=False,
                  use_existing_oncotator_data=False,
                  write_extended_mutation_txt_files=False,
+                 oncotator_nthreads=8,
+                 cbioportal_nthreads=4,
+                 transcript_gtf_filepath=None,
+                 cds_fasta_filepath=None,
+                 incremental=True,
                  run_main=True,
                  commit_to_db=True
                  ):
+        """
+        Parameters
+        ----------
+        use_existing_cbioportal_data: bool
+        use_existing_oncotator_data: bool
+            Use Oncotator annotations already present in the local cache, and only query the
+            Oncotator server for mutations which are not found
+        write_extended_mutation_txt_files: bool
+        oncotator_nthreads: int
+            Maximum number of concurrent requests to the Oncotator server
+        cbioportal_nthreads: int
+            Maximum number of concurrent requests to the cBioPortal server
+        transcript_gtf_filepath: str
+        cds_fasta_filepath: str
+            If both are given, missense mutations are annotated offline with SNVAnnotator, using
+            the CDS models in the GTF file and the CDS sequences in the FASTA file, instead of
+            querying Oncotator
+        incremental: bool
+            Store the responses for each study (see StudyDataCache), and only download studies
+            which are new or have changed since they were stored. Mutation data for studies
+            which are unchanged since the safe crawl is copied from the safe crawl rather than
+            being extracted again.
+        run_main: bool
+        commit_to_db: bool
+        """
         self.commit_to_db = commit_to_db
         self.use_existing_cbioportal_data = use_existing_cbioportal_data
         self.use_existing_oncotator_data = use_existing_oncotator_data
         self.write_extended_mutation_txt_files = write_extended_mutation_txt_files
-        if os.path.exists(external_oncotator_data_filepath):
-            with gzip.open(external_oncotator_data_filepath) as oncotator_data_file:
-                self.existing_oncotator_data = json.load(oncotator_data_file)
-        else:
-            self.existing_oncotator_data = {}
+        self.oncotator_nthreads = oncotator_nthreads
+        self.cbioportal_nthreads = cbioportal_nthreads
+        self.transcript_gtf_filepath = transcript_gtf_filepath
+        self.cds_fasta_filepath = cds_fasta_filepath
+        self.incremental = incremental
+        self.snv_annotator = None
+        # studies for which mutation data is copied from the safe crawl
+        self.carried_forward_studies = set()
+        # search strings for which Oncotator data has been retrieved during this run
+        self.retrieved_oncotator_search_strings = set()
+        # search strings for which Oncotator retrieval failed during this run; these mutations
+        # are not annotated, and are not requested again
+        self.failed_oncotator_search_strings = set()
 
         if not os.path.exists(external_data_dir):
             os.mkdir(external_data_dir)
 
+        self.oncotator_cache = OncotatorCache(external_oncotator_data_filepath)
+        if len(self.oncotator_cache) == 0 and os.path.exists(legacy_oncotator_data_filepath):
+            logger.info('Importing Oncotator data from {0}'.format(legacy_oncotator_data_filepath))
+            self.oncotator_cache.import_json_file(legacy_oncotator_data_filepath)
+
         self.now = datetime.datetime.utcnow()
+        db.use_sqlite_profile('gather')
 
         crawldata_row = models.CrawlData.query.first()
         self.current_crawl_number = crawldata_row.current_crawl_number
+        self.safe_crawl_number = crawldata_row.safe_crawl_number
         print('Current crawl number: {0}'.format(self.current_crawl_number))
 
         if run_main:
             self.get_hgnc_gene_symbols_from_db()
             self.get_mutation_data_as_xml()
+            self.carry_forward_unchanged_studies()
+            if self.transcript_gtf_filepath and self.cds_fasta_filepath:
+                self.setup_snv_annotator()
+            else:
+                self.retrieve_oncotator_data()
             self.extract_mutation_data()
-            self.write_oncotator_data()
             self.finish()
 
     def get_hgnc_gene_symbols_from_db(self):
@@ -75,38 +137,133 @@ class GatherCbioportalData(object):
         else:
             print 'Retrieving new cBioPortal data file from server...'
             self.cancer_studies = get_cancer_studies()
+            study_data_cache = None
+            if self.incremental:
+                study_data_cache = StudyDataCache(external_study_data_dir)
             retrieve_mutants_xml(
                 external_cbioportal_data_filepath,
                 self.cancer_studies,
                 self.hgnc_gene_symbols,
                 write_extended_mutation_txt_files=self.write_extended_mutation_txt_files,
+                # a partial file left by an interrupted retrieval counts as existing data
+                resume=self.use_existing_cbioportal_data,
+                nthreads=self.cbioportal_nthreads,
+                study_data_cache=study_data_cache,
+                crawl_number=self.current_crawl_number,
             )
+            if self.incremental and self.safe_crawl_number is not None and self.safe_crawl_number >= 0:
+                self.carried_forward_studies = set(
+                    study_data_cache.get_studies_unchanged_since(
+                        self.safe_crawl_number, self.cancer_studies
+                    )
+                )
 
         # import shutil
         # shutil.copy(external_data_filepath, '/Users/partond/tmp')
 
         self.xmltree = etree.parse(external_cbioportal_data_filepath, xml_parser).getroot()
 
+    def setup_snv_annotator(self):
+        # Only transcripts corresponding to canonical UniProt isoforms are used by
+        # extract_mutation_data, so there is no need to load any others
+        canonical_transcript_ids = [
+            value_tuple[0] for value_tuple
+            in models.EnsemblTranscript.query.join(models.UniProtIsoform).filter(
+                models.EnsemblTranscript.crawl_number == self.current_crawl_number,
+                models.UniProtIsoform.is_canonical == True,
+            ).values(models.EnsemblTranscript.transcript_id)
+        ]
+        logger.info('Loading transcript models from {0} and {1}...'.format(
+            self.transcript_gtf_filepath, self.cds_fasta_filepath
+        ))
+        self.snv_annotator = SNVAnnotator(
+            self.transcript_gtf_filepath,
+            self.cds_fasta_filepath,
+            transcript_ids=canonical_transcript_ids,
+        )
+
+    def retrieve_oncotator_data(self):
+        """
+        Collect the Oncotator search strings for all missense mutations in the cBioPortal data
+        which cannot be resolved from the local cache, then retrieve them concurrently and store
+        them in the cache before the mutation data is extracted.
+        """
+        search_strings = set()
+        for mutation_node in self.xmltree.findall('.//gene/case/mutation'):
+            if mutation_node.get('mutation_type') != 'Missense_Mutation':
+                continue
+            if mutation_node.getparent().get('study') in self.carried_forward_studies:
+                continue
+            chromosome_index = int_else_none(mutation_node.get('chromosome_index'))
+            chromosome_startpos = int_else_none(mutation_node.get('chromosome_startpos'))
+            chromosome_endpos = int_else_none(mutation_node.get('chromosome_endpos'))
+            if None in [chromosome_index, chromosome_startpos, chromosome_endpos]:
+                continue
+            search_strings.add(build_oncotator_search_string(
+                chromosome_index,
+                chromosome_startpos,
+                chromosome_endpos,
+                mutation_node.get('reference_allele'),
+                mutation_node.get('variant_allele')
+            ))
+
+        if self.use_existing_oncotator_data:
+            search_strings = [
+                search_string for search_string in search_strings
+                if search_string not in self.oncotator_cache
+            ]
+        if len(search_strings) == 0:
+            return
+
+        logger.info('Retrieving Oncotator data for {0} mutations...'.format(len(search_strings)))
+        nfailed = 0
+        for search_string, oncotator_data in retrieve_oncotator_mutation_data_concurrently(
+                search_strings, nthreads=self.oncotator_nthreads
+                ):
+            if oncotator_data is None:
+                nfailed += 1
+                self.failed_oncotator_search_strings.add(search_string)
+                continue
+            self.oncotator_cache[search_string] = oncotator_data
+            self.retrieved_oncotator_search_strings.add(search_string)
+        if nfailed > 0:
+            logger.info(
+                'Oncotator data could not be retrieved for {0} mutations.'.format(nfailed)
+            )
+
     def extract_mutation_data(self):
-        # for gene_node in self.xmltree.findall('gene'):
-        #     cases = gene_node.findall('mutant')
-        case_nodes = self.xmltree.findall('gene/case')
-        case_rows_by_case_id = {}
+        # Documents written by earlier versions do not have study nodes, so search for
+        # gene/case nodes at any depth
+        case_nodes = self.xmltree.findall('.//gene/case')
+        # num_in_cohort is only set for cases whose mutations were found in the "Mutation"
+        # format data, but is the same for all cases in a study
+        num_in_cohort_by_study = {}
+        for case_node in case_nodes:
+            if case_node.get('num_in_cohort') is not None:
+                num_in_cohort_by_study[case_node.get('study')] = int(case_node.get('num_in_cohort'))
+        # Case IDs are only unique within a study
+        case_rows_by_study_and_case_id = {}
+        nmutations_by_study = {}
         for case_node in case_nodes:
+            study = case_node.get('study')
+            if study in self.carried_forward_studies:
+                continue
             case_id = case_node.get('case_id')
-            print('Extracting mutation data for case {0}'.format(case_id))
-            if case_id not in case_rows_by_case_id:
+            logger.debug('Extracting mutation data for case {0}'.format(case_id))
+            if (study, case_id) not in case_rows_by_study_and_case_id:
                 case_row = models.CbioportalCase(
                     crawl_number=self.current_crawl_number,
-                    study=case_node.get('study'),
+                    study=study,
                     case_id=case_id,
+                    num_in_cohort=num_in_cohort_by_study.get(study),
                 )
                 db.session.add(case_row)
-                case_rows_by_case_id[case_id] = case_row
+                case_rows_by_study_and_case_id[(study, case_id)] = case_row
             else:
-                case_row = case_rows_by_case_id[case_id]
+                case_row = case_rows_by_study_and_case_id[(study, case_id)]
 
             mutation_nodes = case_node.findall('mutation')
+            nmutations_by_study[study] = nmutations_by_study.get(study, 0) + len(mutation_nodes)
             for mutation_node in mutation_nodes:
                 mutation_type = mutation_node.get('mutation_type')
                 chromosome_index = int_else_none(mutation_node.get('chromosome_index'))
@@ -168,6 +325,116 @@ class GatherCbioportalData(object):
 
                 db.session.add(mutation_row)
 
+        ncases_by_study = {}
+        for study, case_id in case_rows_by_study_and_case_id:
+            ncases_by_study[study] = ncases_by_study.get(study, 0) + 1
+        for study in sorted(ncases_by_study):
+            logger.info('Extracted mutation data for study {0}: {1} cases, {2} mutations'.format(
+                study, ncases_by_study[study], nmutations_by_study[study]
+            ))
+
+    def carry_forward_unchanged_studies(self):
+        """
+        Copy the case and mutation rows for unchanged studies from the safe crawl to the current
+        crawl, using set-based INSERT ... SELECT statements. Only the data taken from cBioPortal
+        and Oncotator is copied; the links to DBEntry and UniProtDomain rows are then
+        recalculated against the current crawl, in the same way as in extract_mutation_data.
+        """
+        if len(self.carried_forward_studies) == 0:
+            return
+        studies = sorted(self.carried_forward_studies)
+        print 'Copying mutation data for {0} unchanged studies from crawl {1}...'.format(
+            len(studies), self.safe_crawl_number
+        )
+        cases_table = models.CbioportalCase.__table__
+        mutations_table = models.CbioportalMutation.__table__
+        old_cases = cases_table.alias('old_cases')
+        new_cases = cases_table.alias('new_cases')
+
+        db.session.execute(cases_table.insert().from_select(
+            ['crawl_number', 'study', 'case_id', 'num_in_cohort'],
+            db.select([
+                db.literal(self.current_crawl_number),
+                old_cases.c.study,
+                old_cases.c.case_id,
+                old_cases.c.num_in_cohort,
+            ]).where(db.and_(
+                old_cases.c.crawl_number == self.safe_crawl_number,
+                old_cases.c.study.in_(studies),
+            ))
+        ))
+
+        max_mutation_id = db.session.query(
+            db.func.max(models.CbioportalMutation.id)
+        ).scalar() or 0
+        copied_column_names = [
+            'type', 'cbioportal_aa_change_string', 'mutation_origin', 'validation_status',
+            'functional_impact_score', 'chromosome_index', 'chromosome_startpos',
+            'chromosome_endpos', 'reference_dna_allele', 'variant_dna_allele',
+            'oncotator_aa_pos', 'oncotator_reference_aa', 'oncotator_variant_aa',
+            'oncotator_ensembl_transcript_id',
+        ]
+        old_mutations = mutations_table.alias('old_mutations')
+        db.session.execute(mutations_table.insert().from_select(
+            ['crawl_number', 'cbioportal_case_id', 'in_uniprot_domain'] + copied_column_names,
+            db.select(
+                [
+                    db.literal(self.current_crawl_number),
+                    new_cases.c.id,
+                    db.literal(False),
+                ] + [old_mutations.c[column_name] for column_name in copied_column_names]
+            ).select_from(
+                old_mutations.join(
+                    old_cases, old_mutations.c.cbioportal_case_id == old_cases.c.id
+                ).join(
+                    new_cases, db.and_(
+                        new_cases.c.crawl_number == self.current_crawl_number,
+                        new_cases.c.study == old_cases.c.study,
+                        new_cases.c.case_id == old_cases.c.case_id,
+                    )
+                )
+            ).where(db.and_(
+                old_cases.c.crawl_number == self.safe_crawl_number,
+                old_cases.c.study.in_(studies),
+            ))
+        ))
+
+        copied_mutations = db.and_(
+            mutations_table.c.crawl_number == self.current_crawl_number,
+            mutations_table.c.id > max_mutation_id,
+        )
+        transcripts_table = models.EnsemblTranscript.__table__
+        isoforms_table = models.UniProtIsoform.__table__
+        genes_table = models.EnsemblGene.__table__
+        domains_table = models.UniProtDomain.__table__
+        db.session.execute(mutations_table.update().where(copied_mutations).values(
+            db_entry_id=db.select([genes_table.c.db_entry_id]).select_from(
+                transcripts_table.join(
+                    isoforms_table, transcripts_table.c.uniprot_isoform_id == isoforms_table.c.id
+                ).join(
+                    genes_table, transcripts_table.c.ensembl_gene_id == genes_table.c.id
+                )
+            ).where(db.and_(
+                transcripts_table.c.crawl_number == self.current_crawl_number,
+                transcripts_table.c.transcript_id == mutations_table.c.oncotator_ensembl_transcript_id,
+                isoforms_table.c.is_canonical == True,
+            )).limit(1).as_scalar()
+        ))
+        # the last matching domain is used, as in extract_mutation_data
+        db.session.execute(mutations_table.update().where(copied_mutations).values(
+            uniprot_domain_id=db.select([domains_table.c.id]).where(db.and_(
+                domains_table.c.db_entry_id == mutations_table.c.db_entry_id,
+                domains_table.c.begin <= mutations_table.c.oncotator_aa_pos,
+                domains_table.c.end >= mutations_table.c.oncotator_aa_pos,
+                mutations_table.c.oncotator_reference_aa == db.func.substr(
+                    mutations_table.c.cbioportal_aa_change_string, 1, 1
+                ),
+            )).order_by(domains_table.c.id.desc()).limit(1).as_scalar()
+        ))
+        db.session.execute(mutations_table.update().where(db.and_(
+            copied_mutations, mutations_table.c.uniprot_domain_id != None
+        )).values(in_uniprot_domain=True))
+
     def get_oncotator_data(
             self,
             chromosome_index,
@@ -176,6 +443,15 @@ class GatherCbioportalData(object):
             reference_allele,
             variant_allele
             ):
+        if self.snv_annotator is not None:
+            return self.snv_annotator.annotate_snv(
+                chromosome_index,
+                chromosome_startpos,
+                chromosome_endpos,
+                reference_allele,
+                variant_allele
+            )
+
         oncotator_search_string = build_oncotator_search_string(
             chromosome_index,
             chromosome_startpos,
@@ -184,20 +460,31 @@ class GatherCbioportalData(object):
             variant_allele
         )
 
+        if oncotator_search_string in self.failed_oncotator_search_strings:
+            return None
+        oncotator_data = None
         if (
-                self.use_existing_oncotator_data and self.existing_oncotator_data
-                and oncotator_search_string in self.existing_oncotator_data
+                self.use_existing_oncotator_data
+                or oncotator_search_string in self.retrieved_oncotator_search_strings
                 ):
-                oncotator_data = self.existing_oncotator_data[oncotator_search_string]
-        else:
-            oncotator_data = retrieve_oncotator_mutation_data_as_json(
-                chromosome_index,
-                chromosome_startpos,
-                chromosome_endpos,
-                reference_allele,
-                variant_allele
-            )
-            self.existing_oncotator_data[oncotator_search_string] = oncotator_data
+            oncotator_data = self.oncotator_cache.get(oncotator_search_string)
+        if oncotator_data is None:
+            try:
+                oncotator_data = retrieve_oncotator_mutation_data_as_json(
+                    chromosome_index,
+                    chromosome_startpos,
+                    chromosome_endpos,
+                    reference_allele,
+                    variant_allele
+                )
+            except Exception as e:
+                logger.warning(
+                    'Oncotator retrieval failed for {0}: {1}'.format(oncotator_search_string, e)
+                )
+                self.failed_oncotator_search_strings.add(oncotator_search_string)
+                return None
+            self.oncotator_cache[oncotator_search_string] = oncotator_data
+            self.retrieved_oncotator_search_strings.add(oncotator_search_string)
 
         oncotator_ensembl_transcript_id = oncotator_data.get('transcript_id')
         if oncotator_ensembl_transcript_id is None:
@@ -228,11 +515,8 @@ class GatherCbioportalData(object):
             'variant_aa': variant_aa
         }
 
-    def write_oncotator_data(self):
-        with gzip.open(external_oncotator_data_filepath, 'w') as external_oncotator_data_file:
-            json_dump_pretty(self.existing_oncotator_data, external_oncotator_data_file)
-
     def finish(self):
+        self.oncotator_cache.close()
         # update db datestamps
         datestamp_row = models.DateStamps.query.filter_by(crawl_number=self.current_crawl_number).first()
         datestamp_row.cbioportal_datestamp = self.now
@@ -309,6 +593,10 @@ def get_profile_data(case_set_id, genetic_profile_id, entrez_gene_ids):
 
 def retrieve_mutants_xml(output_xml_filepath, cancer_studies, gene_ids,
                          write_extended_mutation_txt_files=False,
+                         resume=False,
+                         nthreads=4,
+                         study_data_cache=None,
+                         crawl_number=None,
                          verbose=False
                          ):
     """
@@ -319,225 +607,561 @@ def retrieve_mutants_xml(output_xml_filepath, cancer_studies, gene_ids,
     Schema for returned XML:
 
     <CBPmuts>
-      <gene gene_symbol= >
-        <mutant source= study= case_id= >
-          <mutation mutation_type= aa_change= ... >
+      <study study_id= >
+        <gene gene_symbol= >
+          <case source= study= case_id= >
+            <mutation mutation_type= aa_change= ... >
 
+    The document is written incrementally, one study at a time, so only a single study is held
+    in memory. While it is being written, the document is stored at
+    output_xml_filepath + '.partial', and the IDs of the studies written so far are appended to
+    output_xml_filepath + '.partial.studies'. Both are replaced by output_xml_filepath once all
+    studies have been retrieved.
+
+    Parameters
+    ----------
+    output_xml_filepath: str
+    cancer_studies: list of str
+    gene_ids: list of str
+    write_extended_mutation_txt_files: bool
+    resume: bool
+        If a partial document is found from a previous interrupted run, keep the studies which
+        were completely written to it, and only retrieve the remaining studies.
+    nthreads: int
+        maximum number of concurrent requests to cBioPortal for each study
+    study_data_cache: StudyDataCache or None
+        If given, studies which are unchanged since they were stored are not downloaded again
+    crawl_number: int
+        Recorded in the StudyDataCache metadata for newly downloaded studies
+    verbose: bool
     """
+    partial_xml_filepath = output_xml_filepath + '.partial'
+    completed_studies_filepath = partial_xml_filepath + '.studies'
+    resume_xml_filepath = partial_xml_filepath + '.resume'
+    new_completed_studies_filepath = completed_studies_filepath + '.new'
+
+    # The completed studies are copied from the previous partial document (moved to
+    # resume_xml_filepath) into the new one. completed_studies_filepath is only replaced once the
+    # copy has been written, so an interrupted resume can itself be resumed from
+    # resume_xml_filepath.
+    completed_studies = []
+    if resume and os.path.exists(completed_studies_filepath) and (
+            os.path.exists(resume_xml_filepath) or os.path.exists(partial_xml_filepath)):
+        with open(completed_studies_filepath) as completed_studies_file:
+            completed_studies = [line.strip() for line in completed_studies_file if line.strip() != '']
+        if not os.path.exists(resume_xml_filepath):
+            os.rename(partial_xml_filepath, resume_xml_filepath)
+        logger.info('Resuming retrieval of cBioPortal data; {0} studies already retrieved'.format(
+            len(completed_studies)
+        ))
+
+    with open(partial_xml_filepath, 'w') as partial_xml_file, \
+            open(new_completed_studies_filepath, 'w') as completed_studies_file:
+        with etree.xmlfile(partial_xml_file, encoding='utf-8') as xmlfile:
+            with xmlfile.element('CBPmuts'):
+                xmlfile.write('\n')
+
+                if len(completed_studies) > 0:
+                    for study_node in iter_completed_study_nodes(resume_xml_filepath, completed_studies):
+                        xmlfile.write(study_node, pretty_print=True)
+                    xmlfile.flush()
+                    partial_xml_file.flush()
+                    for cancer_study in completed_studies:
+                        completed_studies_file.write(cancer_study + '\n')
+                    completed_studies_file.flush()
+                # the open file is renamed, so studies retrieved below are recorded in it
+                os.rename(new_completed_studies_filepath, completed_studies_filepath)
+                if os.path.exists(resume_xml_filepath):
+                    os.remove(resume_xml_filepath)
+
+                for cancer_study in cancer_studies:
+                    if cancer_study in completed_studies:
+                        continue
+                    study_node = build_study_mutants_xml(
+                        cancer_study,
+                        gene_ids,
+                        write_extended_mutation_txt_files=write_extended_mutation_txt_files,
+                        nthreads=nthreads,
+                        study_data_cache=study_data_cache,
+                        crawl_number=crawl_number,
+                        verbose=verbose,
+                    )
+                    if study_node is not None:
+                        xmlfile.write(study_node, pretty_print=True)
+                        xmlfile.flush()
+                        partial_xml_file.flush()
+                    # Only record the study once it has been fully written
+                    completed_studies_file.write(cancer_study + '\n')
+                    completed_studies_file.flush()
 
-    # XML root node
-    results_node = etree.Element('CBPmuts')
+    os.rename(partial_xml_filepath, output_xml_filepath)
+    os.remove(completed_studies_filepath)
 
-    # Use this dict to reference gene nodes by gene_id (may be quicker than using results_node.find())
-    gene_nodes_dict = {}
-    for gene_id in gene_ids:
-        gene_node = etree.SubElement(results_node, 'gene')
-        gene_node.set('gene_symbol', gene_id)
-        gene_nodes_dict[gene_id] = gene_node
 
-    # For each cancer_study
-    for cancer_study in cancer_studies:
+def iter_completed_study_nodes(partial_xml_filepath, completed_studies):
+    """
+    Yields the study nodes for the given studies from a partial document written by
+    retrieve_mutants_xml. The document will usually be truncated, so it is parsed in recover
+    mode; the last study node may therefore be incomplete, which is why only studies recorded
+    as completed are returned. Each node is cleared once the next node has been parsed.
+    """
+    completed_studies = set(completed_studies)
+    for event, study_node in etree.iterparse(
+            partial_xml_filepath, events=('end',), tag='study', recover=True, huge_tree=True
+            ):
+        if study_node.get('study_id') in completed_studies:
+            study_node.tail = None
+            yield study_node
+        study_node.clear()
+        while study_node.getprevious() is not None:
+            del study_node.getparent()[0]
 
-        # ==============
-        # First get "ExtendedMutation" data
-        # --------------
-        case_set_id = cancer_study + '_sequenced'
-        genetic_profile_id = cancer_study + '_mutations'
-        print 'Retrieving ExtendedMutation data from cBioPortal for study %s...' % cancer_study
 
-        if write_extended_mutation_txt_files:
-            txt_output_filepath = os.path.join(external_data_dir, cancer_study+'.txt')
-        else:
-            txt_output_filepath = False
+def build_study_mutants_xml(cancer_study, gene_ids, write_extended_mutation_txt_files=False,
+                            nthreads=4, study_data_cache=None, crawl_number=None, verbose=False):
+    """
+    Downloads mutation data for a single cBioPortal cancer study, and returns it as a study
+    node (see retrieve_mutants_xml for the schema), or None if no sequencing data is available
+    for the study.
+
+    If a StudyDataCache is given, the stored responses are used if the study is unchanged
+    (see get_study_fingerprint); otherwise the responses are downloaded and stored, together
+    with crawl_number.
+    """
+    study_node = etree.Element('study')
+    study_node.set('study_id', cancer_study)
 
-        lines = retrieve_extended_mutation_datatxt(
-            case_set_id,
-            genetic_profile_id,
+    # Gene and case nodes are created as mutations are found for them
+    gene_nodes_dict = {}
+    case_nodes_by_gene_id_and_case_id = {}
+
+    study_datatxt = None
+    fingerprint = None
+    if study_data_cache is not None:
+        fingerprint, ncases = get_study_fingerprint(cancer_study, gene_ids)
+        study_datatxt = study_data_cache.get(cancer_study, fingerprint)
+        if study_datatxt is not None:
+            print 'Using stored cBioPortal data for unchanged study %s' % cancer_study
+    if study_datatxt is None:
+        study_datatxt = retrieve_study_datatxt(
+            cancer_study,
             gene_ids,
-            write_to_filepath=txt_output_filepath,
+            write_extended_mutation_txt_files=write_extended_mutation_txt_files,
+            nthreads=nthreads,
         )
-        if lines == ['Error: Problem when identifying a cancer study for the request.']:
-            print 'WARNING: case_set_id "%s" not available - probably means that sequencing data from the underlying cancer study is not yet available. Skipping this case set.' % case_set_id
-            continue
-        if lines[0][0:25] == '# Warning:  Unknown gene:':
-            print lines[0]
-            raise Exception
-        print 'Done retrieving ExtendedMutation data from cBioPortal.'
-
-        # These dicts will be used later to assign percent_in_cohort values for a given mutation by matching case_id and aa_change
-        mutant_nodes_by_case_id = {}
-        mutation_nodes_by_case_id_and_aa_change = {}
-
-        # First line is a header
-        # Second line describes the tab-separated data columns:
-        # entrez_gene_id  gene_symbol case_id sequencing_center   mutation_status mutation_type   validation_status   amino_acid_change   functional_impact_score xvar_link   xvar_link_pdb   xvar_link_msa   chr start_position  end_position    reference_allele    variant_allele  genetic_profile_id
-        # From third line onwards, each line is associated with a single mutant, e.g.:
-        # 1956  EGFR    TCGA-16-1048    broad.mit.edu   Somatic Missense_Mutation   NA  F254I   M   [getma.org/...snip]   [getma.org/...snip] [getma.org/...snip] 7   55221716    55221716    T   A   gbm_tcga_mutations
-        # EXCEPT for dual mutations of consecutive aas, e.g.:
-        # 51231 VRK3    TCGA-AA-A01V    broad.mit.edu   Somatic Missense_Mutation   Unknown 324_325LA>FS    NA  NA  NA  NA  19  50493019    50493020    CC  AA  coadread_tcga_pub_mutations
-        for line in lines[2:]:
-            words = line.split('\t')
-            returned_gene_id = words[1]
-            case_id = words[2]
-            mutation_status = words[4] # 'Somatic', ?'Germline'
-            mutation_type = words[5] # 'Missense_Mutation', ...
-            validation_status = words[6] # 'NA', ???
-            aa_changes = [ words[7] ] # 'F254I', '324_325LA>FS'
-            functional_impact_score = words[8]
-            chromosome_index = words[12]
-            chromosome_startpos = words[13]
-            chromosome_endpos = words[14]
-            reference_allele = words[15]
-            variant_allele = words[16]
-            #returned_cancer_study = words[-1][ 0 : words[-1].rfind('_mutations') ]
-
-            # _______________
-            # Some exceptions
-            # ---------------
-
-            if aa_changes[0] == 'MUTATED':
-                aa_changes[0] = 'Unknown'
-
-            # Dual mutations of consecutive aas
-            if mutation_type == 'Missense_Mutation' and match_dual_consecutive_aa_change(aa_changes[0]):
-                aa_changes = split_dual_consecutive_aa_change(aa_changes[0])
-
-            if returned_gene_id == 'C9ORF96':
-                returned_gene_id = 'C9orf96'
-
-            # _______________
-
-            for aa_change in aa_changes:
-                # Look for a mutant node (corresponding to this study and case_id). This will only exist if a mutation has already been added for this mutant.
-                case_node = gene_nodes_dict[returned_gene_id].find('case[@study="%s"][@case_id="%s"]' % (cancer_study, case_id))
-                # If not found, create it.
-                if case_node == None:
-                    case_node = etree.SubElement(gene_nodes_dict[returned_gene_id], 'case')
-                    case_node.set('source', 'cBioPortal')
-                    case_node.set('study', cancer_study)
-                    case_node.set('case_id', case_id)
-                    mutant_nodes_by_case_id[case_id] = case_node
-
-                # Each mutation gets a mutation_mode
-                mutation_node = etree.SubElement(case_node, 'mutation')
-                mutation_node.set('mutation_origin', mutation_status)
-                mutation_node.set('mutation_type', mutation_type)
-                mutation_node.set('validation_status', validation_status)
-                mutation_node.set('aa_change', aa_change)
-                mutation_node.set('functional_impact_score', functional_impact_score)
-                mutation_node.set('chromosome_index', chromosome_index)
-                mutation_node.set('chromosome_startpos', chromosome_startpos)
-                mutation_node.set('chromosome_endpos', chromosome_endpos)
-                mutation_node.set('reference_allele', reference_allele)
-                mutation_node.set('variant_allele', variant_allele)
-
-                # This dict is used later to assign percent_in_cohort values to mutations by matching case_id and aa_change
-                mutation_nodes_by_case_id_and_aa_change[case_id + aa_change] = mutation_node
-
-        # ============
-
-        # ============
-        # Now get the non-extended "Mutation" format data - this includes non-mutated samples, thus allowing calculation of percent_in_cohort values
-        # ------------
-
-        print 'Retrieving Mutation data from cBioPortal for study %s...' % cancer_study
-        lines = retrieve_mutation_datatxt(case_set_id, genetic_profile_id, gene_ids)
-        print 'Done retrieving Mutation data from cBioPortal.'
-
-        # First two lines are header info
-        # Third line contains the case_ids, tab-separated
-        case_ids_returned = lines[2].split('\t')[2:]
-
-        num_in_cohort = len(case_ids_returned)
-
-        # Fourth line onwards: first column is Entrez Gene ID, second is gene_id, third onwards are the aa_change strings (in order of case_ids from the third line)
-        # 1956    EGFR    NaN NaN C620Y ...
-        # Multiple mutations for a given case are split by ',', except for dual consecutive mutations which are annotated in the form '324_325LA>FS'
-        for line in lines[3:]:
-            words = line.split('\t')
-            returned_gene_id = words[1]
-            aa_change_strings = words[2:]
-
-            if verbose:
-                print returned_gene_id
-
-            # Make a flat list of aa changes (with multiple-mutation aa_changes split into separate elements)
-            all_aa_changes_this_cohort = []
-            # Also require a list of case_ids for each individual aa_change
-            case_ids_returned_by_aa_change = []
-            for a, aa_change_string in enumerate(aa_change_strings):
-                aa_changes_split_comma = aa_change_string.split(',') # May result in ['R23K', '56_57EG>AH']
-                aa_changes = []
-                for b in range(len(aa_changes_split_comma)):
-                    if match_dual_consecutive_aa_change(aa_changes_split_comma[b]):
-                        aa_changes += split_dual_consecutive_aa_change(aa_changes_split_comma[b])
-                    else:
-                        aa_changes.append( aa_changes_split_comma[b] )
-
-                all_aa_changes_this_cohort += aa_changes
-                case_ids_returned_by_aa_change += ( [case_ids_returned[a]] * len(aa_changes) )
-
-            # Number of aas with any aa_change for this gene and cancer study
-            num_in_cohort_any_aa_change = sum( [ 1 for x in aa_change_strings if x != 'NaN' ] )
-            percent_in_cohort_any_aa_change = float(num_in_cohort_any_aa_change) / num_in_cohort * 100.
-
-            for a, aa_change in enumerate(all_aa_changes_this_cohort):
-                if aa_change not in ['NaN', 'MUTATED']:
-                    num_in_cohort_this_aa_change = sum( [ 1 for x in all_aa_changes_this_cohort if x == aa_change ] )
-                    # Calculate percent_in_cohort
-                    percent_in_cohort_this_aa_change = float(num_in_cohort_this_aa_change) / num_in_cohort * 100.
-                    mutation_nodes_by_case_id_and_aa_change[ case_ids_returned_by_aa_change[a] + aa_change ].set('percent_in_cohort_this_aa_change', '%.3f' % percent_in_cohort_this_aa_change)
-                    mutation_nodes_by_case_id_and_aa_change[ case_ids_returned_by_aa_change[a] + aa_change ].getparent().set('percent_in_cohort_any_aa_change', '%.3f' % percent_in_cohort_any_aa_change)
-                    mutation_nodes_by_case_id_and_aa_change[ case_ids_returned_by_aa_change[a] + aa_change ].getparent().set('num_in_cohort', str(num_in_cohort))
-
-        # ============
-
-    # ===========
-    # Write XML to file
-    # -----------
-
-    with open(output_xml_filepath, 'w') as output_xml_file:
-        output_xml_file.write(etree.tostring(results_node, pretty_print=True))
-
-    # ===========
+        if study_datatxt is None:
+            return None
+        if fingerprint is not None:
+            # the responses are stored as they are parsed below
+            study_datatxt = study_data_cache.iter_storing(
+                cancer_study, fingerprint, ncases, crawl_number, *study_datatxt
+            )
+    extended_mutation_lines, mutation_lines = study_datatxt
+
+    # ==============
+    # First parse "ExtendedMutation" data
+    # --------------
+    lines = iter(extended_mutation_lines)
+
+    # This dict will be used later to assign percent_in_cohort values for a given mutation by matching case_id and aa_change
+    mutation_nodes_by_case_id_and_aa_change = {}
+
+    # First line is a header
+    # Second line describes the tab-separated data columns:
+    # entrez_gene_id  gene_symbol case_id sequencing_center   mutation_status mutation_type   validation_status   amino_acid_change   functional_impact_score xvar_link   xvar_link_pdb   xvar_link_msa   chr start_position  end_position    reference_allele    variant_allele  genetic_profile_id
+    # From third line onwards, each line is associated with a single mutant, e.g.:
+    # 1956  EGFR    TCGA-16-1048    broad.mit.edu   Somatic Missense_Mutation   NA  F254I   M   [getma.org/...snip]   [getma.org/...snip] [getma.org/...snip] 7   55221716    55221716    T   A   gbm_tcga_mutations
+    # EXCEPT for dual mutations of consecutive aas, e.g.:
+    # 51231 VRK3    TCGA-AA-A01V    broad.mit.edu   Somatic Missense_Mutation   Unknown 324_325LA>FS    NA  NA  NA  NA  19  50493019    50493020    CC  AA  coadread_tcga_pub_mutations
+    for line in itertools.islice(lines, 2, None):
+        words = line.split('\t')
+        returned_gene_id = words[1]
+        case_id = words[2]
+        mutation_status = words[4] # 'Somatic', ?'Germline'
+        mutation_type = words[5] # 'Missense_Mutation', ...
+        validation_status = words[6] # 'NA', ???
+        aa_changes = [ words[7] ] # 'F254I', '324_325LA>FS'
+        functional_impact_score = words[8]
+        chromosome_index = words[12]
+        chromosome_startpos = words[13]
+        chromosome_endpos = words[14]
+        reference_allele = words[15]
+        variant_allele = words[16]
+        #returned_cancer_study = words[-1][ 0 : words[-1].rfind('_mutations') ]
+
+        # _______________
+        # Some exceptions
+        # ---------------
+
+        if aa_changes[0] == 'MUTATED':
+            aa_changes[0] = 'Unknown'
+
+        # Dual mutations of consecutive aas
+        if mutation_type == 'Missense_Mutation' and match_dual_consecutive_aa_change(aa_changes[0]):
+            aa_changes = split_dual_consecutive_aa_change(aa_changes[0])
+
+        if returned_gene_id == 'C9ORF96':
+            returned_gene_id = 'C9orf96'
+
+        # _______________
+
+        for aa_change in aa_changes:
+            gene_node = gene_nodes_dict.get(returned_gene_id)
+            if gene_node is None:
+                gene_node = etree.SubElement(study_node, 'gene')
+                gene_node.set('gene_symbol', returned_gene_id)
+                gene_nodes_dict[returned_gene_id] = gene_node
+
+            # Look for a case node (corresponding to this gene and case_id). This will only exist if a mutation has already been added for this case.
+            case_node = case_nodes_by_gene_id_and_case_id.get((returned_gene_id, case_id))
+            # If not found, create it.
+            if case_node is None:
+                case_node = etree.SubElement(gene_node, 'case')
+                case_node.set('source', 'cBioPortal')
+                case_node.set('study', cancer_study)
+                case_node.set('case_id', case_id)
+                case_nodes_by_gene_id_and_case_id[(returned_gene_id, case_id)] = case_node
+
+            # Each mutation gets a mutation_mode
+            mutation_node = etree.SubElement(case_node, 'mutation')
+            mutation_node.set('mutation_origin', mutation_status)
+            mutation_node.set('mutation_type', mutation_type)
+            mutation_node.set('validation_status', validation_status)
+            mutation_node.set('aa_change', aa_change)
+            mutation_node.set('functional_impact_score', functional_impact_score)
+            mutation_node.set('chromosome_index', chromosome_index)
+            mutation_node.set('chromosome_startpos', chromosome_startpos)
+            mutation_node.set('chromosome_endpos', chromosome_endpos)
+            mutation_node.set('reference_allele', reference_allele)
+            mutation_node.set('variant_allele', variant_allele)
+
+            # This dict is used later to assign percent_in_cohort values to mutations by matching case_id and aa_change
+            mutation_nodes_by_case_id_and_aa_change[case_id + aa_change] = mutation_node
+
+    # ============
+
+    # ============
+    # Now parse the non-extended "Mutation" format data - this includes non-mutated samples, thus allowing calculation of percent_in_cohort values
+    # ------------
+
+    lines = iter(mutation_lines)
+
+    # First two lines are header info
+    # Third line contains the case_ids, tab-separated
+    header_lines = list(itertools.islice(lines, 3))
+    case_ids_returned = header_lines[2].split('\t')[2:]
+
+    num_in_cohort = len(case_ids_returned)
+
+    # Fourth line onwards: first column is Entrez Gene ID, second is gene_id, third onwards are the aa_change strings (in order of case_ids from the third line)
+    # 1956    EGFR    NaN NaN C620Y ...
+    # Multiple mutations for a given case are split by ',', except for dual consecutive mutations which are annotated in the form '324_325LA>FS'
+    for line in lines:
+        words = line.split('\t')
+        returned_gene_id = words[1]
+        aa_change_strings = words[2:]
+
+        if verbose:
+            print returned_gene_id
+
+        # Make a flat list of aa changes (with multiple-mutation aa_changes split into separate elements)
+        all_aa_changes_this_cohort = []
+        # Also require a list of case_ids for each individual aa_change
+        case_ids_returned_by_aa_change = []
+        for a, aa_change_string in enumerate(aa_change_strings):
+            aa_changes_split_comma = aa_change_string.split(',') # May result in ['R23K', '56_57EG>AH']
+            aa_changes = []
+            for b in range(len(aa_changes_split_comma)):
+                if match_dual_consecutive_aa_change(aa_changes_split_comma[b]):
+                    aa_changes += split_dual_consecutive_aa_change(aa_changes_split_comma[b])
+                else:
+                    aa_changes.append( aa_changes_split_comma[b] )
+
+            all_aa_changes_this_cohort += aa_changes
+            case_ids_returned_by_aa_change += ( [case_ids_returned[a]] * len(aa_changes) )
+
+        # Number of aas with any aa_change for this gene and cancer study
+        num_in_cohort_any_aa_change = sum( [ 1 for x in aa_change_strings if x != 'NaN' ] )
+        percent_in_cohort_any_aa_change = float(num_in_cohort_any_aa_change) / num_in_cohort * 100.
+
+        for a, aa_change in enumerate(all_aa_changes_this_cohort):
+            if aa_change not in ['NaN', 'MUTATED']:
+                num_in_cohort_this_aa_change = sum( [ 1 for x in all_aa_changes_this_cohort if x == aa_change ] )
+                # Calculate percent_in_cohort
+                percent_in_cohort_this_aa_change = float(num_in_cohort_this_aa_change) / num_in_cohort * 100.
+                mutation_nodes_by_case_id_and_aa_change[ case_ids_returned_by_aa_change[a] + aa_change ].set('percent_in_cohort_this_aa_change', '%.3f' % percent_in_cohort_this_aa_change)
+                mutation_nodes_by_case_id_and_aa_change[ case_ids_returned_by_aa_change[a] + aa_change ].getparent().set('percent_in_cohort_any_aa_change', '%.3f' % percent_in_cohort_any_aa_change)
+                mutation_nodes_by_case_id_and_aa_change[ case_ids_returned_by_aa_change[a] + aa_change ].getparent().set('num_in_cohort', str(num_in_cohort))
+
+    return study_node
+
+
+def retrieve_study_datatxt(cancer_study, gene_ids, write_extended_mutation_txt_files=False,
+                           nthreads=4):
+    """
+    Downloads the "ExtendedMutation" and "Mutation" format data for a single cBioPortal cancer
+    study. Only the first response of the "ExtendedMutation" data is waited for (to check
+    whether data is available); the lines of both data files are otherwise downloaded as they
+    are iterated over (see iter_webservice_lines), so the extended_mutation_lines iterator
+    should be consumed before the mutation_lines iterator.
+
+    Returns
+    -------
+    (extended_mutation_lines, mutation_lines) iterators, or None if no sequencing data is
+    available for the study
+    """
+    case_set_id = cancer_study + '_sequenced'
+    genetic_profile_id = cancer_study + '_mutations'
+    print 'Retrieving ExtendedMutation and Mutation data from cBioPortal for study %s...' % cancer_study
+
+    if write_extended_mutation_txt_files:
+        txt_output_filepath = os.path.join(external_data_dir, cancer_study+'.txt')
+    else:
+        txt_output_filepath = False
+
+    extended_mutation_lines = iter_extended_mutation_datatxt(
+        case_set_id,
+        genetic_profile_id,
+        gene_ids,
+        write_to_filepath=txt_output_filepath,
+        nthreads=nthreads,
+    )
+    first_line = next(extended_mutation_lines, None)
+    if first_line == 'Error: Problem when identifying a cancer study for the request.':
+        print 'WARNING: case_set_id "%s" not available - probably means that sequencing data from the underlying cancer study is not yet available. Skipping this case set.' % case_set_id
+        return None
+    if first_line is not None and first_line[0:25] == '# Warning:  Unknown gene:':
+        print first_line
+        raise Exception
+    if first_line is not None:
+        extended_mutation_lines = itertools.chain([first_line], extended_mutation_lines)
+
+    mutation_lines = iter_mutation_datatxt(
+        case_set_id, genetic_profile_id, gene_ids, nthreads=nthreads
+    )
+    return extended_mutation_lines, mutation_lines
+
+
+def get_study_case_ids(cancer_study, case_list_id=None):
+    """
+    Returns the case IDs in a case list for a cBioPortal cancer study (by default the
+    '_sequenced' case list), or None if the case list is not found.
+    """
+    if case_list_id is None:
+        case_list_id = cancer_study + '_sequenced'
+    case_lists_url = 'http://www.cbioportal.org/public-portal/webservice.do?cmd=getCaseLists&cancer_study_id={0}'.format(cancer_study)
+    response = urllib2.urlopen(case_lists_url)
+    # Columns: case_list_id, case_list_name, case_list_description, cancer_study_id, case_ids
+    for line in response:
+        words = line.rstrip('\r\n').split('\t')
+        if words[0] == case_list_id and len(words) >= 5:
+            return words[4].split()
+    return None
+
+
+def calculate_study_fingerprint(case_ids, gene_ids):
+    sha1 = hashlib.sha1()
+    sha1.update('\n'.join(sorted(case_ids)))
+    sha1.update('\n\n')
+    sha1.update('\n'.join(sorted(gene_ids)))
+    return sha1.hexdigest()
+
+
+def get_study_fingerprint(cancer_study, gene_ids):
+    """
+    Fingerprint used to decide whether a study needs to be downloaded again. cBioPortal does
+    not provide a version for each study, so the fingerprint is calculated from the sequenced
+    case list (which changes whenever cases are added to or removed from the study) and the
+    gene list.
+
+    Returns
+    -------
+    (fingerprint, ncases), or (None, None) if the case list is not available
+    """
+    case_ids = get_study_case_ids(cancer_study)
+    if case_ids is None:
+        return None, None
+    return calculate_study_fingerprint(case_ids, gene_ids), len(case_ids)
+
+
+class StudyDataCache(object):
+    """
+    Stores the raw cBioPortal responses for each study, together with metadata describing the
+    version of the study they were retrieved for:
+
+    {
+        "study": "gbm_tcga",
+        "fingerprint": "...",  # see get_study_fingerprint
+        "ncases": 291,
+        "crawl_number": 3,  # crawl in which data with this fingerprint was first retrieved
+        "datestamp": "2015-06-01 12:00:00"
+    }
+    """
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+
+    def _filepath(self, study, suffix):
+        return os.path.join(self.dirpath, study + suffix)
+
+    def read_metadata(self, study):
+        metadata_filepath = self._filepath(study, '-metadata.json')
+        if not os.path.exists(metadata_filepath):
+            return None
+        with open(metadata_filepath) as metadata_file:
+            return json.load(metadata_file)
+
+    def get(self, study, fingerprint):
+        """
+        Returns (extended_mutation_lines, mutation_lines) if data is stored for the study with
+        the given fingerprint, otherwise None.
+        """
+        if fingerprint is None:
+            return None
+        metadata = self.read_metadata(study)
+        if metadata is None or metadata['fingerprint'] != fingerprint:
+            return None
+        study_datatxt = []
+        for suffix in ['-extended-mutation-data.txt.gz', '-mutation-data.txt.gz']:
+            datatxt_filepath = self._filepath(study, suffix)
+            if not os.path.exists(datatxt_filepath):
+                return None
+            with gzip.open(datatxt_filepath) as datatxt_file:
+                study_datatxt.append(datatxt_file.read().splitlines())
+        return tuple(study_datatxt)
+
+    def store(self, study, fingerprint, ncases, crawl_number, extended_mutation_lines,
+              mutation_lines):
+        for lines in self.iter_storing(study, fingerprint, ncases, crawl_number,
+                                       extended_mutation_lines, mutation_lines):
+            for line in lines:
+                pass
+
+    def iter_storing(self, study, fingerprint, ncases, crawl_number, extended_mutation_lines,
+                     mutation_lines):
+        """
+        Returns (extended_mutation_lines, mutation_lines) iterators which yield the given lines
+        and store them as they are taken, so that streamed responses need not be held in
+        memory. The metadata is only written once both iterators have been exhausted; until
+        then, no data is stored for the study.
+        """
+        metadata = self.read_metadata(study)
+        if metadata is not None and metadata['fingerprint'] == fingerprint:
+            # keep the crawl in which this version of the study was first retrieved
+            crawl_number = metadata['crawl_number']
+        metadata_filepath = self._filepath(study, '-metadata.json')
+        if os.path.exists(metadata_filepath):
+            os.remove(metadata_filepath)
+        nstored = [0]
+
+        def iter_storing_lines(suffix, lines):
+            datatxt_filepath = self._filepath(study, suffix)
+            with gzip.open(datatxt_filepath + '.part', 'w') as datatxt_file:
+                for line in lines:
+                    datatxt_file.write(line + '\n')
+                    yield line
+            os.rename(datatxt_filepath + '.part', datatxt_filepath)
+            nstored[0] += 1
+            if nstored[0] == 2:
+                self._write_metadata(study, fingerprint, ncases, crawl_number)
+
+        return (
+            iter_storing_lines('-extended-mutation-data.txt.gz', extended_mutation_lines),
+            iter_storing_lines('-mutation-data.txt.gz', mutation_lines),
+        )
+
+    def _write_metadata(self, study, fingerprint, ncases, crawl_number):
+        # metadata is written last, so that it only refers to completely written responses
+        with open(self._filepath(study, '-metadata.json'), 'w') as metadata_file:
+            json_dump_pretty({
+                'study': study,
+                'fingerprint': fingerprint,
+                'ncases': ncases,
+                'crawl_number': crawl_number,
+                'datestamp': datetime.datetime.utcnow().strftime(datestamp_format_string),
+            }, metadata_file)
+
+    def get_studies_unchanged_since(self, crawl_number, studies):
+        """
+        Returns those of the given studies for which the stored data was first retrieved in or
+        before the given crawl.
+        """
+        unchanged_studies = []
+        for study in studies:
+            metadata = self.read_metadata(study)
+            if metadata is not None and metadata['crawl_number'] is not None \
+                    and metadata['crawl_number'] <= crawl_number:
+                unchanged_studies.append(study)
+        return unchanged_studies
 
 
 def retrieve_mutation_datatxt(case_set_id,
                               genetic_profile_id,
                               gene_ids,
                               portal_version='public-portal',
+                              nthreads=4,
+                              max_url_length=2000,
+                              max_genes_per_request=100,
                               verbose=False,
                               ):
     """
     Queries cBioPortal for "Mutation" format data, given a list of cBioPortal cancer studies and a list of HGNC Approved gene Symbols.
     Returns the data file as a list of text lines.
+
+    The gene list is split into chunks (see plan_gene_list_chunks), which are requested
+    concurrently, and the responses merged into a single data file.
+
+    Parameters
+    ----------
+    nthreads: int
+        maximum number of concurrent requests
+    max_url_length: int
+    max_genes_per_request: int
+        see plan_gene_list_chunks
     """
-    gene_ids_string = '+'.join(gene_ids)
-    mutation_url = 'http://www.cbioportal.org/{0}/' \
-                   'webservice.do' \
-                   '?cmd=getProfileData' \
-                   '&case_set_id={1}' \
-                   '&genetic_profile_id={2}' \
-                   '&gene_list={3}'.format(
-                       portal_version,
-                       case_set_id,
-                       genetic_profile_id,
-                       gene_ids_string
-                   )
     if verbose:
         set_loglevel('debug')
-        logger.debug(mutation_url)
-    response = urllib2.urlopen(mutation_url)
-    page = response.read(1000000000)
-    lines = page.splitlines()
-    return lines
+    return list(iter_mutation_datatxt(
+        case_set_id,
+        genetic_profile_id,
+        gene_ids,
+        portal_version=portal_version,
+        nthreads=nthreads,
+        max_url_length=max_url_length,
+        max_genes_per_request=max_genes_per_request,
+    ))
+
+
+def iter_mutation_datatxt(case_set_id, genetic_profile_id, gene_ids,
+                          portal_version='public-portal', nthreads=4, max_url_length=2000,
+                          max_genes_per_request=100):
+    """
+    As retrieve_mutation_datatxt, but yields the lines of the data file as the responses for
+    each gene list chunk are received (see iter_webservice_lines). Nothing is requested until
+    the first line is taken.
+    """
+    return iter_webservice_lines(
+        'getProfileData',
+        case_set_id,
+        genetic_profile_id,
+        gene_ids,
+        nheader_lines=3,
+        portal_version=portal_version,
+        nthreads=nthreads,
+        max_url_length=max_url_length,
+        max_genes_per_request=max_genes_per_request,
+    )
 
 
 def retrieve_extended_mutation_datatxt(case_set_id,
                                        genetic_profile_id,
                                        gene_ids,
                                        portal_version='public-portal',
-                                       write_to_filepath=False
+                                       write_to_filepath=False,
+                                       nthreads=4,
+                                       max_url_length=2000,
+                                       max_genes_per_request=100,
                                        ):
     """
     Queries cBioPortal for "ExtendedMutation" format data, given a list of cBioPortal cancer studies and a list of HGNC Approved gene Symbols.
@@ -549,26 +1173,196 @@ def retrieve_extended_mutation_datatxt(case_set_id,
         'public-portal': use only public cBioPortal data
         'private': use private cBioPortal data
     write_to_filepath: str (or False)
+    nthreads: int
+    max_url_length: int
+    max_genes_per_request: int
+        see retrieve_mutation_datatxt
     """
-    gene_ids_string = '+'.join(gene_ids)
-    mutation_url = 'http://www.cbioportal.org/{0}/' \
-                   'webservice.do' \
-                   '?cmd=getMutationData' \
-                   '&case_set_id={1}' \
-                   '&genetic_profile_id={2}' \
-                   '&gene_list={3}'.format(
-                       portal_version,
-                       case_set_id,
-                       genetic_profile_id,
-                       gene_ids_string
-                   )
-    response = urllib2.urlopen(mutation_url)
-    page = response.read(1000000000)
+    return list(iter_extended_mutation_datatxt(
+        case_set_id,
+        genetic_profile_id,
+        gene_ids,
+        portal_version=portal_version,
+        write_to_filepath=write_to_filepath,
+        nthreads=nthreads,
+        max_url_length=max_url_length,
+        max_genes_per_request=max_genes_per_request,
+    ))
+
+
+def iter_extended_mutation_datatxt(case_set_id, genetic_profile_id, gene_ids,
+                                   portal_version='public-portal', write_to_filepath=False,
+                                   nthreads=4, max_url_length=2000, max_genes_per_request=100):
+    """
+    As retrieve_extended_mutation_datatxt, but yields the lines of the data file as the
+    responses for each gene list chunk are received (see iter_webservice_lines). If
+    write_to_filepath is given, each line is written to the file as it is yielded.
+    """
+    lines_iter = iter_webservice_lines(
+        'getMutationData',
+        case_set_id,
+        genetic_profile_id,
+        gene_ids,
+        nheader_lines=2,
+        portal_version=portal_version,
+        nthreads=nthreads,
+        max_url_length=max_url_length,
+        max_genes_per_request=max_genes_per_request,
+    )
     if write_to_filepath:
         with open(write_to_filepath, 'w') as ofile:
-            ofile.write(page)
-    lines = page.splitlines()
-    return lines
+            for line in lines_iter:
+                ofile.write(line + '\n')
+                yield line
+    else:
+        for line in lines_iter:
+            yield line
+
+
+def build_webservice_url(cmd, case_set_id, genetic_profile_id, gene_ids,
+                         portal_version='public-portal'):
+    return 'http://www.cbioportal.org/{0}/' \
+           'webservice.do' \
+           '?cmd={1}' \
+           '&case_set_id={2}' \
+           '&genetic_profile_id={3}' \
+           '&gene_list={4}'.format(
+               portal_version,
+               cmd,
+               case_set_id,
+               genetic_profile_id,
+               '+'.join(gene_ids)
+           )
+
+
+def plan_gene_list_chunks(gene_ids, base_url_length, max_url_length=2000,
+                          max_genes_per_request=100):
+    """
+    Splits a list of gene symbols into consecutive chunks, such that the gene_list parameter
+    for each chunk keeps the request URL within max_url_length characters, and each request
+    covers at most max_genes_per_request genes (which bounds the size of each response).
+
+    Parameters
+    ----------
+    gene_ids: list of str
+    base_url_length: int
+        length of the request URL excluding the gene list
+    max_url_length: int
+    max_genes_per_request: int
+
+    Returns
+    -------
+    list of lists of str
+    """
+    max_gene_list_length = max_url_length - base_url_length
+    chunks = []
+    chunk = []
+    chunk_length = 0
+    for gene_id in gene_ids:
+        # '+' separator
+        gene_id_length = len(gene_id) + (1 if len(chunk) > 0 else 0)
+        if len(chunk) > 0 and (
+                chunk_length + gene_id_length > max_gene_list_length or
+                len(chunk) >= max_genes_per_request
+                ):
+            chunks.append(chunk)
+            chunk = []
+            chunk_length = 0
+            gene_id_length = len(gene_id)
+        chunk.append(gene_id)
+        chunk_length += gene_id_length
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
+
+
+def _retrieve_webservice_lines_for_pool(url):
+    # reads the whole response for one gene list chunk; see iter_webservice_lines
+    logger.debug(url)
+    response = urllib2.urlopen(url)
+    return [line.rstrip('\r\n') for line in response]
+
+
+def iter_webservice_lines(cmd, case_set_id, genetic_profile_id, gene_ids, nheader_lines,
+                          portal_version='public-portal', nthreads=4, max_url_length=2000,
+                          max_genes_per_request=100):
+    """
+    Requests cBioPortal webservice data for chunks of the gene list concurrently, and yields
+    the lines of the merged data file. Responses are merged in the order of the gene list: the
+    first nheader_lines lines are taken from the first response, and the remaining responses
+    only contribute their data lines. The last header line (column names or case IDs) must be
+    identical for all responses.
+
+    Chunks are requested in a window of at most nthreads outstanding requests, in the order of
+    the gene list. The lines of each response are yielded as soon as it and all preceding
+    responses have been received, and a further chunk is only requested once the oldest
+    response in the window has been taken, so at most about nthreads responses are held in
+    memory at once, however long the gene list.
+
+    An error or warning response (e.g. 'Error: Problem when identifying a cancer study for
+    the request.') for the first chunk is yielded unchanged, so that callers can detect it
+    as for an unchunked request. An error response for any subsequent chunk raises an
+    Exception, since the data file would otherwise be incomplete.
+    """
+    base_url_length = len(build_webservice_url(
+        cmd, case_set_id, genetic_profile_id, [], portal_version=portal_version
+    ))
+    gene_id_chunks = plan_gene_list_chunks(
+        gene_ids,
+        base_url_length,
+        max_url_length=max_url_length,
+        max_genes_per_request=max_genes_per_request,
+    )
+    urls = [
+        build_webservice_url(
+            cmd, case_set_id, genetic_profile_id, gene_id_chunk, portal_version=portal_version
+        )
+        for gene_id_chunk in gene_id_chunks
+    ]
+
+    window_size = max(1, min(nthreads, len(urls)))
+    pool = ThreadPool(window_size)
+    try:
+        urls_iter = iter(urls)
+        window = collections.deque(
+            pool.apply_async(_retrieve_webservice_lines_for_pool, (url,))
+            for url in itertools.islice(urls_iter, window_size)
+        )
+        header_lines = None
+        for c in range(len(urls)):
+            # responses are taken in the order of the gene list
+            lines = window.popleft().get()
+            next_url = next(urls_iter, None)
+            if next_url is not None:
+                window.append(pool.apply_async(_retrieve_webservice_lines_for_pool, (next_url,)))
+            is_error_response = len(lines) > 0 and (
+                lines[0].startswith('Error:') or lines[0].startswith('# Warning:')
+            )
+            if is_error_response:
+                if c == 0:
+                    for line in lines:
+                        yield line
+                    return
+                raise Exception(
+                    'cBioPortal returned an error for gene list chunk {0} of {1}: {2}'.format(
+                        c+1, len(urls), lines[0]
+                    )
+                )
+            if header_lines is None:
+                header_lines = lines[:nheader_lines]
+                for line in header_lines:
+                    yield line
+            elif lines[nheader_lines-1:nheader_lines] != header_lines[-1:]:
+                # e.g. the case IDs or column names differ, so data lines can not be merged
+                raise Exception(
+                    'cBioPortal response headers differ between gene list chunks for {0}'.format(
+                        case_set_id
+                    )
+                )
+            for line in lines[nheader_lines:]:
+                yield line
+    finally:
+        pool.terminate()
 
 
 def match_dual_consecutive_aa_change(aa_change_string):
@@ -606,9 +1400,70 @@ def split_dual_consecutive_aa_change(aa_change_string):
     return aa_changes
 
 
+def calculate_mutation_frequencies(crawl_number=None, by='db_entry', mutation_types=None):
+    """
+    Calculates the percentage of cases with mutations, for all DBEntries (or UniProt domains)
+    at once, from the CbioportalMutation and CbioportalCase rows of a crawl.
+
+    As for percent_cases_with_mutations, the percentage is calculated across the studies in
+    which each target has at least one mutated case:
+    100 * sum(mutated cases in study) / sum(num_in_cohort for study).
+    Studies for which num_in_cohort is not known are ignored.
+
+    Parameters
+    ----------
+    crawl_number: int
+        Defaults to the current crawl
+    by: str
+        'db_entry' or 'uniprot_domain'
+    mutation_types: list of str or None
+        e.g. ['Missense_Mutation']; by default mutations of all types are counted
+
+    Returns
+    -------
+    pandas.Series of percentages, indexed by DBEntry (or UniProtDomain) id. Targets without
+    mutations are not included; use e.g. .reindex(db_entry_ids, fill_value=0.) to obtain
+    values for a given list of targets.
+    """
+    if by == 'db_entry':
+        target_id_column = models.CbioportalMutation.db_entry_id
+    elif by == 'uniprot_domain':
+        target_id_column = models.CbioportalMutation.uniprot_domain_id
+    else:
+        raise ValueError('by must be "db_entry" or "uniprot_domain"')
+    if crawl_number is None:
+        crawl_number = models.CrawlData.query.first().current_crawl_number
+
+    # One row per target and study
+    query = db.session.query(
+        target_id_column.label('target_id'),
+        models.CbioportalCase.study,
+        db.func.count(db.distinct(models.CbioportalCase.id)).label('nmutated_cases'),
+        db.func.max(models.CbioportalCase.num_in_cohort).label('num_in_cohort'),
+    ).join(models.CbioportalCase).filter(
+        models.CbioportalMutation.crawl_number == crawl_number,
+        target_id_column != None,
+        models.CbioportalCase.num_in_cohort != None,
+    )
+    if mutation_types is not None:
+        query = query.filter(models.CbioportalMutation.type.in_(mutation_types))
+    study_counts_df = pd.DataFrame(
+        query.group_by(target_id_column, models.CbioportalCase.study).all(),
+        columns=['target_id', 'study', 'nmutated_cases', 'num_in_cohort'],
+    )
+
+    target_counts_df = study_counts_df.groupby('target_id')[['nmutated_cases', 'num_in_cohort']].sum()
+    percent_cases_with_mutations = (
+        target_counts_df.nmutated_cases.astype(float) / target_counts_df.num_in_cohort * 100.
+    )
+    percent_cases_with_mutations.name = 'percent_cases_with_mutations'
+    return percent_cases_with_mutations
+
+
 def percent_cases_with_mutations(gene_node):
     """
     Calculates the percentage of cases with mutations for a given gene node (kinDB XML style), and across all cancer studies with data contained in the node.
+    See calculate_mutation_frequencies to calculate this for all targets in the database at once.
     """
     cancer_studies = set([x.get('study') for x in gene_node.findall('mutants/mutant')])
     if len(cancer_studies) == 0:
@@ -629,114 +1484,193 @@ def percent_cases_with_mutations(gene_node):
 class AddCbioportalMAFData(object):
     def __init__(self,
                  maf_filepath=None,
+                 chunksize=100000,
                  run_main=True,
                  commit_to_db=True
                  ):
+        """
+        Adds mutation data from a MAF file (e.g. from an internal sequencing project) to the
+        current crawl, as cases belonging to the study 'internal'.
+
+        Parameters
+        ----------
+        maf_filepath: str
+        chunksize: int
+            Number of MAF lines to read and process at a time
+        run_main: bool
+        commit_to_db: bool
+        """
         self.maf_filepath = maf_filepath
+        self.chunksize = chunksize
         self.commit_to_db = commit_to_db
         self.aa_change_regex = re.compile('^p\.([0-9A-Z]*)')
         self.aa_change_split_regex = re.compile('^([A-Z]+)([0-9]+)([A-Z]+)')
+        self.study = 'internal'
+        db.use_sqlite_profile('gather')
 
         crawldata_row = models.CrawlData.query.first()
         self.current_crawl_number = crawldata_row.current_crawl_number
 
         if run_main:
-            self.parse_maf_file()
+            self.get_transcript_and_domain_data_from_db()
             self.extract_mutation_data()
             self.finish()
 
+    def get_transcript_and_domain_data_from_db(self):
+        # Ensembl transcript ID => DBEntry id
+        self.transcripts_df = pd.DataFrame(
+            db.session.query(
+                models.EnsemblTranscript.transcript_id, models.EnsemblGene.db_entry_id
+            ).join(models.EnsemblGene).filter(
+                models.EnsemblTranscript.crawl_number == self.current_crawl_number
+            ).all(),
+            columns=['Transcript_ID', 'db_entry_id']
+        ).drop_duplicates('Transcript_ID')
+        self.domains_df = pd.DataFrame(
+            db.session.query(
+                models.UniProtDomain.db_entry_id,
+                models.UniProtDomain.id,
+                models.UniProtDomain.begin,
+                models.UniProtDomain.end,
+            ).filter_by(crawl_number=self.current_crawl_number).all(),
+            columns=['db_entry_id', 'uniprot_domain_id', 'begin', 'end']
+        )
+
     def parse_maf_file(self):
-        self.maf_df = pd.read_csv(self.maf_filepath, sep='\t', skiprows=0, header=1)
+        """
+        Returns an iterator over DataFrames of self.chunksize MAF lines.
+        The first line of the MAF file is a version line, and the second is the header.
+        """
+        return pd.read_csv(
+            self.maf_filepath, sep='\t', skiprows=0, header=1, chunksize=self.chunksize,
+            dtype={'Chromosome': str, 'Transcript_ID': str, 'Tumor_Sample_Barcode': str},
+        )
 
     def extract_mutation_data(self):
-        case_rows = {}
+        self.case_row_ids = {}
+        # all cases in the MAF file, including those without mutations in any DBEntry
+        self.maf_case_ids = set()
+        n_maf_lines = 0
         n_mutations_added = 0
-        for maf_index_row_tuple in self.maf_df.iterrows():
-            maf_row = maf_index_row_tuple[1]
-            # hgnc_symbol = maf_row.Hugo_Symbol
-            oncotator_ensembl_transcript_id = maf_row.Transcript_ID
-            matching_db_ensembl_transcript_row = models.EnsemblTranscript.query.filter_by(
-                transcript_id=oncotator_ensembl_transcript_id
-            ).first()
-            if matching_db_ensembl_transcript_row is None:
-                continue
-            study = 'internal'
-            case_id = maf_row.Tumor_Sample_Barcode
-            if case_id not in case_rows:
-                case_rows[case_id] = models.CbioportalCase(
-                     crawl_number=self.current_crawl_number, case_id=case_id, study=study
-                )
-                db.session.add(case_rows[case_id])
-
-            type = maf_row.Variant_Classification
-            chromosome_index = maf_row.Chromosome
-            chromosome_startpos = maf_row.Start_Position
-            chromosome_endpos = maf_row.End_Position
-            reference_dna_allele = maf_row.Reference_Allele
-            if maf_row.Tumor_Seq_Allele1 != reference_dna_allele:
-                variant_dna_allele = maf_row.Tumor_Seq_Allele1
-            elif maf_row.Tumor_Seq_Allele2 != reference_dna_allele:
-                variant_dna_allele = maf_row.Tumor_Seq_Allele2
-            else:
-                variant_dna_allele = maf_row.Tumor_Seq_Allele1
-            cbioportal_aa_change_string = None
-            oncotator_reference_aa = None
-            oncotator_aa_pos = None
-            oncotator_variant_aa = None
-            if maf_row.Amino_Acid_Change is not np.nan:
-                aa_change_regex_match = re.match(self.aa_change_regex, maf_row.Amino_Acid_Change)
-                if aa_change_regex_match:
-                    cbioportal_aa_change_string = aa_change_regex_match.groups()[0]
-                    if type == 'Missense_Mutation':
-                        aa_change_split_regex_match = re.match(
-                            self.aa_change_split_regex, cbioportal_aa_change_string
-                        )
-                        if aa_change_split_regex_match:
-                            oncotator_reference_aa = aa_change_split_regex_match.groups()[0]
-                            oncotator_aa_pos = int(aa_change_split_regex_match.groups()[1])
-                            oncotator_variant_aa = aa_change_split_regex_match.groups()[2]
-            validation_status = maf_row.Validation_Status
-            functional_impact_score = maf_row['MA:FImpact']
-            print type, cbioportal_aa_change_string, oncotator_reference_aa, oncotator_aa_pos, oncotator_variant_aa
-
-            mutation_row = models.CbioportalMutation(
-                crawl_number=self.current_crawl_number,
-                type=type,
-                cbioportal_aa_change_string=cbioportal_aa_change_string,
-                mutation_origin=None,
-                validation_status=validation_status,
-                functional_impact_score=functional_impact_score,
-                chromosome_index=chromosome_index,
-                chromosome_startpos=chromosome_startpos,
-                chromosome_endpos=chromosome_endpos,
-                reference_dna_allele=reference_dna_allele,
-                variant_dna_allele=variant_dna_allele,
-                oncotator_aa_pos=oncotator_aa_pos,
-                oncotator_reference_aa=oncotator_reference_aa,
-                oncotator_variant_aa=oncotator_variant_aa,
-                oncotator_ensembl_transcript_id=oncotator_ensembl_transcript_id,
-                db_entry=matching_db_ensembl_transcript_row.ensembl_gene.db_entry,
-                cbioportal_case=case_rows[case_id],
-                in_uniprot_domain=False,
+        for maf_df in self.parse_maf_file():
+            n_maf_lines += len(maf_df)
+            self.maf_case_ids.update(maf_df.Tumor_Sample_Barcode.unique())
+            mutations_df = self.extract_mutation_data_from_chunk(maf_df)
+            self.add_case_rows(mutations_df.case_id.unique())
+            mutations_df['cbioportal_case_id'] = mutations_df.case_id.map(self.case_row_ids)
+            bulk_insert_mappings(
+                models.CbioportalMutation,
+                dataframe_to_records(mutations_df.drop('case_id', axis=1))
             )
+            n_mutations_added += len(mutations_df)
 
-            # is mutation within a uniprot domain?
-            matching_uniprot_domains = matching_db_ensembl_transcript_row.ensembl_gene.db_entry.uniprot_domains.all()
-            for domain in matching_uniprot_domains:
-                if oncotator_aa_pos >= domain.begin and oncotator_aa_pos <= domain.end:
-                    if oncotator_reference_aa != cbioportal_aa_change_string[0]:
-                        continue
-                    mutation_row.in_uniprot_domain = True
-                    mutation_row.uniprot_domain = domain
+        logger.info('From {} mutation annotations, added {} mutations and {} cases.'.format(
+            n_maf_lines, n_mutations_added, len(self.case_row_ids))
+        )
+        # only the cases added by this import; earlier imports keep their own cohort size
+        case_row_ids = sorted(self.case_row_ids.values())
+        for start in range(0, len(case_row_ids), 500):
+            models.CbioportalCase.query.filter(
+                models.CbioportalCase.id.in_(case_row_ids[start:start + 500])
+            ).update({'num_in_cohort': len(self.maf_case_ids)}, synchronize_session=False)
+
+    def extract_mutation_data_from_chunk(self, maf_df):
+        """
+        Returns a DataFrame with one row per mutation to be added, with columns matching those
+        of the CbioportalMutation table (plus case_id).
+        """
+        # Only keep mutations in transcripts which are in the db
+        maf_df = maf_df.merge(self.transcripts_df, on='Transcript_ID', how='inner')
+
+        reference_dna_allele = maf_df.Reference_Allele
+        variant_dna_allele = maf_df.Tumor_Seq_Allele1.where(
+            (maf_df.Tumor_Seq_Allele1 != reference_dna_allele) |
+            (maf_df.Tumor_Seq_Allele2 == reference_dna_allele),
+            maf_df.Tumor_Seq_Allele2
+        )
 
-            db.session.add(mutation_row)
-            n_mutations_added += 1
+        cbioportal_aa_change_string = maf_df.Amino_Acid_Change.str.extract(
+            self.aa_change_regex, expand=False
+        )
+        aa_change_split = cbioportal_aa_change_string.str.extract(
+            self.aa_change_split_regex, expand=True
+        )
+        aa_change_split[maf_df.Variant_Classification != 'Missense_Mutation'] = np.nan
+
+        mutations_df = pd.DataFrame({
+            'crawl_number': self.current_crawl_number,
+            'case_id': maf_df.Tumor_Sample_Barcode,
+            'type': maf_df.Variant_Classification,
+            'cbioportal_aa_change_string': cbioportal_aa_change_string,
+            'mutation_origin': None,
+            'validation_status': maf_df.Validation_Status,
+            'functional_impact_score': maf_df['MA:FImpact'],
+            'chromosome_index': pd.to_numeric(
+                maf_df.Chromosome, errors='coerce'
+            ).astype('Int64'),
+            'chromosome_startpos': maf_df.Start_Position.astype('Int64'),
+            'chromosome_endpos': maf_df.End_Position.astype('Int64'),
+            'reference_dna_allele': reference_dna_allele,
+            'variant_dna_allele': variant_dna_allele,
+            'oncotator_reference_aa': aa_change_split[0],
+            'oncotator_aa_pos': pd.to_numeric(aa_change_split[1]).astype('Int64'),
+            'oncotator_variant_aa': aa_change_split[2],
+            'oncotator_ensembl_transcript_id': maf_df.Transcript_ID,
+            'db_entry_id': maf_df.db_entry_id,
+            'in_uniprot_domain': False,
+            'uniprot_domain_id': None,
+        })
+
+        # is mutation within a uniprot domain?
+        # Join mutations to the domains of the same DBEntry, and keep those within the domain
+        # boundaries. If a mutation falls within multiple domains, the last is used.
+        mutation_domains_df = mutations_df[
+            ['db_entry_id', 'oncotator_aa_pos', 'oncotator_reference_aa',
+             'cbioportal_aa_change_string']
+        ].reset_index().merge(self.domains_df, on='db_entry_id', how='inner')
+        mutation_domains_df = mutation_domains_df[
+            (mutation_domains_df.oncotator_aa_pos >= mutation_domains_df.begin) &
+            (mutation_domains_df.oncotator_aa_pos <= mutation_domains_df.end) &
+            (
+                mutation_domains_df.oncotator_reference_aa ==
+                mutation_domains_df.cbioportal_aa_change_string.str[0]
+            )
+        ].drop_duplicates('index', keep='last').set_index('index')
+        mutations_df.loc[mutation_domains_df.index, 'in_uniprot_domain'] = True
+        mutations_df.loc[mutation_domains_df.index, 'uniprot_domain_id'] = (
+            mutation_domains_df.uniprot_domain_id
+        )
 
-        logger.info('From {} mutation annotations, added {} mutations and {} cases.'.format(
-            len(self.maf_df), n_mutations_added, len(case_rows))
+        return mutations_df
+
+    def add_case_rows(self, case_ids):
+        new_case_ids = [case_id for case_id in case_ids if case_id not in self.case_row_ids]
+        if len(new_case_ids) == 0:
+            return
+        max_case_row_id = db.session.query(db.func.max(models.CbioportalCase.id)).scalar() or 0
+        bulk_insert_mappings(
+            models.CbioportalCase,
+            [
+                {'crawl_number': self.current_crawl_number, 'case_id': case_id, 'study': self.study}
+                for case_id in new_case_ids
+            ]
+        )
+        self.case_row_ids.update(
+            db.session.query(models.CbioportalCase.case_id, models.CbioportalCase.id).filter(
+                models.CbioportalCase.id > max_case_row_id
+            ).all()
         )
 
     def finish(self):
         if self.commit_to_db:
             db.session.commit()
         print 'Done.'
+
+
+def dataframe_to_records(df):
+    """
+    Converts a DataFrame to a list of dicts suitable for bulk insertion, with numpy scalars
+    converted to Python types and NaN values converted to None.
+    """
+    df = df.astype(object).where(pd.notnull(df), None)
+    return df.to_dict('records')
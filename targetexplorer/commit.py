@@ -1,23 +1,66 @@
+import json
 import datetime
 import targetexplorer
 from targetexplorer.flaskapp import db, models
+from targetexplorer.bulkload import bulk_insert_mappings
 from targetexplorer.core import read_project_config, logger
+from targetexplorer.crawls import export_crawl_partition, delete_old_crawl_partitions
+from targetexplorer.crawls import prune_working_database, publish_crawl_partition
+from targetexplorer.crawls import get_published_crawl_number
+from targetexplorer.crawls import CrawlHistory, crawl_history_filepath, get_crawl_partition_filepath
 from targetexplorer.utils import DatabaseException
 
 
 class Commit(object):
     def __init__(self, run_main=True):
+        # the gather profile trades durability for speed; commits use the SQLite defaults
+        db.use_sqlite_profile(None)
         self.project_config = read_project_config()
         self.crawldata_row = models.CrawlData.query.first()
         self.current_crawl_number = self.crawldata_row.current_crawl_number
         self.safe_crawl_datestamp = self.crawldata_row.safe_crawl_datestamp
         self.current_crawl_datestamps_row = models.DateStamps.query.filter_by(crawl_number=self.current_crawl_number).first()
         if run_main:
+            if db.engine.dialect.name == 'sqlite':
+                self.publish_unpublished_safe_crawl()
             self.check_all_gather_scripts_have_been_run()
             self.update_crawl_numbers()
             self.update_datestamps()
+            self.create_db_entry_summaries()
             self.delete_old_crawls()
             self.commit()
+            if db.engine.dialect.name == 'sqlite':
+                try:
+                    self.publish_crawl(self.current_crawl_number)
+                except Exception:
+                    logger.error(
+                        'Crawl {0} was committed to the working db, but could not be published. '
+                        'It will be published when Commit is next run.'.format(
+                            self.current_crawl_number
+                        )
+                    )
+                    raise
+            logger.info('Done.')
+
+    def publish_unpublished_safe_crawl(self):
+        """
+        The working db is committed before the new safe crawl is exported and published (the
+        partition is copied from the committed rows), so if a previous Commit failed after the
+        working db was committed, the safe crawl is published here instead.
+        """
+        safe_crawl_number = self.crawldata_row.safe_crawl_number
+        if safe_crawl_number < 0 or get_published_crawl_number() == safe_crawl_number:
+            return
+        logger.info('Safe crawl {0} has not been published; publishing...'.format(
+            safe_crawl_number
+        ))
+        self.publish_crawl(safe_crawl_number)
+
+    def publish_crawl(self, crawl_number):
+        self.write_crawl_partition(crawl_number)
+        self.publish_safe_crawl(crawl_number)
+        self.add_crawl_to_history(crawl_number)
+        self.delete_old_crawl_partitions()
 
     def check_all_gather_scripts_have_been_run(self):
         """
@@ -52,27 +95,112 @@ class Commit(object):
         new_datestamps_row = models.DateStamps(crawl_number=self.current_crawl_number+1)
         db.session.add(new_datestamps_row)
 
+    def create_db_entry_summaries(self):
+        """
+        Builds one DBEntrySummary row per DBEntry of the new safe crawl, from which the /search
+        and /listall API endpoints are served.
+        """
+        domains_by_db_entry_id = {}
+        for domain in models.UniProtDomain.query.filter_by(
+                crawl_number=self.current_crawl_number
+        ).order_by(models.UniProtDomain.id):
+            descriptions, target_ids = domains_by_db_entry_id.setdefault(
+                domain.db_entry_id, ([], [])
+            )
+            descriptions.append(domain.description)
+            if domain.is_target_domain:
+                target_ids.append(domain.target_id)
+
+        summary_mappings = {}
+        for db_entry, uniprot in db.session.query(models.DBEntry, models.UniProtEntry).join(
+            models.UniProtEntry, models.UniProtEntry.db_entry_id == models.DBEntry.id
+        ).filter(
+            models.DBEntry.crawl_number == self.current_crawl_number
+        ).order_by(models.DBEntry.id, models.UniProtEntry.id):
+            if db_entry.id in summary_mappings:
+                continue
+            descriptions, target_ids = domains_by_db_entry_id.get(db_entry.id, ([], []))
+            summary_mappings[db_entry.id] = dict(
+                crawl_number=self.current_crawl_number,
+                ac=uniprot.ac,
+                entry_name=uniprot.entry_name,
+                family=uniprot.family,
+                ncbi_taxon_id=uniprot.ncbi_taxon_id,
+                taxon_name_scientific=uniprot.taxon_name_scientific,
+                taxon_name_common=uniprot.taxon_name_common,
+                npdbs=db_entry.npdbs,
+                ndomains=db_entry.ndomains,
+                nisoforms=db_entry.nisoforms,
+                nfunctions=db_entry.nfunctions,
+                ndisease_associations=db_entry.ndisease_associations,
+                npubs=db_entry.npubs,
+                nbioassays=db_entry.nbioassays,
+                domains=json.dumps(descriptions),
+                target_domains=json.dumps(target_ids),
+                db_entry_id=db_entry.id,
+            )
+        bulk_insert_mappings(
+            models.DBEntrySummary,
+            [summary_mappings[db_entry_id] for db_entry_id in sorted(summary_mappings)]
+        )
+        logger.info('Built {0} DBEntry summaries for crawl {1}'.format(
+            len(summary_mappings), self.current_crawl_number
+        ))
+
     def delete_old_crawls(self):
-        crawl_numbers = [row.crawl_number for row in models.DateStamps.query.all()]
-        if len(crawl_numbers) > self.project_config['ncrawls_to_save']:
-            logger.info('More than %d crawls found.' % self.project_config['ncrawls_to_save'])
-            crawl_numbers_sorted = sorted(crawl_numbers, reverse=True)
-            crawls_to_delete = crawl_numbers_sorted[self.project_config['ncrawls_to_save']:]
-            # iterate through crawls to delete
-            for crawl_to_delete in crawls_to_delete:
-                logger.info('Deleting crawl %d...' % crawl_to_delete)
-                # iterate through tables
-                for table_class_name in models.table_class_names:
-                    if table_class_name == 'CrawlData':
-                        continue
-                    table = getattr(models, table_class_name)
-                    rows_to_delete = table.query.filter_by(crawl_number=crawl_to_delete)
-                    logger.info('  - %s - %d rows' % (table_class_name, rows_to_delete.count()))
-                    rows_to_delete.delete()
+        """
+        The working db only holds the new safe crawl and the new current crawl. Older crawls are
+        kept as separate crawl partition files (see write_crawl_partition), so are deleted here
+        in the same transaction which updates the safe crawl number.
+
+        Crawl partitions are SQLite files, so with a database server such as PostgreSQL the
+        ncrawls_to_save most recent crawls are kept in the working db instead, and API
+        processes read the safe crawl from it.
+        """
+        if db.engine.dialect.name == 'sqlite':
+            oldest_crawl_number = self.current_crawl_number
+        else:
+            oldest_crawl_number = (
+                self.current_crawl_number - self.project_config['ncrawls_to_save'] + 1
+            )
+        logger.info('Deleting crawls older than {0} from working db...'.format(
+            oldest_crawl_number
+        ))
+        prune_working_database(oldest_crawl_number)
 
     def commit(self):
         db.session.commit()
         logger.info('Database committed.')
         logger.info('New safe crawl number: {0}'.format(self.current_crawl_number))
         logger.info('New current crawl number: {0}'.format(self.current_crawl_number+1))
-        logger.info('Done.')
+
+    def write_crawl_partition(self, crawl_number):
+        export_crawl_partition(crawl_number)
+
+    def publish_safe_crawl(self, crawl_number):
+        publish_crawl_partition(crawl_number)
+
+    def add_crawl_to_history(self, crawl_number):
+        """
+        Older crawls are kept in the crawl history (see crawls.CrawlHistory), which only stores
+        the rows which changed between crawls. The ncrawls_to_save most recent crawls are kept.
+        """
+        crawl_history = CrawlHistory(crawl_history_filepath)
+        ninserted = crawl_history.add_crawl(
+            get_crawl_partition_filepath(crawl_number), crawl_number
+        )
+        logger.info('Added crawl {0} to crawl history ({1} changed rows)'.format(
+            crawl_number, sum(ninserted.values())
+        ))
+        crawl_numbers = crawl_history.list_crawls()
+        if len(crawl_numbers) > self.project_config['ncrawls_to_save']:
+            logger.info('More than %d crawls found.' % self.project_config['ncrawls_to_save'])
+            crawl_history.delete_crawls_before(
+                crawl_numbers[-self.project_config['ncrawls_to_save']]
+            )
+        crawl_history.close()
+
+    def delete_old_crawl_partitions(self):
+        # only the published safe crawl is kept as a full partition file; older crawls can be
+        # re-created from the crawl history
+        delete_old_crawl_partitions(1)
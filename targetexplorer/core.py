@@ -16,6 +16,8 @@ manual_overrides_filename = 'manual_overrides.yaml'
 database_filename = 'database.db'
 wsgi_filename = 'webapi-wsgi.py'
 external_data_dirpath = 'external-data'
+crawl_partitions_dirpath = 'crawls'
+safe_crawl_snapshot_filename = 'safe-crawl.db'
 
 # =========
 # =========
@@ -0,0 +1,598 @@
+import os
+import re
+import glob
+import json
+import hashlib
+import sqlite3
+from targetexplorer.flaskapp import app, db, models
+from targetexplorer.core import crawl_partitions_dirpath, safe_crawl_snapshot_filename, logger
+
+crawl_partition_filename_regex = re.compile('^crawl-(-?[0-9]+)\.db$')
+crawl_history_filepath = os.path.join(crawl_partitions_dirpath, 'history.db')
+fulltext_table_name = 'db_entry_fulltext'
+
+# Queries returning (id, key values...) for rows of a crawl partition which can be identified
+# across crawls by a natural key. See CrawlHistory.
+crawl_history_row_key_queries = {
+    'db_entries': 'SELECT db_entry_id, ac FROM partition.uniprot_entries ORDER BY id',
+    'uniprot_entries': 'SELECT id, ac FROM partition.uniprot_entries ORDER BY id',
+    'uniprot_isoforms': 'SELECT id, ac FROM partition.uniprot_isoforms ORDER BY id',
+    'bindingdb_ligands': 'SELECT id, bindingdb_id FROM partition.bindingdb_ligands ORDER BY id',
+    'cbioportal_cases': 'SELECT id, study, case_id FROM partition.cbioportal_cases ORDER BY id',
+}
+
+
+def get_crawl_partition_filepath(crawl_number):
+    return os.path.join(crawl_partitions_dirpath, 'crawl-{0}.db'.format(crawl_number))
+
+
+def get_working_database_filepath():
+    """
+    Returns the path of the SQLite database which gather stages write to.
+    """
+    return db.engine.url.database
+
+
+def get_crawl_tables():
+    """
+    Returns the Table objects for all model classes, with CrawlData first.
+    """
+    return [
+        getattr(models, table_class_name).__table__
+        for table_class_name in sorted(
+            models.table_class_names, key=lambda name: (name != 'CrawlData', name)
+        )
+    ]
+
+
+def list_crawl_partitions():
+    """
+    Returns
+    -------
+    list of int
+        crawl numbers of all crawl partitions, in ascending order
+    """
+    crawl_numbers = []
+    for filepath in glob.glob(os.path.join(crawl_partitions_dirpath, 'crawl-*.db')):
+        match = re.match(crawl_partition_filename_regex, os.path.basename(filepath))
+        if match is not None:
+            crawl_numbers.append(int(match.group(1)))
+    return sorted(crawl_numbers)
+
+
+def export_crawl_partition(crawl_number):
+    """
+    Copies all rows for a crawl from the working database into a separate SQLite file, with the
+    same schema, together with the CrawlData row. The file is written under a temporary name and
+    only moved into place once complete.
+
+    Returns
+    -------
+    crawl_partition_filepath: str
+    """
+    if not os.path.exists(crawl_partitions_dirpath):
+        os.mkdir(crawl_partitions_dirpath)
+    crawl_partition_filepath = get_crawl_partition_filepath(crawl_number)
+    partial_filepath = crawl_partition_filepath + '.part'
+    if os.path.exists(partial_filepath):
+        os.remove(partial_filepath)
+
+    partition_engine = db.create_engine('sqlite:///' + os.path.abspath(partial_filepath))
+    db.metadata.create_all(bind=partition_engine)
+    partition_engine.dispose()
+
+    # ATTACH cannot be used within the transaction of the Flask-SQLAlchemy session, so the rows
+    # are copied over a separate connection to the working database.
+    connection = sqlite3.connect(get_working_database_filepath())
+    try:
+        connection.execute('ATTACH DATABASE ? AS partition', (os.path.abspath(partial_filepath),))
+        with connection:
+            for table in get_crawl_tables():
+                column_names = ', '.join([column.name for column in table.columns])
+                sql = 'INSERT INTO partition.{0} ({1}) SELECT {1} FROM main.{0}'.format(
+                    table.name, column_names
+                )
+                if 'crawl_number' in table.columns:
+                    connection.execute(sql + ' WHERE crawl_number = ?', (crawl_number,))
+                else:
+                    connection.execute(sql)
+        connection.execute('DETACH DATABASE partition')
+    finally:
+        connection.close()
+
+    # Partitions are never written to once exported, so the full-text index and the query
+    # planner statistics are built once here for the API readers
+    connection = sqlite3.connect(partial_filepath)
+    try:
+        create_fulltext_index(connection)
+        connection.execute('ANALYZE')
+        connection.commit()
+    finally:
+        connection.close()
+
+    os.rename(partial_filepath, crawl_partition_filepath)
+    logger.info('Crawl {0} written to {1}'.format(crawl_number, crawl_partition_filepath))
+    return crawl_partition_filepath
+
+
+def create_fulltext_index(connection):
+    """
+    Builds an FTS5 full-text index (db_entry_fulltext) of the UniProt recommended name,
+    function, disease association and subcellular location annotations in a crawl partition,
+    with one row per DBEntry (rowid = db_entry_id), for the /fulltext API endpoint. Annotations
+    with several rows per entry are concatenated.
+
+    Parameters
+    ----------
+    connection: sqlite3.Connection
+        connection to the crawl partition
+
+    Returns
+    -------
+    bool
+        False if the SQLite library was built without FTS5
+    """
+    try:
+        connection.execute(
+            "CREATE VIRTUAL TABLE {0} USING fts5("
+            "recommended_name, functions, disease_associations, subcellular_locations, "
+            "tokenize='porter unicode61')".format(fulltext_table_name)
+        )
+    except sqlite3.OperationalError as e:
+        logger.warning('Full-text index not created: {0}'.format(e))
+        return False
+    with connection:
+        connection.execute(
+            'INSERT INTO {0} '
+            '(rowid, recommended_name, functions, disease_associations, subcellular_locations) '
+            'SELECT uniprot.db_entry_id, uniprot.recommended_name, '
+            "(SELECT group_concat(function, ' ') FROM uniprot_functions "
+            'WHERE uniprot_id = uniprot.id), '
+            "(SELECT group_concat(disease_association, ' ') FROM uniprot_disease_associations "
+            'WHERE uniprot_id = uniprot.id), '
+            "(SELECT group_concat(subcellular_location, ' ') FROM uniprot_subcellular_locations "
+            'WHERE uniprot_id = uniprot.id) '
+            'FROM uniprot_entries AS uniprot WHERE uniprot.id IN ('
+            'SELECT MIN(id) FROM uniprot_entries WHERE db_entry_id IS NOT NULL '
+            'GROUP BY db_entry_id)'.format(fulltext_table_name)
+        )
+        connection.execute(
+            "INSERT INTO {0} ({0}) VALUES ('optimize')".format(fulltext_table_name)
+        )
+    return True
+
+
+def delete_crawl_partition(crawl_number):
+    os.remove(get_crawl_partition_filepath(crawl_number))
+
+
+def delete_old_crawl_partitions(ncrawls_to_save):
+    """
+    Deletes all but the ncrawls_to_save most recent crawl partitions. The published safe crawl
+    partition is never deleted.
+
+    Returns
+    -------
+    list of int
+        crawl numbers of the deleted partitions
+    """
+    crawl_numbers = list_crawl_partitions()
+    crawls_to_delete = [
+        crawl_number for crawl_number in crawl_numbers[:max(len(crawl_numbers) - ncrawls_to_save, 0)]
+        if crawl_number != get_published_crawl_number()
+    ]
+    for crawl_number in crawls_to_delete:
+        logger.info('Deleting crawl partition {0}...'.format(crawl_number))
+        delete_crawl_partition(crawl_number)
+    return crawls_to_delete
+
+
+def prune_working_database(oldest_crawl_number_to_keep):
+    """
+    Deletes the rows of all crawls older than oldest_crawl_number_to_keep from the working
+    database, within the current session transaction. Uses one DELETE per table, on the
+    crawl_number index.
+    """
+    for table in get_crawl_tables():
+        if 'crawl_number' not in table.columns:
+            continue
+        result = db.session.execute(
+            table.delete().where(table.c.crawl_number < oldest_crawl_number_to_keep)
+        )
+        if result.rowcount:
+            logger.info('  - {0} - {1} rows'.format(table.name, result.rowcount))
+
+
+def publish_crawl_partition(crawl_number):
+    """
+    Atomically points the safe crawl snapshot (safe-crawl.db, a symlink in the project
+    directory) at a crawl partition. A new symlink is created under a temporary name and renamed
+    over the old one, so readers opening the snapshot see either the old or the new partition,
+    never a partially written one.
+    """
+    crawl_partition_filepath = get_crawl_partition_filepath(crawl_number)
+    if not os.path.exists(crawl_partition_filepath):
+        raise Exception('Crawl partition not found: {0}'.format(crawl_partition_filepath))
+    partial_link_filepath = safe_crawl_snapshot_filename + '.part'
+    if os.path.lexists(partial_link_filepath):
+        os.remove(partial_link_filepath)
+    os.symlink(crawl_partition_filepath, partial_link_filepath)
+    os.rename(partial_link_filepath, safe_crawl_snapshot_filename)
+    logger.info('Published crawl {0} as {1}'.format(crawl_number, safe_crawl_snapshot_filename))
+
+
+def get_published_crawl_number():
+    """
+    Returns the crawl number of the published safe crawl snapshot, or None.
+    """
+    if not os.path.lexists(safe_crawl_snapshot_filename):
+        return None
+    match = re.match(
+        crawl_partition_filename_regex, os.path.basename(os.readlink(safe_crawl_snapshot_filename))
+    )
+    return int(match.group(1))
+
+
+def serve_safe_crawl_snapshot(snapshot_filepath=None):
+    """
+    Configures the Flask app to read from the published safe crawl snapshot instead of the
+    working database, for API processes (see the project's webapi-wsgi.py file).
+
+    The snapshot is only written by Commit, and is replaced by renaming the symlink, so API
+    readers never block on or are slowed down by gather stages writing to the working database.
+    File-based SQLite engines open a new connection for each session, so each request resolves
+    the symlink again and picks up a newly published crawl without a restart. Connections are
+    opened with the serve SQLite profile (read-only and immutable, see sqlite_profiles).
+
+    With a database server such as PostgreSQL there are no snapshot files (see
+    Commit.delete_old_crawls), and the working database is used.
+
+    Parameters
+    ----------
+    snapshot_filepath: str or None
+        default: safe-crawl.db in the same directory as the working database
+    """
+    if db.engine.dialect.name != 'sqlite':
+        logger.info('Serving the safe crawl from the working database')
+        return
+    if snapshot_filepath is None:
+        snapshot_filepath = os.path.join(
+            os.path.dirname(os.path.abspath(get_working_database_filepath())),
+            safe_crawl_snapshot_filename
+        )
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.abspath(snapshot_filepath))
+    db.use_sqlite_profile('serve')
+
+
+class CrawlHistory(object):
+    """
+    Copy-on-write store of committed crawls. Each version of a row is stored once, with a
+    content hash and the range of crawls [first_crawl, last_crawl] in which it is present, so
+    adding a crawl only inserts rows which have changed since the previous crawl, and extends
+    the range of the rest.
+
+    Row ids differ between crawls in the working db, so they are not stored. Each row is
+    identified by a row key instead: a natural key where one is given in
+    crawl_history_row_key_queries (e.g. the UniProt AC), or otherwise its content hash. Foreign
+    keys are stored as the row key of the referenced row, and the content hash covers the row
+    key and the remaining columns, so inserting or deleting a row only adds versions of that row
+    (and of rows referencing it, if it has no natural key). Identical rows within a crawl are
+    told apart by the number of preceding identical rows.
+
+    Crawls are re-created as partition files with restore_crawl_partition, which assigns new
+    ids and resolves foreign keys through the row keys.
+
+    >>> history = CrawlHistory(crawl_history_filepath)
+    >>> history.add_crawl(get_crawl_partition_filepath(3), 3)
+    >>> history.restore_crawl_partition(2)
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        crawl_table_names = set([table.name for table in get_crawl_tables()])
+        # referenced tables first, so foreign keys can be mapped to row keys
+        self.tables = [
+            table for table in db.metadata.sorted_tables if table.name in crawl_table_names
+        ]
+        self.referenced_table_names = set()
+        for table in self.tables:
+            self.referenced_table_names.update(self._foreign_key_tables(table).values())
+        self.connection = sqlite3.connect(filepath)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS crawls ('
+            'crawl_number INTEGER PRIMARY KEY, '
+            'safe_crawl_datestamp'
+            ')'
+        )
+        for table in self.tables:
+            if 'crawl_number' not in table.columns:
+                continue
+            self.connection.execute('CREATE TABLE IF NOT EXISTS {0} ({1})'.format(
+                table.name,
+                ', '.join(
+                    ['row_key TEXT', 'position INTEGER'] + self._payload_column_names(table) +
+                    ['content_hash TEXT', 'first_crawl INTEGER', 'last_crawl INTEGER']
+                )
+            ))
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS ix_{0}_last_crawl_content_hash '
+                'ON {0} (last_crawl, content_hash)'.format(table.name)
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS ix_{0}_first_crawl ON {0} (first_crawl)'.format(
+                    table.name
+                )
+            )
+        self.connection.commit()
+
+    @staticmethod
+    def _payload_column_names(table):
+        return [
+            column.name for column in table.columns if column.name not in ['id', 'crawl_number']
+        ]
+
+    @staticmethod
+    def _foreign_key_tables(table):
+        """
+        Returns
+        -------
+        dict of {column_name: referenced_table_name}
+        """
+        return {
+            column.name: list(column.foreign_keys)[0].column.table.name
+            for column in table.columns if len(column.foreign_keys) > 0
+        }
+
+    def list_crawls(self):
+        return [
+            row[0] for row in self.connection.execute(
+                'SELECT crawl_number FROM crawls ORDER BY crawl_number'
+            )
+        ]
+
+    def add_crawl(self, crawl_partition_filepath, crawl_number):
+        """
+        Adds the rows of a crawl partition file (see export_crawl_partition) as crawl
+        crawl_number. Rows which are unchanged since the most recent crawl in the history have
+        their last_crawl extended; only new or changed rows are inserted.
+
+        Returns
+        -------
+        dict of {table_name: number of row versions inserted}
+        """
+        crawl_numbers = self.list_crawls()
+        if crawl_number in crawl_numbers:
+            return {}
+        if len(crawl_numbers) > 0 and crawl_number < crawl_numbers[-1]:
+            raise Exception('Crawl {0} is older than the most recent crawl in {1}'.format(
+                crawl_number, self.filepath
+            ))
+        previous_crawl_number = crawl_numbers[-1] if len(crawl_numbers) > 0 else None
+
+        ninserted = {}
+        self.connection.execute(
+            'ATTACH DATABASE ? AS partition', (os.path.abspath(crawl_partition_filepath),)
+        )
+        try:
+            with self.connection:
+                safe_crawl_datestamp = self.connection.execute(
+                    'SELECT safe_crawl_datestamp FROM partition.crawldata'
+                ).fetchone()
+                self.connection.execute(
+                    'INSERT INTO crawls (crawl_number, safe_crawl_datestamp) VALUES (?, ?)',
+                    (crawl_number, safe_crawl_datestamp[0] if safe_crawl_datestamp else None)
+                )
+                # {table_name: {id: row_key}} for referenced tables
+                row_keys = {}
+                for table in self.tables:
+                    if 'crawl_number' not in table.columns:
+                        continue
+                    ninserted[table.name], row_keys[table.name] = self._add_table_rows(
+                        table, crawl_number, previous_crawl_number, row_keys
+                    )
+        finally:
+            self.connection.execute('DETACH DATABASE partition')
+        return ninserted
+
+    def _get_natural_row_keys(self, table):
+        """
+        Returns
+        -------
+        dict of {id: row_key} for rows of the attached partition with a natural key
+        """
+        if table.name not in crawl_history_row_key_queries:
+            return {}
+        natural_row_keys = {}
+        nkey_occurrences = {}
+        for row in self.connection.execute(crawl_history_row_key_queries[table.name]):
+            key_values = list(row[1:])
+            if row[0] is None or None in key_values:
+                continue
+            row_key = json.dumps(key_values)
+            noccurrences = nkey_occurrences.get(row_key, 0)
+            nkey_occurrences[row_key] = noccurrences + 1
+            if noccurrences > 0:
+                row_key = json.dumps(key_values + [noccurrences])
+            natural_row_keys[row[0]] = row_key
+        return natural_row_keys
+
+    def _add_table_rows(self, table, crawl_number, previous_crawl_number, row_keys):
+        """
+        Returns
+        -------
+        ninserted: int
+        table_row_keys: dict of {id: row_key}
+            only filled for tables referenced by foreign keys
+        """
+        payload_column_names = self._payload_column_names(table)
+        foreign_key_tables = self._foreign_key_tables(table)
+        natural_row_keys = self._get_natural_row_keys(table)
+        is_referenced = table.name in self.referenced_table_names
+        previous_content_hashes = set()
+        if previous_crawl_number is not None:
+            previous_content_hashes = set([
+                row[0] for row in self.connection.execute(
+                    'SELECT content_hash FROM {0} WHERE last_crawl = ?'.format(table.name),
+                    (previous_crawl_number,)
+                )
+            ])
+
+        table_row_keys = {}
+        ncontent_occurrences = {}
+        unchanged_content_hashes = []
+        new_rows = []
+        for position, row in enumerate(self.connection.execute(
+                'SELECT {0} FROM partition.{1} ORDER BY id'.format(
+                    ', '.join(['id'] + payload_column_names), table.name
+                ))):
+            values = []
+            for column_name, value in zip(payload_column_names, row[1:]):
+                if column_name in foreign_key_tables and value is not None:
+                    value = row_keys[foreign_key_tables[column_name]].get(value)
+                values.append(value)
+            row_key = natural_row_keys.get(row[0])
+            if row_key is None:
+                content_hash = hashlib.sha1(json.dumps(values)).hexdigest()
+                noccurrences = ncontent_occurrences.get(content_hash, 0)
+                ncontent_occurrences[content_hash] = noccurrences + 1
+                if noccurrences > 0:
+                    content_hash = hashlib.sha1(
+                        '{0} {1}'.format(content_hash, noccurrences)
+                    ).hexdigest()
+                row_key = content_hash
+            else:
+                content_hash = hashlib.sha1(json.dumps([row_key] + values)).hexdigest()
+            if is_referenced:
+                table_row_keys[row[0]] = row_key
+            if content_hash in previous_content_hashes:
+                unchanged_content_hashes.append((crawl_number, previous_crawl_number, content_hash))
+            else:
+                new_rows.append(
+                    [row_key, position] + values + [content_hash, crawl_number, crawl_number]
+                )
+
+        self.connection.executemany(
+            'UPDATE {0} SET last_crawl = ? WHERE last_crawl = ? AND content_hash = ?'.format(
+                table.name
+            ),
+            unchanged_content_hashes
+        )
+        self.connection.executemany(
+            'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                table.name,
+                ', '.join(
+                    ['row_key', 'position'] + payload_column_names +
+                    ['content_hash', 'first_crawl', 'last_crawl']
+                ),
+                ', '.join(['?'] * (len(payload_column_names) + 5))
+            ),
+            new_rows
+        )
+        return len(new_rows), table_row_keys
+
+    def delete_crawls_before(self, crawl_number):
+        """
+        Removes all crawls older than crawl_number. Row versions only present in those crawls
+        are deleted, and the ranges of the remaining rows are truncated.
+        """
+        with self.connection:
+            for table in self.tables:
+                if 'crawl_number' not in table.columns:
+                    continue
+                self.connection.execute(
+                    'DELETE FROM {0} WHERE last_crawl < ?'.format(table.name), (crawl_number,)
+                )
+                self.connection.execute(
+                    'UPDATE {0} SET first_crawl = ? WHERE first_crawl < ?'.format(table.name),
+                    (crawl_number, crawl_number)
+                )
+            self.connection.execute('DELETE FROM crawls WHERE crawl_number < ?', (crawl_number,))
+
+    def restore_crawl_partition(self, crawl_number, crawl_partition_filepath=None):
+        """
+        Writes a crawl stored in the history to a partition file, with the same schema as the
+        working db. Ids are reassigned from 1 in each table, with rows ordered by their position
+        in the crawl in which they were added.
+
+        Returns
+        -------
+        crawl_partition_filepath: str
+        """
+        crawl_row = self.connection.execute(
+            'SELECT safe_crawl_datestamp FROM crawls WHERE crawl_number = ?', (crawl_number,)
+        ).fetchone()
+        if crawl_row is None:
+            raise Exception('Crawl {0} not found in {1}'.format(crawl_number, self.filepath))
+        if crawl_partition_filepath is None:
+            if not os.path.exists(crawl_partitions_dirpath):
+                os.mkdir(crawl_partitions_dirpath)
+            crawl_partition_filepath = get_crawl_partition_filepath(crawl_number)
+        partial_filepath = crawl_partition_filepath + '.part'
+        if os.path.exists(partial_filepath):
+            os.remove(partial_filepath)
+        partition_engine = db.create_engine('sqlite:///' + os.path.abspath(partial_filepath))
+        db.metadata.create_all(bind=partition_engine)
+        partition_engine.dispose()
+
+        self.connection.execute('ATTACH DATABASE ? AS partition', (os.path.abspath(partial_filepath),))
+        try:
+            with self.connection:
+                self.connection.execute(
+                    'INSERT INTO partition.crawldata '
+                    '(id, current_crawl_number, safe_crawl_number, safe_crawl_datestamp) '
+                    'VALUES (1, ?, ?, ?)',
+                    (crawl_number + 1, crawl_number, crawl_row[0])
+                )
+                # {table_name: {row_key: id}} for referenced tables
+                row_ids = {}
+                for table in self.tables:
+                    if 'crawl_number' not in table.columns:
+                        continue
+                    row_ids[table.name] = self._restore_table_rows(table, crawl_number, row_ids)
+        finally:
+            self.connection.execute('DETACH DATABASE partition')
+        connection = sqlite3.connect(partial_filepath)
+        try:
+            create_fulltext_index(connection)
+        finally:
+            connection.close()
+        os.rename(partial_filepath, crawl_partition_filepath)
+        return crawl_partition_filepath
+
+    def _restore_table_rows(self, table, crawl_number, row_ids, batchsize=10000):
+        payload_column_names = self._payload_column_names(table)
+        foreign_key_tables = self._foreign_key_tables(table)
+        is_referenced = table.name in self.referenced_table_names
+        table_row_ids = {}
+        cursor = self.connection.execute(
+            'SELECT {0} FROM main.{1} WHERE first_crawl <= ? AND last_crawl >= ? '
+            'ORDER BY position, rowid'.format(
+                ', '.join(['row_key'] + payload_column_names), table.name
+            ),
+            (crawl_number, crawl_number)
+        )
+        insert_sql = 'INSERT INTO partition.{0} ({1}) VALUES ({2})'.format(
+            table.name,
+            ', '.join(['id', 'crawl_number'] + payload_column_names),
+            ', '.join(['?'] * (len(payload_column_names) + 2))
+        )
+        row_id = 0
+        while True:
+            rows = cursor.fetchmany(batchsize)
+            if len(rows) == 0:
+                break
+            restored_rows = []
+            for row in rows:
+                row_id += 1
+                if is_referenced:
+                    table_row_ids[row[0]] = row_id
+                restored_row = [row_id, crawl_number]
+                for column_name, value in zip(payload_column_names, row[1:]):
+                    if column_name in foreign_key_tables and value is not None:
+                        value = row_ids[foreign_key_tables[column_name]].get(value)
+                    restored_row.append(value)
+                restored_rows.append(restored_row)
+            self.connection.executemany(insert_sql, restored_rows)
+        return table_row_ids
+
+    def close(self):
+        self.connection.close()
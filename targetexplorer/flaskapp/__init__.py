@@ -1,14 +1,19 @@
 import os
 from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
 from targetexplorer.core import read_project_config
+from targetexplorer.sqlite_profiles import SQLiteProfileSQLAlchemy
 
 targetexplorer_flaskapp_dir = os.path.dirname(__file__)
 
 app = Flask(__name__)
-db = SQLAlchemy(app)
+db = SQLiteProfileSQLAlchemy(app)
 project_config = read_project_config()
 app.config.update(
-    SQLALCHEMY_DATABASE_URI=project_config.get('sqlalchemy_database_uri')
+    SQLALCHEMY_DATABASE_URI=project_config.get('sqlalchemy_database_uri'),
+    # connection pool of each API worker process when using a database server such as
+    # PostgreSQL; should be at least the number of threads per worker
+    SQLALCHEMY_POOL_SIZE=project_config.get('sqlalchemy_pool_size'),
+    SQLALCHEMY_MAX_OVERFLOW=project_config.get('sqlalchemy_max_overflow'),
+    SQLALCHEMY_POOL_RECYCLE=project_config.get('sqlalchemy_pool_recycle'),
 )
 import models
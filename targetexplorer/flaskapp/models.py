@@ -20,6 +20,22 @@ frontend2backend_mappings = {
     'pseudodomain': ['UniProtDomain', 'is_pseudodomain'],
 }
 
+# frontend fields which are columns of DBEntrySummary; the other fields have several values per
+# DBEntry, so are searched by joining their tables
+frontend2summary_mappings = {
+    'ac': 'ac',
+    'name': 'entry_name',
+    'npdbs': 'npdbs',
+    'ndomains': 'ndomains',
+    'nisoforms': 'nisoforms',
+    'nfunctions': 'nfunctions',
+    'ndiseaseassociations': 'ndisease_associations',
+    'npubs': 'npubs',
+    'nbioassays': 'nbioassays',
+    'family': 'family',
+    'species': 'taxon_name_common',
+}
+
 
 class CrawlData(db.Model):
     __tablename__ = 'crawldata'
@@ -36,7 +52,7 @@ class CrawlData(db.Model):
 class DateStamps(db.Model):
     __tablename__ = 'datestamps'
     id = db.Column(db.Integer, primary_key=True)
-    crawl_number = db.Column(db.Integer)
+    crawl_number = db.Column(db.Integer, index=True)
     uniprot_datestamp = db.Column(db.DateTime)
     pdb_datestamp = db.Column(db.DateTime)
     ncbi_gene_datestamp = db.Column(db.DateTime)
@@ -54,7 +70,7 @@ class DBEntry(db.Model):
     """
     __tablename__ = 'db_entries'
     id = db.Column(db.Integer, primary_key=True)
-    crawl_number = db.Column(db.Integer)
+    crawl_number = db.Column(db.Integer, index=True)
     npdbs = db.Column(db.Integer)
     ndomains = db.Column(db.Integer)
     nisoforms = db.Column(db.Integer)
@@ -75,6 +91,7 @@ class DBEntry(db.Model):
     hgnc_entries = db.relationship('HGNCEntry', backref='db_entry', lazy='dynamic')
     bindingdb_bioassays = db.relationship('BindingDBBioassay', backref='db_entry', lazy='dynamic')
     cbioportal_mutations = db.relationship('CbioportalMutation', backref='db_entry', lazy='dynamic')
+    summaries = db.relationship('DBEntrySummary', backref='db_entry', lazy='dynamic')
     def __repr__(self):
         return '<DBEntry {}>'.format(self.id)
 
@@ -137,7 +154,7 @@ class UniProtIsoform(db.Model):
 class UniProtIsoformNote(db.Model):
     __tablename__ = 'uniprot_isoform_notes'
     id = db.Column(db.Integer, primary_key=True)
-    crawl_number = db.Column(db.Integer)
+    crawl_number = db.Column(db.Integer, index=True)
     note = db.Column(db.Text)
     uniprot_isoform_id = db.Column(db.Integer, db.ForeignKey('uniprot_isoforms.id'))
     def __repr__(self):
@@ -216,7 +233,7 @@ class PDBEntry(db.Model):
 class PDBChain(db.Model):
     __tablename__ = 'pdb_chains'
     id = db.Column(db.Integer, primary_key=True)
-    crawl_number = db.Column(db.Integer)
+    crawl_number = db.Column(db.Integer, index=True)
     chain_id = db.Column(db.String(64))
     begin = db.Column(db.Integer)
     end = db.Column(db.Integer)
@@ -235,7 +252,7 @@ class PDBChain(db.Model):
 class PDBExpressionData(db.Model):
     __tablename__ = 'pdb_expression_data'
     id = db.Column(db.Integer, primary_key=True)
-    crawl_number = db.Column(db.Integer)
+    crawl_number = db.Column(db.Integer, index=True)
     expression_data_type = db.Column(db.String(64))
     expression_data_value = db.Column(db.Text)
     pdb_entry_id = db.Column(db.Integer, db.ForeignKey('pdb_entries.id'))
@@ -257,7 +274,7 @@ class NCBIGeneEntry(db.Model):
 class NCBIGenePublication(db.Model):
     __tablename__ = 'ncbi_gene_publication'
     id = db.Column(db.Integer, primary_key=True)
-    crawl_number = db.Column(db.Integer)
+    crawl_number = db.Column(db.Integer, index=True)
     pmid = db.Column(db.Integer)
     ncbi_gene_entry_id = db.Column(db.Integer, db.ForeignKey('ncbi_gene_entries.id'))
     def __repr__(self):
@@ -310,6 +327,30 @@ class HGNCEntry(db.Model):
         return '<HGNCEntry approved_symbol {}>'.format(self.approved_symbol)
 
 
+# '=' for exact values, '<' or '>' for values given as bounds, e.g. '>10000'
+bindingdb_qualifier_enum = db.Enum('=', '<', '>', name='bindingdb_qualifier')
+
+
+class BindingDBLigand(db.Model):
+    """
+    One row per BindingDB monomer per crawl, shared by all bioassays measured for that ligand.
+    """
+    __tablename__ = 'bindingdb_ligands'
+    id = db.Column(db.Integer, primary_key=True)
+    crawl_number = db.Column(db.Integer)
+    bindingdb_id = db.Column(db.Integer)   # BindingDB monomer ID
+    chembl_id = db.Column(db.String(64))
+    smiles_string = db.Column(db.Text)
+    zinc_id = db.Column(db.String(64))
+    bioassays = db.relationship('BindingDBBioassay', backref='ligand', lazy='dynamic')
+    __table_args__ = (
+        db.Index('ix_bindingdb_ligands_crawl_number_bindingdb_id', 'crawl_number', 'bindingdb_id', unique=True),
+        db.Index('ix_bindingdb_ligands_chembl_id', 'chembl_id'),
+    )
+    def __repr__(self):
+        return '<BindingDBLigand {}>'.format(self.bindingdb_id)
+
+
 class BindingDBBioassay(db.Model):
     __tablename__ = 'bindingdb_bioassays'
     id = db.Column(db.Integer, primary_key=True)
@@ -320,11 +361,9 @@ class BindingDBBioassay(db.Model):
     temperature = db.Column(db.String(64))
     ph = db.Column(db.String(64))
     target_name = db.Column(db.Text)
-    ligand_bindingdb_id = db.Column(db.Integer)
-    ligand_chembl_id = db.Column(db.String(64))
-    ligand_smiles_string = db.Column(db.Text)
-    ligand_zinc_id = db.Column(db.String(64))
+    ligand_id = db.Column(db.Integer, db.ForeignKey('bindingdb_ligands.id'), index=True)
 
+    # values as given in the BindingDB data file, e.g. ' 12.5', '>10000', ''
     ki = db.Column(db.String(64))
     ic50 = db.Column(db.String(64))
     kd = db.Column(db.String(64))
@@ -332,8 +371,30 @@ class BindingDBBioassay(db.Model):
     kon = db.Column(db.String(64))
     koff = db.Column(db.String(64))
 
+    # parsed values; see bindingdb.parse_bindingdb_measurement
+    ki_value = db.Column(db.Float)   # nM
+    ki_qualifier = db.Column(bindingdb_qualifier_enum)
+    ic50_value = db.Column(db.Float)   # nM
+    ic50_qualifier = db.Column(bindingdb_qualifier_enum)
+    kd_value = db.Column(db.Float)   # nM
+    kd_qualifier = db.Column(bindingdb_qualifier_enum)
+    ec50_value = db.Column(db.Float)   # nM
+    ec50_qualifier = db.Column(bindingdb_qualifier_enum)
+    kon_value = db.Column(db.Float)   # M-1 s-1
+    kon_qualifier = db.Column(bindingdb_qualifier_enum)
+    koff_value = db.Column(db.Float)   # s-1
+    koff_qualifier = db.Column(bindingdb_qualifier_enum)
+
     # measurements = db.relationship('BindingDBMeasurement', backref='bindingdb_bioassay', lazy='dynamic')
     db_entry_id = db.Column(db.Integer, db.ForeignKey('db_entries.id'))
+    __table_args__ = tuple(
+        db.Index(
+            'ix_bindingdb_bioassays_db_entry_id_{0}_value'.format(measurement),
+            'db_entry_id',
+            '{0}_value'.format(measurement),
+        )
+        for measurement in ['ki', 'ic50', 'kd', 'ec50']
+    )
     def __repr__(self):
         return '<BindingDBBioassay source {}>'.format(self.bindingdb_source)
 
@@ -355,6 +416,7 @@ class CbioportalCase(db.Model):
     crawl_number = db.Column(db.Integer)
     study = db.Column(db.Text)
     case_id = db.Column(db.Text)
+    num_in_cohort = db.Column(db.Integer)   # number of sequenced cases in the study
     mutations = db.relationship('CbioportalMutation', backref='cbioportal_case', lazy='dynamic')
     def __repr__(self):
         return '<CbioportalCase ID {0}>'.format(self.case_id)
@@ -388,6 +450,111 @@ class CbioportalMutation(db.Model):
         )
 
 
+class DBEntrySummary(db.Model):
+    """
+    Denormalized summary of a DBEntry, built by Commit for the new safe crawl, from which the
+    /search and /listall API endpoints are served without querying the other tables.
+    domains and target_domains are JSON-encoded lists.
+    """
+    __tablename__ = 'db_entry_summaries'
+    id = db.Column(db.Integer, primary_key=True)
+    crawl_number = db.Column(db.Integer)
+    ac = db.Column(db.String(64))
+    entry_name = db.Column(db.String(64))
+    family = db.Column(db.String(64))
+    ncbi_taxon_id = db.Column(db.String(64))
+    taxon_name_scientific = db.Column(db.String(120))
+    taxon_name_common = db.Column(db.String(120))
+    npdbs = db.Column(db.Integer)
+    ndomains = db.Column(db.Integer)
+    nisoforms = db.Column(db.Integer)
+    nfunctions = db.Column(db.Integer)
+    ndisease_associations = db.Column(db.Integer)
+    npubs = db.Column(db.Integer)
+    nbioassays = db.Column(db.Integer)
+    domains = db.Column(db.Text)   # domain descriptions
+    target_domains = db.Column(db.Text)   # target_ids of target domains
+    db_entry_id = db.Column(db.Integer, db.ForeignKey('db_entries.id'))
+    def __repr__(self):
+        return '<DBEntrySummary AC {} entry_name {}>'.format(self.ac, self.entry_name)
+
+
+# ===============
+# Indexes for crawl-scoped lookups
+# ===============
+# Almost all queries filter on crawl_number together with an identifier or a DBEntry foreign key,
+# so these are composite indexes with crawl_number first, which also serve queries filtering on
+# crawl_number alone. Tables without such an index have a single-column crawl_number index.
+# Other foreign keys are indexed on their own, since ids are unique across crawls.
+# Indexes are created along with the tables; add them to existing project databases with
+# DoraMigrateDB.py (see targetexplorer.migrate).
+
+def _index(table_class, *column_names):
+    table = table_class.__table__
+    return db.Index(
+        'ix_{0}_{1}'.format(table.name, '_'.join(column_names)),
+        *[table.c[column_name] for column_name in column_names]
+    )
+
+
+crawl_scoped_indexes = [
+    _index(UniProtEntry, 'crawl_number', 'ac'),
+    _index(UniProtEntry, 'crawl_number', 'entry_name'),
+    _index(UniProtEntry, 'crawl_number', 'db_entry_id'),
+    _index(UniProtGeneName, 'crawl_number', 'db_entry_id'),
+    _index(UniProtGeneName, 'uniprot_id'),
+    _index(UniProtIsoform, 'crawl_number', 'ac'),
+    _index(UniProtIsoform, 'crawl_number', 'db_entry_id'),
+    _index(UniProtIsoform, 'uniprot_id'),
+    _index(UniProtIsoformNote, 'uniprot_isoform_id'),
+    _index(UniProtDomain, 'crawl_number', 'db_entry_id'),
+    _index(UniProtDomain, 'crawl_number', 'target_id'),
+    _index(UniProtDomain, 'uniprot_id'),
+    _index(UniProtFunction, 'crawl_number', 'db_entry_id'),
+    _index(UniProtFunction, 'uniprot_id'),
+    _index(UniProtDiseaseAssociation, 'crawl_number', 'db_entry_id'),
+    _index(UniProtDiseaseAssociation, 'uniprot_id'),
+    _index(UniProtSubcellularLocation, 'crawl_number', 'db_entry_id'),
+    _index(UniProtSubcellularLocation, 'uniprot_id'),
+    _index(PDBEntry, 'crawl_number', 'pdb_id'),
+    _index(PDBEntry, 'crawl_number', 'db_entry_id'),
+    _index(PDBChain, 'pdb_entry_id'),
+    _index(PDBChain, 'uniprot_domain_id'),
+    _index(PDBExpressionData, 'pdb_entry_id'),
+    _index(NCBIGeneEntry, 'crawl_number', 'gene_id'),
+    _index(NCBIGeneEntry, 'crawl_number', 'db_entry_id'),
+    _index(NCBIGenePublication, 'ncbi_gene_entry_id'),
+    _index(EnsemblGene, 'crawl_number', 'gene_id'),
+    _index(EnsemblGene, 'crawl_number', 'db_entry_id'),
+    _index(EnsemblTranscript, 'crawl_number', 'transcript_id'),
+    _index(EnsemblTranscript, 'ensembl_gene_id'),
+    _index(EnsemblTranscript, 'uniprot_isoform_id'),
+    _index(EnsemblProtein, 'crawl_number', 'protein_id'),
+    _index(EnsemblProtein, 'ensembl_gene_id'),
+    _index(EnsemblProtein, 'ensembl_transcript_id'),
+    _index(HGNCEntry, 'crawl_number', 'gene_id'),
+    _index(HGNCEntry, 'crawl_number', 'db_entry_id'),
+    _index(BindingDBBioassay, 'crawl_number', 'db_entry_id'),
+    _index(CbioportalCase, 'crawl_number', 'study', 'case_id'),
+    _index(CbioportalMutation, 'crawl_number', 'db_entry_id'),
+    _index(CbioportalMutation, 'cbioportal_case_id'),
+    _index(CbioportalMutation, 'uniprot_domain_id'),
+    _index(DBEntrySummary, 'crawl_number', 'ac'),
+    _index(DBEntrySummary, 'crawl_number', 'entry_name'),
+    _index(DBEntrySummary, 'crawl_number', 'family'),
+    _index(DBEntrySummary, 'crawl_number', 'ncbi_taxon_id'),
+    _index(DBEntrySummary, 'crawl_number', 'taxon_name_common'),
+    _index(DBEntrySummary, 'crawl_number', 'npdbs'),
+    _index(DBEntrySummary, 'crawl_number', 'ndomains'),
+    _index(DBEntrySummary, 'crawl_number', 'nisoforms'),
+    _index(DBEntrySummary, 'crawl_number', 'nfunctions'),
+    _index(DBEntrySummary, 'crawl_number', 'ndisease_associations'),
+    _index(DBEntrySummary, 'crawl_number', 'npubs'),
+    _index(DBEntrySummary, 'crawl_number', 'nbioassays'),
+    _index(DBEntrySummary, 'db_entry_id'),
+]
+
+
 _module_local_names = [key for key in locals().keys()]
 table_class_names = [
     key for key in _module_local_names if isinstance(locals()[key], _BoundDeclarativeMeta)
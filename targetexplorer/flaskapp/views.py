@@ -1,11 +1,15 @@
 import re
+import json
 from flask import abort, jsonify, request, make_response
+from sqlalchemy.exc import OperationalError
 from targetexplorer.flaskapp import app, db, models
+from targetexplorer.crawls import fulltext_table_name
 from targetexplorer.core import read_project_config
 from targetexplorer.flaskapp.webapi_utils import crossdomain
 
 project_config = read_project_config()
 dbapi_name = project_config['dbapi_name']
+fulltext_max_limit = project_config.get('fulltext_max_limit', 1000)
 
 
 # ======
@@ -44,9 +48,11 @@ def listall():
 
     uniprot_values = [
         values for values
-        in models.UniProtEntry.query.filter_by(
+        in models.DBEntrySummary.query.filter_by(
             crawl_number=safe_crawl_number
-        ).values(models.UniProtEntry.ac, models.UniProtEntry.entry_name)
+        ).order_by(models.DBEntrySummary.id).values(
+            models.DBEntrySummary.ac, models.DBEntrySummary.entry_name
+        )
     ]
 
     results_obj = {
@@ -149,6 +155,7 @@ def get_db_entry():
 # Examples:
 # http://.../[DB_NAME]DBAPI/search?query=family="TK" AND npubs>0&return="domain_seqs"
 # http://.../[DB_NAME]DBAPI/search?query=family="TK" AND db_target_rank<300&return="domain_seqs"
+# Several return fields are separated by commas, e.g. return=seqs,pdb_data
 
 # Example SQLAlchemy filter syntax:
 # 'family is null AND species="Human"'
@@ -157,74 +164,51 @@ def get_db_entry():
 @crossdomain(origin='*', headers=["Origin", "X-Requested-With", "Content-Type", "Accept"])
 def query_db():
     frontend_query_string = request.args.get('query') # expecting SQLAlchemy syntax (wtih frontend-style field names)
-    return_fields = request.args.get('return') if 'return' in request.args else []
-    if type(return_fields) == str:
-        return_fields = [return_fields]
+    return_fields = [
+        return_field.strip().strip('"\'')
+        for return_field in request.args.get('return', '').split(',')
+    ]
 
     crawldata = models.CrawlData.query.first()
     safe_crawl_number = crawldata.safe_crawl_number
 
     # = Use the query string to query the db =
-    # Convert the frontend data fields to backend identifiers '[table].[column]'
-    # And determine which tables will need to be queried
-    sql_query_string = frontend_query_string
-    query_tables = []
-    for frontend_field_name, backend_data_list in models.frontend2backend_mappings.iteritems():
-        sql_query_string = sql_query_string.replace(frontend_field_name, '.'.join(backend_data_list))
-        if frontend_field_name in frontend_query_string:
-            query_tables.append(backend_data_list[0])
-    query_tables = set(query_tables)
-
-    # Start with the DBEntry table, then carry out SQL joins with the other tables
-    # (note that we only need to filter by crawl_number for the DBEntry rows)
-    query = db.session.query(models.DBEntry).filter_by(crawl_number=safe_crawl_number)
-    for query_table_name in query_tables:
-        if query_table_name != 'DBEntry':
-            # query_table = models.__dict__[query_table_name]
-            query_table = getattr(models, query_table_name)
-            if not hasattr(query_table, 'db_entry_id'):
-                raise Exception(
-                    'ERROR: Cannot filter on table {} (no relationship to table DBEntry)'.format(
-                        query_table_name
-                    )
-                )
-            query = query.join(query_table, models.DBEntry.id == query_table.db_entry_id)
-
-    # Use the query string to filter DBEntry rows
-    results = query.filter(sql_query_string)
+    query = build_search_query(frontend_query_string, safe_crawl_number)
 
     # = Construct the data structure for holding the results, to be returned as JSON =
     targets_obj = {'results': []}
 
-    for db_entry in results:
-        uniprot = db.session.query(models.UniProtEntry).filter_by(db_entry_id=db_entry.id).first()
-        domain_descriptions = [domain_row.description for domain_row in uniprot.domains]
-        target_domain_ids = [
-            domain_row.target_id for domain_row in uniprot.domains if domain_row.is_target_domain
-        ]
+    for summary in query:
         target_obj = {
-            'ac': uniprot.ac,
-            'entry_name': uniprot.entry_name,
-            'family': uniprot.family,
-            'npdbs': db_entry.npdbs,
-            'npubs': db_entry.npubs,
-            'nbioassays': db_entry.nbioassays,
-            'domains': domain_descriptions,
-            'target_domains': target_domain_ids,
+            'ac': summary.ac,
+            'entry_name': summary.entry_name,
+            'family': summary.family,
+            'npdbs': summary.npdbs,
+            'npubs': summary.npubs,
+            'nbioassays': summary.nbioassays,
+            'domains': json.loads(summary.domains),
+            'target_domains': json.loads(summary.target_domains),
         }
 
         # Optional additional data
         if 'seqs' in return_fields:
-            canon_isoform = uniprot.isoforms.filter_by(canonical=True).first()
-            target_obj['sequence'] = canon_isoform.sequence
+            canon_isoform = models.UniProtIsoform.query.filter_by(
+                db_entry_id=summary.db_entry_id, is_canonical=True
+            ).first()
+            target_obj['sequence'] = canon_isoform.sequence if canon_isoform else None
         if 'domain_seqs' in return_fields:
-            domain_data = [{'targetid': domain_row.targetid, 'sequence': domain_row.sequence} for domain_row in uniprot.domains]
+            domain_data = [
+                {'targetid': domain_row.target_id, 'sequence': domain_row.sequence}
+                for domain_row in models.UniProtDomain.query.filter_by(
+                    db_entry_id=summary.db_entry_id
+                )
+            ]
             target_obj['domains'] = domain_data
         if 'pdb_data' in return_fields:
             pdb_data = []
-            for pdb_row in db_entry.pdbs:
-                pdbchain_data = [{'chainid': pdb_chain_row.chain_id, 'domainid': pdb_chain_row.domain_id, 'seq_begin': pdb_chain_row.begin, 'seq_end': pdb_chain_row.end} for pdb_chain_row in pdb_row.chains]
-                pdb_data.append({'pdbid': pdb_row.pdbid, 'pdbchains': pdbchain_data})
+            for pdb_row in models.PDBEntry.query.filter_by(db_entry_id=summary.db_entry_id):
+                pdbchain_data = [{'chainid': pdb_chain_row.chain_id, 'domainid': pdb_chain_row.uniprot_domain_id, 'seq_begin': pdb_chain_row.begin, 'seq_end': pdb_chain_row.end} for pdb_chain_row in pdb_row.chains]
+                pdb_data.append({'pdbid': pdb_row.pdb_id, 'pdbchains': pdbchain_data})
 
             target_obj['pdbs'] = pdb_data
 
@@ -235,6 +219,124 @@ def query_db():
     return response
 
 
+def build_search_query(frontend_query_string, safe_crawl_number):
+    """
+    Converts a /search query string to a query on the DBEntrySummary table. Frontend fields
+    (see models.frontend2backend_mappings) stored in DBEntrySummary are replaced with its
+    columns; the tables of other fields are joined on db_entry_id.
+
+    >>> build_search_query('family="TK" AND npubs>0', 0)
+    """
+    field_regex = re.compile(
+        r'\b({0})\b'.format('|'.join(models.frontend2backend_mappings.keys()))
+    )
+    summary_table_name = models.DBEntrySummary.__tablename__
+    query_tables = set()
+
+    def replace_field(match):
+        frontend_field_name = match.group(1)
+        if frontend_field_name in models.frontend2summary_mappings:
+            return '{0}.{1}'.format(
+                summary_table_name, models.frontend2summary_mappings[frontend_field_name]
+            )
+        query_table_name, column_name = models.frontend2backend_mappings[frontend_field_name]
+        query_table = getattr(models, query_table_name)
+        query_tables.add(query_table)
+        return '{0}.{1}'.format(query_table.__tablename__, column_name)
+
+    # quoted values are left as they are
+    sql_query_string = ''.join([
+        part if part[:1] in ('"', "'") else field_regex.sub(replace_field, part)
+        for part in re.split(r'("[^"]*"|\'[^\']*\')', frontend_query_string)
+    ])
+
+    query = models.DBEntrySummary.query.filter_by(crawl_number=safe_crawl_number)
+    for query_table in query_tables:
+        query = query.join(
+            query_table, models.DBEntrySummary.db_entry_id == query_table.db_entry_id
+        )
+    if len(query_tables) > 0:
+        query = query.distinct()
+    return query.filter(db.text(sql_query_string)).order_by(models.DBEntrySummary.id)
+
+
+# ======
+# Full-text search over UniProt annotations
+# ======
+
+# Ranked by relevance (bm25), using the FTS5 index built for the safe crawl snapshot by
+# DoraCommit.py. The query uses the FTS5 query syntax, with the columns recommended_name,
+# functions, disease_associations and subcellular_locations.
+
+# Examples:
+# http://.../[DB_NAME]DBAPI/fulltext?query=leukemia
+# http://.../[DB_NAME]DBAPI/fulltext?query=disease_associations:leukemia&limit=20
+# (limit: default 100, at most fulltext_max_limit in project_config.yaml, default 1000)
+# http://.../[DB_NAME]DBAPI/fulltext?query="cell migration" AND membrane
+
+@app.route('/%s/fulltext' % dbapi_name, methods=['GET'])
+@crossdomain(origin='*', headers=["Origin", "X-Requested-With", "Content-Type", "Accept"])
+def fulltext_search():
+    fulltext_query_string = request.args.get('query')
+    if not fulltext_query_string:
+        abort(400)
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        limit = None
+    if limit is None or not 1 <= limit <= fulltext_max_limit:
+        return make_response(jsonify({
+            'error': 'Invalid limit',
+            'message': 'limit must be an integer from 1 to {0}'.format(fulltext_max_limit),
+        }), 400)
+
+    crawldata = models.CrawlData.query.first()
+    safe_crawl_number = crawldata.safe_crawl_number
+
+    if not db.engine.has_table(fulltext_table_name):
+        return make_response(jsonify({
+            'error': 'Full-text index not available',
+            'message': 'The full-text index is only built for the safe crawl snapshot',
+        }), 501)
+
+    try:
+        results = db.session.execute(
+            db.text(
+                'SELECT summary.ac, summary.entry_name, summary.family, '
+                '-bm25({0}) AS score, '
+                "snippet({0}, -1, '[', ']', '...', 16) AS snippet "
+                'FROM {0} JOIN db_entry_summaries AS summary '
+                'ON summary.db_entry_id = {0}.rowid '
+                'WHERE {0} MATCH :query AND summary.crawl_number = :crawl_number '
+                'ORDER BY bm25({0}) LIMIT :limit'.format(fulltext_table_name)
+            ),
+            {'query': fulltext_query_string, 'crawl_number': safe_crawl_number, 'limit': limit}
+        ).fetchall()
+    except OperationalError as e:
+        db.session.rollback()
+        return make_response(jsonify({
+            'error': 'Invalid full-text query',
+            'message': str(e.orig),
+        }), 400)
+
+    results_obj = {
+        'results': [
+            {
+                'ac': ac,
+                'entry_name': entry_name,
+                'family': family,
+                'score': score,
+                'snippet': snippet,
+            }
+            for ac, entry_name, family, score, snippet in results
+        ]
+    }
+
+    # = Return data in JSON format =
+    response = make_response(jsonify(results_obj))
+    return response
+
+
 # ======
 # error handlers
 # ======
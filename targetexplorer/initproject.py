@@ -5,6 +5,7 @@ import targetexplorer
 from targetexplorer.utils import get_installed_resource_filepath
 from targetexplorer.core import write_yaml_file, logger, project_config_filename, database_filename
 from targetexplorer.core import external_data_dirpath, wsgi_filename, manual_overrides_filename
+from targetexplorer.sqlite_profiles import default_sqlite_profiles
 
 
 class InitProject(object):
@@ -12,9 +13,18 @@ class InitProject(object):
                  uniprot_query='EXAMPLE... mnemonic:ABL1_HUMAN',
                  uniprot_domain_regex='EXAMPLE... ^Protein kinase(?!; truncated)(?!; inactive)',
                  ncrawls_to_save=5,
+                 sqlalchemy_database_uri=None,
                  run_main=True
                  ):
+        """
+        Parameters
+        ----------
+        sqlalchemy_database_uri: str or None
+            e.g. postgresql://user@host/dbname for a PostgreSQL database, which must already
+            exist. default: SQLite file database.db in the project directory
+        """
         self.db_name = db_name
+        self.sqlalchemy_database_uri = sqlalchemy_database_uri
         self.project_path = os.getcwd() if project_path is None else project_path
         self.uniprot_query = uniprot_query
         self.uniprot_domain_regex = uniprot_domain_regex
@@ -33,7 +43,10 @@ class InitProject(object):
         self.targetexplorer_install_dir = os.path.abspath(
             os.path.dirname(targetexplorer.__file__)
         )
-        self.sqlalchemy_database_uri = 'sqlite:///' + os.path.join(self.project_path, database_filename)
+        if self.sqlalchemy_database_uri is None:
+            self.sqlalchemy_database_uri = 'sqlite:///' + os.path.join(
+                self.project_path, database_filename
+            )
 
     def mk_project_dirs(self):
         if not os.path.exists(external_data_dirpath):
@@ -44,11 +57,15 @@ class InitProject(object):
             config_data = {
                 'db_name': self.db_name,
                 'sqlalchemy_database_uri': self.sqlalchemy_database_uri,
+                'sqlalchemy_pool_size': 5,
+                'sqlalchemy_max_overflow': 10,
+                'sqlalchemy_pool_recycle': 3600,
                 'dbapi_name': self.db_name + 'DBAPI',
                 'ncrawls_to_save': self.ncrawls_to_save,
                 'uniprot_query': self.uniprot_query,
                 'uniprot_domain_regex': self.uniprot_domain_regex,
                 'ignore_uniprot_pdbs': None,
+                'sqlite_profiles': default_sqlite_profiles,
             }
             write_yaml_file(config_data, project_config_filename)
 
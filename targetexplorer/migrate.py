@@ -0,0 +1,132 @@
+from sqlalchemy.schema import CreateColumn
+from targetexplorer.flaskapp import db
+from targetexplorer.core import logger
+
+
+class SchemaMigrationError(Exception):
+    pass
+
+
+def add_missing_columns(engine=None):
+    """
+    Adds the columns declared in flaskapp.models which are missing from the tables of an
+    existing project database (e.g. bindingdb_bioassays.ki_value or
+    cbioportal_cases.num_in_cohort), with ALTER TABLE ... ADD COLUMN. The added columns are
+    NULL for existing rows until the corresponding gather stage is run again.
+
+    Column changes which can not be made this way - a missing column which is NOT NULL or part
+    of the primary key, or an existing column which is no longer declared (e.g. the ligand_*
+    columns of bindingdb_bioassays, whose data is now stored in bindingdb_ligands) - are not
+    migrated. In that case nothing is changed, and a SchemaMigrationError is raised; the
+    database should then be re-initialised (DoraInit.py) and the data gathered again.
+
+    Parameters
+    ----------
+    engine: sqlalchemy Engine or None
+        default: the engine of the Flask app (i.e. the project database)
+
+    Returns
+    -------
+    added_column_names: list of str
+        as 'table.column'
+    """
+    if engine is None:
+        engine = db.engine
+    inspector = db.inspect(engine)
+    existing_table_names = set(inspector.get_table_names())
+    missing_columns = []
+    unmigratable_column_changes = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_table_names:
+            # created by create_missing_indexes
+            continue
+        existing_column_names = set([column['name'] for column in inspector.get_columns(table.name)])
+        for column in table.columns:
+            if column.name in existing_column_names:
+                continue
+            if column.primary_key or (not column.nullable and column.server_default is None):
+                unmigratable_column_changes.append('{0}.{1} is missing and can not be NULL'.format(
+                    table.name, column.name
+                ))
+            else:
+                missing_columns.append(column)
+        for column_name in sorted(existing_column_names - set(table.columns.keys())):
+            unmigratable_column_changes.append('{0}.{1} is no longer declared'.format(
+                table.name, column_name
+            ))
+    if len(unmigratable_column_changes) > 0:
+        raise SchemaMigrationError(
+            'The following column changes can not be migrated: {0}. Please re-initialise the '
+            'database (DoraInit.py) and gather the data again.'.format(
+                '; '.join(unmigratable_column_changes)
+            )
+        )
+    added_column_names = []
+    for column in missing_columns:
+        column_name = '{0}.{1}'.format(column.table.name, column.name)
+        logger.info('Adding column {0}...'.format(column_name))
+        if hasattr(column.type, 'create'):
+            # e.g. a PostgreSQL ENUM type
+            column.type.create(bind=engine, checkfirst=True)
+        engine.execute('ALTER TABLE {0} ADD COLUMN {1}'.format(
+            column.table.name, CreateColumn(column).compile(dialect=engine.dialect)
+        ))
+        added_column_names.append(column_name)
+    return added_column_names
+
+
+def create_missing_indexes(engine=None, drop_undeclared_indexes=False, analyze=True):
+    """
+    Brings the indexes of an existing project database in line with those declared in
+    flaskapp.models. Missing tables are created; columns are not migrated (see
+    add_missing_columns), so indexes on columns which are missing from an existing table are
+    skipped.
+
+    Parameters
+    ----------
+    engine: sqlalchemy Engine or None
+        default: the engine of the Flask app (i.e. the project database)
+    drop_undeclared_indexes: bool
+        Also drop indexes named ix_* which are no longer declared, e.g. single-column
+        crawl_number indexes superseded by composite indexes
+    analyze: bool
+        Run ANALYZE afterwards, so that the query planner uses the new indexes
+
+    Returns
+    -------
+    created_index_names, dropped_index_names: list of str, list of str
+    """
+    if engine is None:
+        engine = db.engine
+    db.metadata.create_all(bind=engine, checkfirst=True)
+    inspector = db.inspect(engine)
+    created_index_names = []
+    dropped_index_names = []
+    for table in db.metadata.sorted_tables:
+        existing_column_names = set([column['name'] for column in inspector.get_columns(table.name)])
+        existing_index_names = set([index['name'] for index in inspector.get_indexes(table.name)])
+        declared_index_names = set([index.name for index in table.indexes])
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in existing_index_names:
+                continue
+            missing_column_names = [
+                column.name for column in index.columns if column.name not in existing_column_names
+            ]
+            if len(missing_column_names) > 0:
+                logger.warning('Skipping index {0}: columns {1} not found in table {2}'.format(
+                    index.name, ', '.join(missing_column_names), table.name
+                ))
+                continue
+            logger.info('Creating index {0}...'.format(index.name))
+            index.create(bind=engine)
+            created_index_names.append(index.name)
+        if drop_undeclared_indexes:
+            for index_name in sorted(existing_index_names - declared_index_names):
+                if not index_name.startswith('ix_'):
+                    continue
+                logger.info('Dropping index {0}...'.format(index_name))
+                engine.execute('DROP INDEX {0}'.format(index_name))
+                dropped_index_names.append(index_name)
+    if analyze:
+        engine.execute('ANALYZE')
+    return created_index_names, dropped_index_names
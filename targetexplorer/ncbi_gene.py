@@ -2,109 +2,191 @@ import urllib2
 import os
 import datetime
 from targetexplorer.flaskapp import models, db
+from targetexplorer.core import external_data_dirpath, logger
+from targetexplorer.artifacts import ArtifactCache
+from targetexplorer.bulkload import bulk_insert_mappings
 import pandas as pd
 
+ncbi_gene_data_dir = os.path.join(external_data_dirpath, 'NCBI_Gene')
+gene2pubmed_filepath = os.path.join(ncbi_gene_data_dir, 'gene2pubmed.gz')
+
 
 class GatherNCBIGene(object):
     def __init__(self,
                  use_existing_gene2pubmed=False,
+                 chunksize=1000000,
+                 use_artifact_cache=True,
                  run_main=True,
                  commit_to_db=True
                  ):
+        """
+        Parameters
+        ----------
+        use_existing_gene2pubmed: bool
+        chunksize: int
+            Number of gene2pubmed rows read at a time
+        use_artifact_cache: bool
+            Reuse the gene2pubmed rows extracted by a previous run, if the gene2pubmed file,
+            the taxa and Gene IDs in the db and the code are unchanged (see
+            artifacts.ArtifactCache)
+        run_main: bool
+        commit_to_db: bool
+        """
         self.commit_to_db = commit_to_db
+        self.use_existing_gene2pubmed = use_existing_gene2pubmed
+        self.chunksize = chunksize
+        self.use_artifact_cache = use_artifact_cache
+        self.now = datetime.datetime.utcnow()
+        db.use_sqlite_profile('gather')
+        crawldata_row = models.CrawlData.query.first()
+        self.current_crawl_number = crawldata_row.current_crawl_number
         if run_main:
-            external_data_dir = 'external-data'
-            ncbi_gene_data_dir = os.path.join(external_data_dir, 'NCBI_Gene')
-
-            if not os.path.exists(ncbi_gene_data_dir):
-                os.mkdir(ncbi_gene_data_dir)
-
-            gene2pubmed_filepath = os.path.join(ncbi_gene_data_dir, 'gene2pubmed.gz')
-
-            now = datetime.datetime.utcnow()
-
-            # get current crawl number
-            crawldata_row = models.CrawlData.query.first()
-            current_crawl_number = crawldata_row.current_crawl_number
-            print 'Current crawl number: %d' % current_crawl_number
-
-            # ==============================================================
-            # Download new gene2pubmed.gz file from NCBI Gene
-            # ==============================================================
-
-            if os.path.exists(gene2pubmed_filepath) and use_existing_gene2pubmed:
-                print 'gene2pubmed file found at:', gene2pubmed_filepath
-            else:
-                print 'Retrieving new Gene2PubMed file from NCBI server...'
-                retrieve_gene2pubmed(gene2pubmed_filepath)
-
-            print ''
-
-            # ==============================================================
-            # Extract publication data from Gene2PubMed file
-            # ==============================================================
-
-            print 'Extracting publication data from gene2pubmed file...'
-
-            # first get list of Gene IDs from the db
-            db_gene_ids = [value_tuple[0] for value_tuple in models.NCBIGeneEntry.query.filter_by(crawl_number=current_crawl_number).values(models.NCBIGeneEntry.gene_id)]
-
-            # now load the gene2pubmed file using pandas
-            # skiprows=1 -- skips first row, which is a non-tab-separated column header. Assign column names manually
-            # usecols=[1, 2] -- skips first column (taxonomy ID)
-            # the returned object is a pandas Series (squeeze=True), indexed on gene_id
-            pmids_by_gene_id = pd.read_table(gene2pubmed_filepath, compression='gzip', skiprows=1, names=['gene_id', 'pmid'], usecols=[1, 2], index_col=0, squeeze=True)
-
-            # iterate through the db Gene IDs
-            i = 0
-            # db_entry_npubs: npubs for each DBEntry, hashed by DBEntry.id
-            db_entry_npubs = {}
-            for db_gene_id in db_gene_ids:
-                # check if the db Gene ID is present in the gene2pubmed data
-                if db_gene_id in pmids_by_gene_id:
-                    # if so, get the PMIDs corresponding to that Gene ID
-                    matching_pmids = pmids_by_gene_id[pmids_by_gene_id.index == db_gene_id]
-                    # and get the matching NCBIGeneEntry object from the db
-                    db_ncbi_gene_entry = models.NCBIGeneEntry.query.filter_by(crawl_number=current_crawl_number, gene_id=db_gene_id).first()
-
-                    # initialize the npubs counter for the corresponding DBEntry, if necessary
-                    if db_ncbi_gene_entry.db_entry_id not in db_entry_npubs:
-                        db_entry_npubs[db_ncbi_gene_entry.db_entry_id] = 0
-
-                    # matching_pmids may be a single PMID (type:int) or a series of PMIDs (type:pd.Series)
-                    if type(matching_pmids) == pd.Series:
-                        db_entry_npubs[db_ncbi_gene_entry.db_entry_id] += len(matching_pmids)
-                        for pmid in matching_pmids:
-                            # create NCBIGenePublication object and add to db
-                            ncbi_gene_publication_obj = models.NCBIGenePublication(crawl_number=current_crawl_number, pmid=pmid, ncbi_gene_entry=db_ncbi_gene_entry)
-                            db.session.add(ncbi_gene_publication_obj)
-                    else:
-                        db_entry_npubs[db_ncbi_gene_entry.db_entry_id] += 1
-                        # create NCBIGenePublication object and add to db
-                        ncbi_gene_publication_obj = models.NCBIGenePublication(crawl_number=current_crawl_number, pmid=matching_pmids, ncbi_gene_entry=db_ncbi_gene_entry)
-                        db.session.add(ncbi_gene_publication_obj)
-
-                i += 1
-
-                if i % 100 == 0 or i == len(db_gene_ids):
-                    print '%d/%d Gene IDs searched' % (i, len(db_gene_ids))
-
-            for db_entry in models.DBEntry.query.filter_by(crawl_number=current_crawl_number).all():
-                if db_entry.id in db_entry_npubs:
-                    db_entry.npubs = db_entry_npubs[db_entry.id]
-                else:
-                    db_entry.npubs = 0
-
-            # ==============================================================
-            # Update db NCBI Gene datestamp
-            # ==============================================================
-
-            current_crawl_datestamp_row = models.DateStamps.query.filter_by(crawl_number=current_crawl_number).first()
-            current_crawl_datestamp_row.ncbi_gene_datestamp = now
-            if self.commit_to_db:
-                db.session.commit()
-            print 'Done.'
-
+            logger.info('Current crawl number: {0}'.format(self.current_crawl_number))
+            self.setup()
+            self.get_gene2pubmed_file()
+            self.get_ncbi_gene_entries_from_db()
+            self.get_taxon_ids_from_db()
+            logger.info('Extracting publication data from gene2pubmed file...')
+            gene2pubmed_df = self.read_gene2pubmed()
+            self.create_db_rows(gene2pubmed_df)
+            self.commit()
+
+    def setup(self):
+        if not os.path.exists(ncbi_gene_data_dir):
+            os.mkdir(ncbi_gene_data_dir)
+
+    def get_gene2pubmed_file(self):
+        if os.path.exists(gene2pubmed_filepath) and self.use_existing_gene2pubmed:
+            logger.info('gene2pubmed file found at: {0}'.format(gene2pubmed_filepath))
+        else:
+            logger.info('Retrieving new Gene2PubMed file from NCBI server...')
+            retrieve_gene2pubmed(gene2pubmed_filepath)
+
+    def get_ncbi_gene_entries_from_db(self):
+        """
+        Sets self.ncbi_gene_entries, a DataFrame of NCBIGeneEntry ids and db_entry_ids for the
+        current crawl, indexed by Gene ID. Resolved with a single query.
+        """
+        ncbi_gene_entries = pd.DataFrame(
+            db.session.query(
+                models.NCBIGeneEntry.gene_id,
+                models.NCBIGeneEntry.id,
+                models.NCBIGeneEntry.db_entry_id,
+            ).filter_by(
+                crawl_number=self.current_crawl_number
+            ).order_by(models.NCBIGeneEntry.id).all(),
+            columns=['gene_id', 'ncbi_gene_entry_id', 'db_entry_id'],
+        )
+        self.ncbi_gene_entries = ncbi_gene_entries.drop_duplicates('gene_id').set_index('gene_id')
+
+    def get_taxon_ids_from_db(self):
+        self.db_taxon_ids = set([
+            int(value_tuple[0]) for value_tuple in models.UniProtEntry.query.filter_by(
+                crawl_number=self.current_crawl_number
+            ).values(models.UniProtEntry.ncbi_taxon_id)
+            if value_tuple[0] is not None
+        ])
+
+    def read_gene2pubmed(self):
+        """
+        Returns
+        -------
+        DataFrame with columns gene_id and pmid
+            only rows for taxa and Gene IDs in the db
+        """
+        def read():
+            return read_gene2pubmed(
+                gene2pubmed_filepath, self.db_taxon_ids, self.ncbi_gene_entries.index,
+                chunksize=self.chunksize
+            )
+        if not self.use_artifact_cache:
+            return read()
+        artifact_cache = ArtifactCache('ncbi_gene')
+        key = artifact_cache.get_key(
+            [gene2pubmed_filepath],
+            params={
+                'taxon_ids': sorted(self.db_taxon_ids),
+                'gene_ids': sorted([int(gene_id) for gene_id in self.ncbi_gene_entries.index]),
+            },
+            module_names=['targetexplorer.ncbi_gene'],
+        )
+        return artifact_cache.get_or_create(key, read)
+
+    def create_db_rows(self, gene2pubmed_df):
+        matching_df = gene2pubmed_df[gene2pubmed_df.gene_id.isin(self.ncbi_gene_entries.index)]
+        matching_df = matching_df.join(self.ncbi_gene_entries, on='gene_id')
+        bulk_insert_mappings(
+            models.NCBIGenePublication,
+            [
+                {
+                    'crawl_number': self.current_crawl_number,
+                    'pmid': int(pmid),
+                    'ncbi_gene_entry_id': int(ncbi_gene_entry_id),
+                }
+                for pmid, ncbi_gene_entry_id in zip(matching_df.pmid, matching_df.ncbi_gene_entry_id)
+            ]
+        )
+        logger.info('Added {0} publications for {1}/{2} Gene IDs'.format(
+            len(matching_df), matching_df.gene_id.nunique(), len(self.ncbi_gene_entries)
+        ))
+
+        npubs_by_db_entry_id = matching_df.groupby('db_entry_id').size()
+        db_entry_ids = [
+            value_tuple[0] for value_tuple in db.session.query(models.DBEntry.id).filter_by(
+                crawl_number=self.current_crawl_number
+            )
+        ]
+        db.session.bulk_update_mappings(
+            models.DBEntry,
+            [
+                {'id': db_entry_id, 'npubs': int(npubs_by_db_entry_id.get(db_entry_id, 0))}
+                for db_entry_id in db_entry_ids
+            ]
+        )
+
+    def commit(self):
+        current_crawl_datestamp_row = models.DateStamps.query.filter_by(
+            crawl_number=self.current_crawl_number
+        ).first()
+        current_crawl_datestamp_row.ncbi_gene_datestamp = self.now
+        if self.commit_to_db:
+            db.session.commit()
+        print 'Done.'
+
+
+def read_gene2pubmed(gene2pubmed_filepath, taxon_ids, gene_ids, chunksize=1000000):
+    """
+    Streams a gzipped gene2pubmed file in chunks of chunksize rows, keeping only rows for the
+    given taxon IDs and Gene IDs, so that the whole file is never held in memory.
+
+    Parameters
+    ----------
+    gene2pubmed_filepath: str
+    taxon_ids: iterable of int
+        NCBI taxonomy IDs
+    gene_ids: iterable of int
+        NCBI Gene IDs
+    chunksize: int
+
+    Returns
+    -------
+    DataFrame with columns gene_id and pmid
+    """
+    taxon_ids = pd.Index(list(taxon_ids), dtype='int32')
+    gene_ids = pd.Index(list(gene_ids), dtype='int32')
+    matching_chunks = [pd.DataFrame({
+        'gene_id': pd.Series([], dtype='int32'), 'pmid': pd.Series([], dtype='int32')
+    })]
+    # skiprows=1 -- skips first row, which is a non-tab-separated column header. Assign column names manually
+    # Taxon IDs, Gene IDs and PMIDs all fit in 32-bit integers
+    for chunk in pd.read_csv(
+            gene2pubmed_filepath, sep='\t', compression='gzip', skiprows=1,
+            names=['taxon_id', 'gene_id', 'pmid'], dtype='int32', chunksize=chunksize
+            ):
+        chunk = chunk[chunk.taxon_id.isin(taxon_ids)]
+        chunk = chunk[chunk.gene_id.isin(gene_ids)]
+        matching_chunks.append(chunk[['gene_id', 'pmid']])
+    return pd.concat(matching_chunks, ignore_index=True)
 
 
 def retrieve_gene2pubmed(gene2pubmed_gzfilepath):
@@ -1,6 +1,12 @@
 import urllib2
 import json
+import gzip
+import time
+import socket
+import sqlite3
 import StringIO
+from multiprocessing.pool import ThreadPool
+from targetexplorer.core import logger
 
 
 def build_oncotator_search_string(
@@ -53,9 +59,148 @@ def retrieve_oncotator_mutation_data_as_json(
     return json.load(StringIO.StringIO(page))
 
 
-def retrieve_oncotator_mutation_data(search_string_query, maxreadlength=100000000):
+def retrieve_oncotator_mutation_data(search_string_query, maxreadlength=100000000,
+                                     max_retries=3, backoff=1.):
+    """
+    Failed requests are retried up to max_retries times, waiting backoff * 2**n seconds before
+    the nth retry. Client errors (HTTP 4xx) are not retried.
+    """
     base_url = 'http://www.broadinstitute.org/oncotator/mutation/{0}/'
     url_request_string = base_url.format(search_string_query)
-    response = urllib2.urlopen(url_request_string)
-    page = response.read(maxreadlength)
-    return page
+    nretries = 0
+    while True:
+        try:
+            response = urllib2.urlopen(url_request_string)
+            page = response.read(maxreadlength)
+            return page
+        except (urllib2.URLError, socket.error) as e:
+            if isinstance(e, urllib2.HTTPError) and e.code < 500:
+                raise
+            if nretries >= max_retries:
+                raise
+            time.sleep(backoff * 2**nretries)
+            nretries += 1
+
+
+def _retrieve_oncotator_mutation_data_for_pool(args):
+    search_string, max_retries, backoff = args
+    try:
+        page = retrieve_oncotator_mutation_data(
+            search_string, max_retries=max_retries, backoff=backoff
+        )
+        return search_string, json.load(StringIO.StringIO(page))
+    except Exception as e:
+        logger.warning(
+            'Oncotator retrieval failed for {0}: {1}'.format(search_string, e)
+        )
+        return search_string, None
+
+
+def retrieve_oncotator_mutation_data_concurrently(search_strings, nthreads=8,
+                                                  max_retries=3, backoff=1.):
+    """
+    Retrieves Oncotator data for many search strings, using a pool of at most nthreads
+    concurrent requests.
+
+    Parameters
+    ----------
+    search_strings: iterable of str
+        as returned by build_oncotator_search_string
+    nthreads: int
+        maximum number of concurrent requests
+    max_retries: int
+    backoff: float
+        see retrieve_oncotator_mutation_data
+
+    Returns
+    -------
+    Generator of (search_string, oncotator_data) tuples, in order of completion.
+    oncotator_data is None if the request still failed after max_retries retries.
+    """
+    pool = ThreadPool(nthreads)
+    try:
+        for result in pool.imap_unordered(
+                _retrieve_oncotator_mutation_data_for_pool,
+                ((search_string, max_retries, backoff) for search_string in search_strings)
+                ):
+            yield result
+    finally:
+        pool.terminate()
+
+
+class OncotatorCache(object):
+    """
+    Persistent store of Oncotator annotations, keyed by the search strings returned by
+    build_oncotator_search_string.
+
+    Backed by an SQLite file in WAL mode, so individual annotations can be looked up without
+    loading the whole cache, other processes can read the cache while it is being written, and
+    each annotation is committed as soon as it is added (so that results retrieved before an
+    interrupted crawl are not lost).
+
+    >>> cache = OncotatorCache('external-data/cBioPortal/oncotator-data.db')
+    >>> cache['9_133760665_133760665_G_T'] = oncotator_data
+    >>> '9_133760665_133760665_G_T' in cache
+    True
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.connection = sqlite3.connect(filepath)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS oncotator_data ('
+            'search_string TEXT PRIMARY KEY, '
+            'data TEXT NOT NULL'
+            ')'
+        )
+        self.connection.commit()
+
+    def __contains__(self, search_string):
+        row = self.connection.execute(
+            'SELECT 1 FROM oncotator_data WHERE search_string = ?', (search_string,)
+        ).fetchone()
+        return row is not None
+
+    def __getitem__(self, search_string):
+        oncotator_data = self.get(search_string)
+        if oncotator_data is None:
+            raise KeyError(search_string)
+        return oncotator_data
+
+    def __setitem__(self, search_string, oncotator_data):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO oncotator_data (search_string, data) VALUES (?, ?)',
+            (search_string, json.dumps(oncotator_data))
+        )
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM oncotator_data').fetchone()[0]
+
+    def get(self, search_string, default=None):
+        row = self.connection.execute(
+            'SELECT data FROM oncotator_data WHERE search_string = ?', (search_string,)
+        ).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def import_json_file(self, json_gz_filepath):
+        """
+        Import annotations from a gzipped JSON file of the form {search_string: oncotator_data},
+        as written by previous versions of TargetExplorer. Existing entries are kept.
+        """
+        with gzip.open(json_gz_filepath) as json_gz_file:
+            oncotator_data_by_search_string = json.load(json_gz_file)
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO oncotator_data (search_string, data) VALUES (?, ?)',
+                (
+                    (search_string, json.dumps(oncotator_data))
+                    for search_string, oncotator_data in oncotator_data_by_search_string.iteritems()
+                )
+            )
+
+    def close(self):
+        self.connection.close()
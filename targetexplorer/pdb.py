@@ -19,6 +19,7 @@ class GatherPDB(object):
             self.structure_dirs = [structure_dirs]
         else:
             self.structure_dirs = structure_dirs
+        db.use_sqlite_profile('gather')
 
         if run_main:
             self.main()
@@ -6,6 +6,11 @@
 # sys.path.insert(0, targetexplorer_install_dir)
 
 from targetexplorer.flaskapp import app
+from targetexplorer.crawls import serve_safe_crawl_snapshot
+
+# Read from the safe crawl snapshot published by DoraCommit.py, rather than the working database
+# which the gather scripts write to
+serve_safe_crawl_snapshot()
 
 if __name__ == '__main__':
     from targetexplorer.flaskapp import app, views
@@ -0,0 +1,168 @@
+import os
+import urllib
+import sqlite3
+from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import NullPool
+from targetexplorer.core import read_project_config, logger
+
+# Named sets of connection settings for the project database, selected with
+# db.use_sqlite_profile(). Settings given under sqlite_profiles in project_config.yaml are
+# merged into these, and new profiles can be added there.
+#
+# gather: bulk loading by the gather scripts. Loss of the most recent transactions on power
+# failure is acceptable, since a crawl can be re-run, and only committed crawls are published.
+# serve: API processes reading the published safe crawl snapshot, which is never modified in
+# place. immutable opens the file without locking or change detection.
+default_sqlite_profiles = {
+    'gather': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'OFF',
+            'cache_size': -262144,   # KiB, i.e. 256 MiB
+            'temp_store': 'MEMORY',
+        },
+    },
+    'serve': {
+        'immutable': True,
+        'pragmas': {
+            'query_only': 'ON',
+            'mmap_size': 268435456,
+            'cache_size': -65536,
+            'temp_store': 'MEMORY',
+        },
+    },
+}
+
+
+def get_sqlite_profiles(project_config=None):
+    """
+    Returns the default SQLite profiles, updated with those given under sqlite_profiles in the
+    project config.
+
+    Returns
+    -------
+    dict
+        {profile_name: {'immutable': bool, 'pragmas': {pragma_name: value}}}
+    """
+    if project_config is None:
+        project_config = read_project_config()
+    profiles = {}
+    for profile_name, profile in default_sqlite_profiles.iteritems():
+        profiles[profile_name] = {
+            'immutable': profile.get('immutable', False),
+            'pragmas': dict(profile['pragmas']),
+        }
+    config_profiles = project_config.get('sqlite_profiles')
+    if config_profiles is None:
+        config_profiles = {}
+    for profile_name, config_profile in config_profiles.iteritems():
+        profile = profiles.setdefault(profile_name, {'immutable': False, 'pragmas': {}})
+        if config_profile is None:
+            continue
+        if 'immutable' in config_profile:
+            profile['immutable'] = bool(config_profile['immutable'])
+        if config_profile.get('pragmas') is not None:
+            profile['pragmas'].update(config_profile['pragmas'])
+    return profiles
+
+
+def format_pragma_value(value):
+    # unquoted ON/OFF are read from YAML as booleans
+    if value is True:
+        return 'ON'
+    elif value is False:
+        return 'OFF'
+    return str(value)
+
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas):
+    for pragma_name, value in sorted(pragmas.iteritems()):
+        dbapi_connection.execute('PRAGMA {0} = {1}'.format(pragma_name, format_pragma_value(value)))
+
+
+def connect_sqlite_immutable(database_filepath):
+    """
+    Opens a SQLite file with the immutable URI parameter. Falls back to a normal connection if
+    the SQLite library was built without URI filename support, in which case the URI would be
+    taken as the name of a new file.
+    """
+    database_filepath = os.path.realpath(database_filepath)
+    uri = 'file:{0}?immutable=1'.format(urllib.pathname2url(database_filepath))
+    connection = sqlite3.connect(uri)
+    opened_filepath = connection.execute('PRAGMA database_list').fetchone()[2]
+    if os.path.realpath(opened_filepath) == database_filepath:
+        return connection
+    connection.close()
+    if os.path.exists(opened_filepath):
+        os.remove(opened_filepath)
+    logger.warning(
+        'SQLite URI filenames are not supported; opening {0} without immutable'.format(
+            database_filepath
+        )
+    )
+    return sqlite3.connect(database_filepath)
+
+
+class SQLiteProfileSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy extension which applies the selected SQLite profile (see
+    default_sqlite_profiles) to each new connection to a file-based SQLite database, via a
+    connect event listener on the engine.
+
+    File-based SQLite engines use NullPool, so a newly selected profile applies from the next
+    session onwards.
+
+    >>> db.use_sqlite_profile('gather')
+    """
+    def __init__(self, *args, **kwargs):
+        self.sqlite_profile_name = None
+        self.sqlite_profile = None
+        super(SQLiteProfileSQLAlchemy, self).__init__(*args, **kwargs)
+
+    def use_sqlite_profile(self, profile_name):
+        """
+        Parameters
+        ----------
+        profile_name: str or None
+            name of a profile in default_sqlite_profiles or project_config.yaml; None restores
+            the SQLite defaults
+        """
+        if profile_name is None:
+            profile = None
+        else:
+            profiles = get_sqlite_profiles()
+            if profile_name not in profiles:
+                raise Exception('SQLite profile not found: {0}'.format(profile_name))
+            profile = profiles[profile_name]
+        self.sqlite_profile_name = profile_name
+        self.sqlite_profile = profile
+        # sessions are bound to a connection when first used
+        self.session.remove()
+
+    def apply_driver_hacks(self, app, info, options):
+        super(SQLiteProfileSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if info.drivername == 'sqlite' and info.database not in (None, '', ':memory:'):
+            # the pool settings in the project config are for server databases; file-based
+            # SQLite opens a new connection for each session
+            for option_name in ['pool_size', 'pool_timeout', 'pool_recycle', 'max_overflow']:
+                options.pop(option_name, None)
+            options['poolclass'] = NullPool
+            database_filepath = info.database
+            options['creator'] = lambda: self.connect_sqlite(database_filepath)
+
+    def connect_sqlite(self, database_filepath):
+        if self.sqlite_profile is not None and self.sqlite_profile['immutable']:
+            return connect_sqlite_immutable(database_filepath)
+        return sqlite3.connect(database_filepath)
+
+    def get_engine(self, app, bind=None):
+        engine = super(SQLiteProfileSQLAlchemy, self).get_engine(app, bind=bind)
+        if engine.dialect.name == 'sqlite' and not event.contains(
+                engine, 'connect', self.on_connect):
+            event.listen(engine, 'connect', self.on_connect)
+        return engine
+
+    def on_connect(self, dbapi_connection, connection_record):
+        if self.sqlite_profile is not None:
+            apply_sqlite_pragmas(dbapi_connection, self.sqlite_profile['pragmas'])
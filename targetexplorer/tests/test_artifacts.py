@@ -0,0 +1,77 @@
+import os
+from targetexplorer.flaskapp import models, db
+from targetexplorer.tests.utils import projecttest_context
+from targetexplorer.artifacts import ArtifactCache
+from targetexplorer import bindingdb
+from targetexplorer.bindingdb import GatherBindingDB
+from nose.plugins.attrib import attr
+
+
+@attr('unit')
+def test_artifact_cache():
+    with projecttest_context(set_up_project_stage='init') as temp_dir:
+        artifacts_dirpath = os.path.join(temp_dir, 'test-artifacts')
+        input_filepath = os.path.join(temp_dir, 'test-artifact-input.txt')
+        with open(input_filepath, 'w') as input_file:
+            input_file.write('a\n')
+        cache = ArtifactCache('test', dirpath=artifacts_dirpath, max_artifacts=1)
+
+        key = cache.get_key([input_filepath], params={'ids': [1, 2]}, module_names=['targetexplorer.artifacts'])
+        assert key == cache.get_key([input_filepath], params={'ids': [1, 2]}, module_names=['targetexplorer.artifacts'])
+        assert key != cache.get_key([input_filepath], params={'ids': [1]}, module_names=['targetexplorer.artifacts'])
+        assert cache.get(key) is None
+
+        ncalls = []
+        def create():
+            ncalls.append(1)
+            return {'P00519': [{'Kd': '12'}]}
+        assert cache.get_or_create(key, create) == {'P00519': [{'Kd': '12'}]}
+        assert cache.get_or_create(key, create) == {'P00519': [{'Kd': '12'}]}
+        assert len(ncalls) == 1
+
+        # changing the input file changes the key, and the old artifact is removed
+        with open(input_filepath, 'w') as input_file:
+            input_file.write('bc\n')
+        new_key = cache.get_key([input_filepath], params={'ids': [1, 2]}, module_names=['targetexplorer.artifacts'])
+        assert new_key != key
+        cache.store(new_key, [])
+        assert cache.get(new_key) == []
+        assert cache.get(key) is None
+
+        # file hashes are kept per stage
+        other_cache = ArtifactCache('other_test', dirpath=artifacts_dirpath)
+        other_cache.hash_input_file(input_filepath)
+        assert cache.file_hashes_filepath != other_cache.file_hashes_filepath
+        assert cache._read_file_hashes() == other_cache._read_file_hashes()
+        assert os.path.dirname(other_cache.file_hashes_filepath) == other_cache.stage_dirpath
+
+
+@attr('unit')
+def test_gather_bindingdb_with_artifact_cache():
+    with projecttest_context(set_up_project_stage='uniprot'):
+        GatherBindingDB(use_existing_bindingdb_data=True)
+        nbioassays = models.BindingDBBioassay.query.count()
+        assert len(os.listdir(os.path.join('external-data', 'artifacts', 'bindingdb'))) >= 1
+        def delete_bindingdb_rows():
+            models.BindingDBBioassay.query.delete()
+            models.BindingDBLigand.query.delete()
+            db.session.commit()
+        delete_bindingdb_rows()
+
+        # the second run must be served from the cache, without extracting the data again
+        extract_calls = []
+        extract_bindingdb_data = bindingdb.extract_bindingdb_data
+        def counting_extract_bindingdb_data(*args, **kwargs):
+            extract_calls.append(args)
+            return extract_bindingdb_data(*args, **kwargs)
+        bindingdb.extract_bindingdb_data = counting_extract_bindingdb_data
+        try:
+            GatherBindingDB(use_existing_bindingdb_data=True)
+            assert len(extract_calls) == 0
+            assert models.BindingDBBioassay.query.count() == nbioassays
+            delete_bindingdb_rows()
+            GatherBindingDB(use_existing_bindingdb_data=True, use_artifact_cache=False)
+            assert len(extract_calls) == 1
+        finally:
+            bindingdb.extract_bindingdb_data = extract_bindingdb_data
+        assert models.BindingDBBioassay.query.count() == nbioassays
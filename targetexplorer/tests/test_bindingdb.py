@@ -1,6 +1,12 @@
 from targetexplorer.flaskapp import models
 from targetexplorer.tests.utils import projecttest_context
-from targetexplorer.bindingdb import GatherBindingDB
+import os
+import gzip
+import zipfile
+from targetexplorer.bindingdb import GatherBindingDB, extract_bindingdb_data
+from targetexplorer.bindingdb import plan_line_aligned_byte_ranges, BindingDBIndex
+from targetexplorer.bindingdb import get_bgzf_filepath, parse_bindingdb_measurement
+from targetexplorer.utils import get_installed_resource_filepath
 from nose.plugins.attrib import attr
 
 
@@ -12,6 +18,149 @@ def test_gather_bindingdb():
         assert isinstance(first_bioassay_row, models.BindingDBBioassay)
         assert first_bioassay_row.target_name == 'ABL1'
 
+        for bioassay_row in models.BindingDBBioassay.query.all():
+            if bioassay_row.kd_value is None:
+                assert parse_bindingdb_measurement(bioassay_row.kd) == (None, None)
+            else:
+                assert bioassay_row.kd_qualifier in ['=', '<', '>']
+        db_entry_ids = models.BindingDBBioassay.query.filter(
+            models.BindingDBBioassay.kd_value < 100,
+            models.BindingDBBioassay.kd_qualifier != '>',
+        ).values(models.BindingDBBioassay.db_entry_id)
+        assert len(set(db_entry_ids)) == 1
+
+        for db_entry_row in models.DBEntry.query.all():
+            nbioassays = models.BindingDBBioassay.query.filter_by(db_entry=db_entry_row).count()
+            if nbioassays == 0:
+                assert db_entry_row.nbioassays is None
+            else:
+                assert db_entry_row.nbioassays == nbioassays
+
+        ligand_rows = models.BindingDBLigand.query.all()
+        assert len(ligand_rows) > 0
+        assert len(set([ligand_row.bindingdb_id for ligand_row in ligand_rows])) == len(ligand_rows)
+        assert models.BindingDBBioassay.query.filter_by(ligand_id=None).count() == 0
+        ligand_row = first_bioassay_row.ligand
+        assert isinstance(ligand_row, models.BindingDBLigand)
+        assert ligand_row.smiles_string != ''
+        assert first_bioassay_row in ligand_row.bioassays.all()
+
+
+@attr('unit')
+def test_gather_bindingdb_twice_in_same_crawl():
+    with projecttest_context(set_up_project_stage='uniprot'):
+        GatherBindingDB(use_existing_bindingdb_data=True)
+        nbioassays = models.BindingDBBioassay.query.count()
+        nligands = models.BindingDBLigand.query.count()
+        nbioassays_by_db_entry = dict(models.DBEntry.query.values(
+            models.DBEntry.id, models.DBEntry.nbioassays
+        ))
+        GatherBindingDB(use_existing_bindingdb_data=True)
+        assert models.BindingDBBioassay.query.count() == nbioassays
+        assert models.BindingDBLigand.query.count() == nligands
+        assert dict(models.DBEntry.query.values(
+            models.DBEntry.id, models.DBEntry.nbioassays
+        )) == nbioassays_by_db_entry
+        assert models.BindingDBBioassay.query.filter_by(ligand_id=None).count() == 0
+
+
+@attr('unit')
+def test_parse_bindingdb_measurement():
+    assert parse_bindingdb_measurement(' 12.5') == (12.5, '=')
+    assert parse_bindingdb_measurement('>10000') == (10000., '>')
+    assert parse_bindingdb_measurement('<0.1') == (0.1, '<')
+    assert parse_bindingdb_measurement('  1.23e+4') == (12300., '=')
+    assert parse_bindingdb_measurement(' 3E5') == (300000., '=')
+    assert parse_bindingdb_measurement('') == (None, None)
+    assert parse_bindingdb_measurement('n/a') == (None, None)
+
+
+@attr('unit')
+def test_extract_bindingdb_data_in_chunks():
+    with projecttest_context(set_up_project_stage='init') as temp_dir:
+        bindingdb_data_filepath = os.path.join(temp_dir, 'BindingDB_All.tab')
+        with gzip.open(get_installed_resource_filepath(
+                os.path.join('resources', 'BindingDB-abl1.tab.gz')
+                )) as bindingdb_ref_file:
+            with open(bindingdb_data_filepath, 'w') as bindingdb_data_file:
+                bindingdb_data_file.write(bindingdb_ref_file.read())
+
+        byte_ranges = plan_line_aligned_byte_ranges(bindingdb_data_filepath, 10000)
+        assert len(byte_ranges) > 1
+        assert byte_ranges[-1][1] == os.path.getsize(bindingdb_data_filepath)
+        with open(bindingdb_data_filepath) as bindingdb_data_file:
+            for start, end in byte_ranges:
+                bindingdb_data_file.seek(start - 1)
+                assert bindingdb_data_file.read(1) == '\n'
+
+        single_chunk_data = extract_bindingdb_data(
+            bindingdb_data_filepath, ['P00519'], use_index=False
+        )
+        assert len(single_chunk_data['P00519']) > 0
+        chunked_data = extract_bindingdb_data(
+            bindingdb_data_filepath, ['P00519'], nprocesses=2, chunksize=10000, use_index=False
+        )
+        assert chunked_data == single_chunk_data
+
+        bindingdb_archive_filepath = os.path.join(temp_dir, 'BindingDB_All.tsv.zip')
+        with zipfile.ZipFile(bindingdb_archive_filepath, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.write(bindingdb_data_filepath, 'BindingDB_All.tsv')
+        archive_data = extract_bindingdb_data(
+            bindingdb_archive_filepath, ['P00519'], use_index=False
+        )
+        assert archive_data == single_chunk_data
+
+
+@attr('unit')
+def test_bindingdb_index():
+    with projecttest_context(set_up_project_stage='init') as temp_dir:
+        bindingdb_data_filepath = os.path.join(temp_dir, 'BindingDB_All.tab')
+        with gzip.open(get_installed_resource_filepath(
+                os.path.join('resources', 'BindingDB-abl1.tab.gz')
+                )) as bindingdb_ref_file:
+            with open(bindingdb_data_filepath, 'w') as bindingdb_data_file:
+                bindingdb_data_file.write(bindingdb_ref_file.read())
+        scanned_data = extract_bindingdb_data(
+            bindingdb_data_filepath, ['P00519', 'P00000'], use_index=False
+        )
+
+        bindingdb_index = BindingDBIndex(bindingdb_data_filepath)
+        assert not bindingdb_index.is_current()
+        indexed_data = extract_bindingdb_data(
+            bindingdb_data_filepath, ['P00519', 'P00000'], nprocesses=2, chunksize=10000
+        )
+        assert bindingdb_index.is_current()
+        assert indexed_data == scanned_data
+        assert bindingdb_index.extract_bindingdb_data(['P00000']) == {}
+
+        # archives are converted to BGZF files, which are indexed by virtual offset
+        bindingdb_archive_filepath = os.path.join(temp_dir, 'BindingDB_All.tsv.zip')
+        with zipfile.ZipFile(bindingdb_archive_filepath, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.write(bindingdb_data_filepath, 'BindingDB_All.tsv')
+        archive_data = extract_bindingdb_data(bindingdb_archive_filepath, ['P00519'])
+        assert archive_data == scanned_data
+        bgzf_filepath = get_bgzf_filepath(bindingdb_archive_filepath)
+        assert os.path.exists(bindingdb_archive_filepath)
+        assert BindingDBIndex(bgzf_filepath, source_filepath=bindingdb_archive_filepath).is_current()
+        assert BindingDBIndex(bgzf_filepath).is_current()
+        assert extract_bindingdb_data(bgzf_filepath, ['P00519']) == scanned_data
+        os.remove(BindingDBIndex(bgzf_filepath).index_filepath)
+        assert extract_bindingdb_data(bgzf_filepath, ['P00519']) == scanned_data
+        assert extract_bindingdb_data(bgzf_filepath, ['P00519'], use_index=False) == scanned_data
+
+        # a re-downloaded archive is converted again
+        with open(bindingdb_data_filepath) as bindingdb_data_file:
+            lines = bindingdb_data_file.readlines()
+        for ki, mtime in [('111', 1000000000), ('999', 1000000100)]:
+            words = lines[2].split('\t')
+            words[22] = ki
+            lines[2] = '\t'.join(words)
+            with zipfile.ZipFile(bindingdb_archive_filepath, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('BindingDB_All.tsv', ''.join(lines))
+            os.utime(bindingdb_archive_filepath, (mtime, mtime))
+            archive_data = extract_bindingdb_data(bindingdb_archive_filepath, ['P00519'])
+            assert archive_data['P00519'][0]['Ki'] == ki
+
 
 @attr('network')
 @attr('slow')
@@ -0,0 +1,72 @@
+import os
+import datetime
+from nose import SkipTest
+from targetexplorer.flaskapp import app, db, models
+from targetexplorer.tests.utils import projecttest_context
+from targetexplorer.bulkload import bulk_insert_mappings, format_copy_row, CopyRowStream
+from nose.plugins.attrib import attr
+
+# e.g. postgresql://localhost/targetexplorer_test; the tables are dropped afterwards
+test_postgres_uri_env_var = 'TARGETEXPLORER_TEST_POSTGRES_URI'
+
+test_mappings = [
+    {
+        'crawl_number': 0, 'pmid': 12345, 'doi': u'10.1021/jm\xe9\t1\\2\n',
+        'kd_value': 0.1, 'temperature': None,
+    },
+    {'crawl_number': 0, 'pmid': None, 'doi': ''},
+]
+
+
+@attr('unit')
+def test_format_copy_row():
+    assert format_copy_row(
+        test_mappings[0], ['crawl_number', 'pmid', 'doi', 'kd_value', 'temperature']
+    ) == '0\t12345\t10.1021/jm\xc3\xa9\\t1\\\\2\\n\t0.1\t\\N\n'
+    assert format_copy_row(
+        {'is_pseudodomain': False, 'date': datetime.datetime(2015, 1, 2, 3, 4, 5)},
+        ['is_pseudodomain', 'date', 'missing']
+    ) == 'f\t2015-01-02 03:04:05\t\\N\n'
+
+    stream = CopyRowStream(test_mappings * 1000, ['crawl_number', 'pmid'])
+    chunks = []
+    chunk = stream.read(8192)
+    while chunk != '':
+        assert len(chunk) <= 8192
+        chunks.append(chunk)
+        chunk = stream.read(8192)
+    assert ''.join(chunks) == '0\t12345\n0\t\\N\n' * 1000
+
+
+@attr('unit')
+def test_bulk_insert_mappings_sqlite():
+    with projecttest_context(set_up_project_stage='init'):
+        bulk_insert_mappings(models.BindingDBBioassay, test_mappings)
+        db.session.commit()
+        bioassays = models.BindingDBBioassay.query.order_by(models.BindingDBBioassay.id).all()
+        assert [bioassay.doi for bioassay in bioassays] == [test_mappings[0]['doi'], '']
+        assert bioassays[1].pmid is None
+
+
+@attr('unit')
+def test_bulk_insert_mappings_postgres():
+    postgres_uri = os.environ.get(test_postgres_uri_env_var)
+    if postgres_uri is None:
+        raise SkipTest('Set {0} to test against a PostgreSQL database'.format(
+            test_postgres_uri_env_var
+        ))
+    working_database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    app.config.update(SQLALCHEMY_DATABASE_URI=postgres_uri)
+    db.session.remove()
+    try:
+        db.create_all()
+        bulk_insert_mappings(models.BindingDBBioassay, test_mappings)
+        db.session.commit()
+        bioassays = models.BindingDBBioassay.query.order_by(models.BindingDBBioassay.id).all()
+        assert [bioassay.doi for bioassay in bioassays] == [test_mappings[0]['doi'], '']
+        assert bioassays[0].kd_value == 0.1
+        assert bioassays[1].pmid is None
+    finally:
+        db.session.remove()
+        db.drop_all()
+        app.config.update(SQLALCHEMY_DATABASE_URI=working_database_uri)
@@ -1,7 +1,25 @@
-from targetexplorer.flaskapp import models
+from targetexplorer.flaskapp import models, db
+import os
 from targetexplorer.tests.utils import projecttest_context
+from targetexplorer.tests.test_variant_annotation import write_reference_files
 from targetexplorer.cbioportal import GatherCbioportalData, retrieve_extended_mutation_datatxt
-from targetexplorer.oncotator import retrieve_oncotator_mutation_data_as_json
+from targetexplorer.cbioportal import external_oncotator_data_filepath, AddCbioportalMAFData
+from targetexplorer.cbioportal import iter_completed_study_nodes, plan_gene_list_chunks
+from targetexplorer.cbioportal import StudyDataCache, calculate_study_fingerprint
+from targetexplorer.cbioportal import calculate_mutation_frequencies, retrieve_mutants_xml
+from targetexplorer import cbioportal
+from lxml import etree
+from targetexplorer.oncotator import retrieve_oncotator_mutation_data_as_json, OncotatorCache
+from targetexplorer.oncotator import retrieve_oncotator_mutation_data_concurrently
+from targetexplorer.oncotator import retrieve_oncotator_mutation_data
+from targetexplorer import oncotator
+import re
+import gzip
+import itertools
+import json
+import urllib2
+import StringIO
+from targetexplorer.utils import get_installed_resource_filepath
 from nose.plugins.attrib import attr
 from nose.plugins.skip import SkipTest
 
@@ -18,6 +36,273 @@ def test_retrieve_oncotator_mutation_data_as_json():
     assert oncotator_result.get('transcript_id') == 'ENST00000275493.2'
 
 
+@attr('network')
+def test_retrieve_oncotator_mutation_data_concurrently():
+    search_strings = ['7_55259515_55259515_T_G', '9_133760665_133760665_G_T']
+    results = dict(retrieve_oncotator_mutation_data_concurrently(search_strings, nthreads=2))
+    assert set(results.keys()) == set(search_strings)
+    assert results['7_55259515_55259515_T_G'].get('transcript_id') == 'ENST00000275493.2'
+
+
+@attr('unit')
+def test_oncotator_retries():
+    oncotator_data = {'transcript_id': 'ENST00000318560.5'}
+    failing_search_string = '9_1_1_G_T'
+    requested_urls = []
+    sleeps = []
+
+    def urlopen(url):
+        requested_urls.append(url)
+        # all mutations at chromosome 9 position 1
+        if '/9_1_' in url:
+            raise urllib2.URLError('connection refused')
+        if len(requested_urls) <= 2:
+            raise urllib2.HTTPError(url, 503, 'Service Unavailable', None, None)
+        return StringIO.StringIO(json.dumps(oncotator_data))
+
+    def urlopen_not_found(url):
+        requested_urls.append(url)
+        raise urllib2.HTTPError(url, 404, 'Not Found', None, None)
+
+    urlopen_ref = urllib2.urlopen
+    sleep_ref = oncotator.time.sleep
+    oncotator.time.sleep = sleeps.append
+    try:
+        urllib2.urlopen = urlopen
+        # server errors are retried with exponential backoff
+        page = retrieve_oncotator_mutation_data('7_55259515_55259515_T_G', backoff=0.5)
+        assert json.loads(page) == oncotator_data
+        assert len(requested_urls) == 3
+        assert sleeps == [0.5, 1.]
+
+        # client errors are not retried
+        urllib2.urlopen = urlopen_not_found
+        requested_urls[:] = []
+        try:
+            retrieve_oncotator_mutation_data('7_55259515_55259515_T_G')
+            assert False
+        except urllib2.HTTPError as e:
+            assert e.code == 404
+        assert len(requested_urls) == 1
+
+        # failures after max_retries are returned as None
+        urllib2.urlopen = urlopen
+        requested_urls[:] = []
+        results = dict(retrieve_oncotator_mutation_data_concurrently(
+            [failing_search_string, '7_55259515_55259515_T_G'], nthreads=2, max_retries=2
+        ))
+        assert results == {failing_search_string: None, '7_55259515_55259515_T_G': oncotator_data}
+        assert len([url for url in requested_urls if failing_search_string in url]) == 3
+
+        # and are not requested again when the mutation data is extracted
+        with projecttest_context(set_up_project_stage='uniprot'):
+            gather = GatherCbioportalData(run_main=False)
+            gather.xmltree = etree.fromstring(
+                '<CBPmuts><gene><case study="study_a">'
+                '<mutation mutation_type="Missense_Mutation" chromosome_index="9" '
+                'chromosome_startpos="1" chromosome_endpos="1" reference_allele="G" '
+                'variant_allele="T"/>'
+                '</case></gene></CBPmuts>'
+            ).getroottree()
+            gather.retrieve_oncotator_data()
+            nrequests = len(requested_urls)
+            assert gather.get_oncotator_data(9, 1, 1, 'G', 'T') is None
+            assert len(requested_urls) == nrequests
+
+            # mutations which were not retrieved beforehand are requested once
+            assert gather.get_oncotator_data(9, 1, 2, 'G', 'T') is None
+            assert gather.get_oncotator_data(9, 1, 2, 'G', 'T') is None
+            assert len(requested_urls) == nrequests + 4
+            gather.oncotator_cache.close()
+    finally:
+        urllib2.urlopen = urlopen_ref
+        oncotator.time.sleep = sleep_ref
+
+
+@attr('unit')
+def test_iter_completed_study_nodes():
+    partial_xml = (
+        '<CBPmuts>\n'
+        '<study study_id="study_a">\n'
+        '  <gene gene_symbol="ABL1">\n'
+        '    <case source="cBioPortal" study="study_a" case_id="case_1">\n'
+        '      <mutation mutation_type="Missense_Mutation" aa_change="T315I"/>\n'
+        '    </case>\n'
+        '  </gene>\n'
+        '</study>\n'
+        '<study study_id="study_b">\n'
+        '  <gene gene_symbol="ABL1">\n'
+        '    <case source="cBioPortal" study="study_b" case_id="case_2">\n'
+    )
+    with projecttest_context(set_up_project_stage='init'):
+        partial_xml_filepath = 'cbioportal-mutations.xml.partial'
+        with open(partial_xml_filepath, 'w') as partial_xml_file:
+            partial_xml_file.write(partial_xml)
+        # study nodes are cleared once the next one is parsed, so read them while iterating
+        aa_changes_by_study_id = {
+            study_node.get('study_id'): study_node.find('gene/case/mutation').get('aa_change')
+            for study_node in iter_completed_study_nodes(partial_xml_filepath, ['study_a'])
+        }
+        assert aa_changes_by_study_id == {'study_a': 'T315I'}
+
+
+@attr('unit')
+def test_retrieve_mutants_xml_interrupted_resume():
+    built_studies = []
+    def build_study_mutants_xml(cancer_study, gene_ids, **kwargs):
+        built_studies.append(cancer_study)
+        if cancer_study == 'study_c' and len(built_studies) == 3:
+            raise KeyboardInterrupt
+        study_node = etree.Element('study')
+        study_node.set('study_id', cancer_study)
+        return study_node
+
+    def interrupted_iter_completed_study_nodes(partial_xml_filepath, completed_studies):
+        for study_node in iter_completed_study_nodes(partial_xml_filepath, completed_studies):
+            yield study_node
+            raise KeyboardInterrupt
+
+    cancer_studies = ['study_a', 'study_b', 'study_c']
+    original_functions = cbioportal.build_study_mutants_xml, cbioportal.iter_completed_study_nodes
+    with projecttest_context(set_up_project_stage='init'):
+        output_xml_filepath = 'cbioportal-mutations.xml'
+        cbioportal.build_study_mutants_xml = build_study_mutants_xml
+        try:
+            # interrupted while retrieving study_c
+            try:
+                retrieve_mutants_xml(output_xml_filepath, cancer_studies, [], resume=True)
+            except KeyboardInterrupt:
+                pass
+            # interrupted while copying the completed studies
+            cbioportal.iter_completed_study_nodes = interrupted_iter_completed_study_nodes
+            try:
+                retrieve_mutants_xml(output_xml_filepath, cancer_studies, [], resume=True)
+            except KeyboardInterrupt:
+                pass
+            cbioportal.iter_completed_study_nodes = original_functions[1]
+            retrieve_mutants_xml(output_xml_filepath, cancer_studies, [], resume=True)
+        finally:
+            cbioportal.build_study_mutants_xml, cbioportal.iter_completed_study_nodes = (
+                original_functions
+            )
+        assert built_studies == ['study_a', 'study_b', 'study_c', 'study_c']
+        assert [
+            study_node.get('study_id') for study_node in etree.parse(output_xml_filepath).getroot()
+        ] == cancer_studies
+        assert [
+            filename for filename in os.listdir('.') if filename.startswith(output_xml_filepath)
+        ] == [output_xml_filepath]
+        os.remove(output_xml_filepath)
+
+
+@attr('unit')
+def test_plan_gene_list_chunks():
+    gene_ids = ['ABL1', 'EGFR', 'SRC', 'BRAF', 'MAPK1']
+    chunks = plan_gene_list_chunks(gene_ids, 100, max_url_length=110, max_genes_per_request=10)
+    assert chunks == [['ABL1', 'EGFR'], ['SRC', 'BRAF'], ['MAPK1']]
+    for chunk in chunks:
+        assert len('+'.join(chunk)) <= 10
+    chunks = plan_gene_list_chunks(gene_ids, 100, max_url_length=2000, max_genes_per_request=2)
+    assert chunks == [['ABL1', 'EGFR'], ['SRC', 'BRAF'], ['MAPK1']]
+    assert plan_gene_list_chunks(gene_ids, 100) == [gene_ids]
+
+
+@attr('unit')
+def test_iter_webservice_lines():
+    gene_ids = ['GENE%d' % i for i in range(6)]
+    requested_gene_ids = []
+    error_gene_ids = set()
+
+    def urlopen(url):
+        gene_id = url.split('gene_list=')[1]
+        requested_gene_ids.append(gene_id)
+        if gene_id in error_gene_ids:
+            return StringIO.StringIO('Error: Problem when identifying a cancer study for the request.\n')
+        return StringIO.StringIO('# header\ncolumns\n%s\tdata\n' % gene_id)
+
+    def iter_lines():
+        return cbioportal.iter_webservice_lines(
+            'getMutationData', 'study_a_sequenced', 'study_a_mutations', gene_ids, 2,
+            nthreads=2, max_genes_per_request=1,
+        )
+
+    urlopen_ref = urllib2.urlopen
+    try:
+        urllib2.urlopen = urlopen
+        lines = iter_lines()
+        assert list(itertools.islice(lines, 3)) == ['# header', 'columns', 'GENE0\tdata']
+        # only a window of nthreads chunks is requested ahead of the lines yielded
+        assert len(requested_gene_ids) <= 3
+        assert list(lines) == ['GENE%d\tdata' % i for i in range(1, 6)]
+        assert sorted(requested_gene_ids) == gene_ids
+
+        # an error for the first chunk is yielded unchanged; for later chunks it raises
+        error_gene_ids.add('GENE0')
+        assert list(iter_lines()) == ['Error: Problem when identifying a cancer study for the request.']
+        error_gene_ids.clear()
+        error_gene_ids.add('GENE3')
+        try:
+            list(iter_lines())
+            assert False
+        except Exception as e:
+            assert 'chunk 4 of 6' in str(e)
+    finally:
+        urllib2.urlopen = urlopen_ref
+
+
+@attr('unit')
+def test_build_study_mutants_xml_streamed():
+    responses = {
+        'getMutationData': (
+            '# header\n'
+            'entrez_gene_id\tgene_symbol\tcase_id\n'
+            '25\tABL1\tcase_1\tbroad.mit.edu\tSomatic\tMissense_Mutation\tNA\tF317L\tM\t\t\t\t'
+            '9\t133748283\t133748283\tC\tA\tstudy_a_mutations\n'
+        ),
+        'getProfileData': (
+            '# header\n'
+            '#\n'
+            'GENE_ID\tCOMMON\tcase_1\tcase_2\n'
+            '25\tABL1\tF317L\tNaN\n'
+        ),
+    }
+    requested_urls = []
+
+    def urlopen(url):
+        requested_urls.append(url)
+        return StringIO.StringIO(responses[url.split('cmd=')[1].split('&')[0]])
+
+    urlopen_ref = urllib2.urlopen
+    get_study_fingerprint_ref = cbioportal.get_study_fingerprint
+    try:
+        urllib2.urlopen = urlopen
+        cbioportal.get_study_fingerprint = lambda cancer_study, gene_ids: ('fingerprint', 2)
+        with projecttest_context(set_up_project_stage='init') as temp_dir:
+            study_data_cache = StudyDataCache(os.path.join(temp_dir, 'studies'))
+            study_node = cbioportal.build_study_mutants_xml(
+                'study_a', ['ABL1'], study_data_cache=study_data_cache, crawl_number=1
+            )
+            case_node = study_node.find('gene/case')
+            assert case_node.get('case_id') == 'case_1'
+            assert case_node.get('num_in_cohort') == '2'
+            assert case_node.find('mutation').get('percent_in_cohort_this_aa_change') == '50.000'
+
+            # the streamed responses are stored as they are parsed
+            assert study_data_cache.get('study_a', 'fingerprint') == tuple(
+                responses[cmd].splitlines() for cmd in ['getMutationData', 'getProfileData']
+            )
+            assert study_data_cache.read_metadata('study_a')['crawl_number'] == 1
+            nrequests = len(requested_urls)
+            cached_study_node = cbioportal.build_study_mutants_xml(
+                'study_a', ['ABL1'], study_data_cache=study_data_cache, crawl_number=2
+            )
+            assert len(requested_urls) == nrequests
+            assert etree.tostring(cached_study_node) == etree.tostring(study_node)
+    finally:
+        urllib2.urlopen = urlopen_ref
+        cbioportal.get_study_fingerprint = get_study_fingerprint_ref
+
+
 @attr('network')
 def test_retrieve_extended_mutation_datatxt():
     lines = retrieve_extended_mutation_datatxt(
@@ -28,6 +313,22 @@ def test_retrieve_extended_mutation_datatxt():
     assert len(lines) > 0
 
 
+@attr('network')
+def test_retrieve_extended_mutation_datatxt_chunked():
+    lines = retrieve_extended_mutation_datatxt(
+        'gbm_tcga_all',
+        'gbm_tcga_mutations',
+        ['EGFR', 'PTEN']
+    )
+    chunked_lines = retrieve_extended_mutation_datatxt(
+        'gbm_tcga_all',
+        'gbm_tcga_mutations',
+        ['EGFR', 'PTEN'],
+        max_genes_per_request=1,
+    )
+    assert sorted(chunked_lines) == sorted(lines)
+
+
 @attr('private_cbioportal')
 def test_retrieve_extended_mutation_datatxt_private_portal():
     """
@@ -58,6 +359,243 @@ def test_gather_cbioportal():
         assert first_mutation_in_domain_row.uniprot_domain.description == 'SH2'
 
 
+@attr('unit')
+def test_calculate_mutation_frequencies():
+    with projecttest_context(set_up_project_stage='uniprot'):
+        GatherCbioportalData(use_existing_cbioportal_data=True, use_existing_oncotator_data=True)
+        mutated_cases = {}
+        num_in_cohort_by_study = {}
+        for mutation_row in models.CbioportalMutation.query.filter(
+                models.CbioportalMutation.db_entry_id != None
+                ):
+            case_row = mutation_row.cbioportal_case
+            assert case_row.num_in_cohort is not None
+            mutated_cases.setdefault(mutation_row.db_entry_id, set()).add(case_row.id)
+            num_in_cohort_by_study[case_row.study] = case_row.num_in_cohort
+        percent_by_db_entry = calculate_mutation_frequencies()
+        assert set(percent_by_db_entry.index) == set(mutated_cases.keys())
+        for db_entry_id, case_ids in mutated_cases.items():
+            studies = set([models.CbioportalCase.query.get(case_id).study for case_id in case_ids])
+            expected = 100. * len(case_ids) / sum([num_in_cohort_by_study[study] for study in studies])
+            assert abs(percent_by_db_entry[db_entry_id] - expected) < 1e-6
+
+        missense_percent_by_domain = calculate_mutation_frequencies(
+            by='uniprot_domain', mutation_types=['Missense_Mutation']
+        )
+        assert len(missense_percent_by_domain) > 0
+        assert (missense_percent_by_domain > 0).all()
+
+
+@attr('unit')
+def test_study_data_cache():
+    with projecttest_context(set_up_project_stage='init') as temp_dir:
+        study_data_cache = StudyDataCache(os.path.join(temp_dir, 'studies'))
+        fingerprint = calculate_study_fingerprint(['case_1', 'case_2'], ['ABL1', 'EGFR'])
+        assert fingerprint == calculate_study_fingerprint(['case_2', 'case_1'], ['EGFR', 'ABL1'])
+        assert study_data_cache.get('study_a', fingerprint) is None
+        study_datatxt = (['# header', 'columns', 'mutation'], ['# header', '#', 'cases', 'gene'])
+        study_data_cache.store('study_a', fingerprint, 2, 3, *study_datatxt)
+        assert study_data_cache.get('study_a', fingerprint) == study_datatxt
+        new_fingerprint = calculate_study_fingerprint(['case_1', 'case_2', 'case_3'], ['ABL1', 'EGFR'])
+        assert study_data_cache.get('study_a', new_fingerprint) is None
+
+        # the crawl in which a version of a study was first stored is kept
+        study_data_cache.store('study_a', fingerprint, 2, 4, *study_datatxt)
+        assert study_data_cache.read_metadata('study_a')['crawl_number'] == 3
+        assert study_data_cache.get_studies_unchanged_since(3, ['study_a', 'study_b']) == ['study_a']
+        study_data_cache.store('study_a', new_fingerprint, 3, 4, *study_datatxt)
+        assert study_data_cache.get_studies_unchanged_since(3, ['study_a', 'study_b']) == []
+
+
+@attr('unit')
+def test_carry_forward_unchanged_studies():
+    with projecttest_context(set_up_project_stage='uniprot'):
+        GatherCbioportalData(use_existing_cbioportal_data=True, use_existing_oncotator_data=True)
+        current_crawl_number = models.CrawlData.query.first().current_crawl_number
+        mutation_rows = models.CbioportalMutation.query.filter_by(crawl_number=current_crawl_number)
+        nmutations = mutation_rows.count()
+        nmutations_in_domain = mutation_rows.filter_by(in_uniprot_domain=True).count()
+        assert nmutations_in_domain > 0
+        studies = set([case_row.study for case_row in models.CbioportalCase.query.all()])
+
+        # treat the extracted mutation data as belonging to the safe crawl
+        safe_crawl_number = current_crawl_number - 1
+        for table_class in [models.CbioportalCase, models.CbioportalMutation]:
+            table_class.query.update({'crawl_number': safe_crawl_number})
+
+        gather_cbioportal = GatherCbioportalData(run_main=False)
+        gather_cbioportal.safe_crawl_number = safe_crawl_number
+        gather_cbioportal.carried_forward_studies = studies
+        gather_cbioportal.carry_forward_unchanged_studies()
+        db.session.commit()
+
+        mutation_rows = models.CbioportalMutation.query.filter_by(crawl_number=current_crawl_number)
+        assert mutation_rows.count() == nmutations
+        in_domain_rows = mutation_rows.filter_by(in_uniprot_domain=True)
+        assert in_domain_rows.count() == nmutations_in_domain
+        in_domain_row = in_domain_rows.first()
+        assert in_domain_row.uniprot_domain.description == 'SH2'
+        assert in_domain_row.uniprot_domain.crawl_number == current_crawl_number
+        assert in_domain_row.db_entry.crawl_number == current_crawl_number
+        assert in_domain_row.cbioportal_case.crawl_number == current_crawl_number
+
+
+@attr('unit')
+def test_oncotator_cache():
+    with projecttest_context(set_up_project_stage='uniprot'):
+        GatherCbioportalData(use_existing_cbioportal_data=True, use_existing_oncotator_data=True)
+        assert os.path.exists(external_oncotator_data_filepath)
+        oncotator_cache = OncotatorCache(external_oncotator_data_filepath)
+        assert '9_133760665_133760665_G_T' in oncotator_cache
+        oncotator_data = oncotator_cache['9_133760665_133760665_G_T']
+        assert oncotator_data['annotation_transcript'] == 'ENST00000318560.5'
+        oncotator_cache['test'] = {'transcript_id': None}
+        oncotator_cache.close()
+        assert OncotatorCache(external_oncotator_data_filepath).get('test') == {'transcript_id': None}
+
+
+def write_abl1_reference_files(temp_dir):
+    """
+    Writes a GTF file and a CDS FASTA file for a synthetic ABL1 transcript ENST00000318560,
+    built from the codon changes given by Oncotator for the single-nucleotide variants in the
+    Oncotator test data. Each of these codons is placed at its CDS position and at the genomic
+    position of the variant, and the remainder of the CDS is filled with CCC codons.
+    """
+    with gzip.open(get_installed_resource_filepath(
+            os.path.join('resources', 'oncotator-data-abl1.json.gz')
+            )) as oncotator_data_file:
+        oncotator_data_by_search_string = json.load(oncotator_data_file)
+    # {cds_start: (genomic_start, codon)}
+    codons = {}
+    for search_string, oncotator_data in oncotator_data_by_search_string.iteritems():
+        chromosome, startpos, endpos, reference_allele, variant_allele = search_string.split('_')
+        if startpos != endpos or oncotator_data.get('transcript_id') != 'ENST00000318560.5':
+            continue
+        # e.g. 'c.(79-81)gAa>gTa'
+        codon_change_match = re.match(
+            'c\\.\\(([0-9]+)-[0-9]+\\)([ACGTacgt]{3})>', oncotator_data['codon_change']
+        )
+        codon = codon_change_match.group(2)
+        codon_position = [base.isupper() for base in codon].index(True)
+        codons[int(codon_change_match.group(1))] = (int(startpos) - codon_position, codon.upper())
+
+    gtf_lines = []
+    cds_sequence = ''
+    genomic_end = 0
+    for cds_start, (genomic_start, codon) in sorted(codons.iteritems()):
+        nfill_bases = cds_start - 1 - len(cds_sequence)
+        assert genomic_start - nfill_bases > genomic_end
+        gtf_lines.append(
+            '9\tprotein_coding\tCDS\t{0}\t{1}\t.\t+\t0\tgene_id "ENSG00000097007"; '
+            'transcript_id "ENST00000318560";\n'.format(genomic_start - nfill_bases, genomic_start + 2)
+        )
+        cds_sequence += 'C' * nfill_bases + codon
+        genomic_end = genomic_start + 2
+
+    gtf_filepath = os.path.join(temp_dir, 'abl1.gtf')
+    cds_fasta_filepath = os.path.join(temp_dir, 'abl1.cds.fa')
+    with open(gtf_filepath, 'w') as gtf_file:
+        gtf_file.write(''.join(gtf_lines))
+    with open(cds_fasta_filepath, 'w') as cds_fasta_file:
+        cds_fasta_file.write('>ENST00000318560.5 cds\n{0}\n'.format(cds_sequence))
+    return gtf_filepath, cds_fasta_filepath
+
+
+@attr('unit')
+def test_gather_cbioportal_with_local_annotation():
+    with projecttest_context(set_up_project_stage='uniprot') as temp_dir:
+        gtf_filepath, cds_fasta_filepath = write_reference_files(temp_dir)
+        gather_cbioportal = GatherCbioportalData(
+            use_existing_cbioportal_data=True,
+            transcript_gtf_filepath=gtf_filepath,
+            cds_fasta_filepath=cds_fasta_filepath,
+        )
+        # the reference files contain no transcripts matching canonical ABL1 isoforms
+        assert len(gather_cbioportal.snv_annotator.transcript_models) == 0
+        assert models.CbioportalMutation.query.first() is not None
+        assert models.CbioportalMutation.query.filter_by(in_uniprot_domain=True).first() is None
+
+        # annotations of SNVs from the ABL1 reference files match those from Oncotator
+        annotations = []
+        for gather_kwargs in [
+                {'use_existing_oncotator_data': True},
+                dict(zip(
+                    ['transcript_gtf_filepath', 'cds_fasta_filepath'],
+                    write_abl1_reference_files(temp_dir)
+                ))]:
+            models.CbioportalMutation.query.delete()
+            models.CbioportalCase.query.delete()
+            db.session.commit()
+            GatherCbioportalData(use_existing_cbioportal_data=True, **gather_kwargs)
+            mutation_values = models.CbioportalMutation.query.filter_by(
+                type='Missense_Mutation'
+            ).values(
+                models.CbioportalMutation.chromosome_startpos,
+                models.CbioportalMutation.reference_dna_allele,
+                models.CbioportalMutation.variant_dna_allele,
+                models.CbioportalMutation.oncotator_ensembl_transcript_id,
+                models.CbioportalMutation.oncotator_reference_aa,
+                models.CbioportalMutation.oncotator_aa_pos,
+                models.CbioportalMutation.oncotator_variant_aa,
+                models.CbioportalMutation.in_uniprot_domain,
+            )
+            annotations.append(sorted([values for values in mutation_values if len(values[1]) == 1]))
+        oncotator_annotations, local_annotations = annotations
+        assert len([
+            annotation for annotation in local_annotations if annotation[3] == 'ENST00000318560'
+        ]) > 10
+        assert local_annotations == oncotator_annotations
+
+
+maf_text = '''#version 2.4
+Hugo_Symbol\tChromosome\tStart_Position\tEnd_Position\tVariant_Classification\tReference_Allele\tTumor_Seq_Allele1\tTumor_Seq_Allele2\tTumor_Sample_Barcode\tValidation_Status\tTranscript_ID\tAmino_Acid_Change\tMA:FImpact
+ABL1\t9\t133738363\t133738363\tMissense_Mutation\tC\tC\tT\tSAMPLE-1\tValid\tENST00000318560\tp.R171W\tM
+ABL1\t9\t133760430\t133760430\tMissense_Mutation\tC\tT\tT\tSAMPLE-2\tUnknown\tENST00000318560\tp.P937L\tN
+ABL1\t9\t133760431\t133760431\tSilent\tG\tA\tG\tSAMPLE-2\t\tENST00000318560\tp.P937P\t
+BRCA2\t13\t32906729\t32906729\tMissense_Mutation\tA\tC\tA\tSAMPLE-1\tValid\tENST00000380152\tp.N372H\tL
+BRCA2\t13\t32906729\t32906729\tMissense_Mutation\tA\tC\tA\tSAMPLE-3\tValid\tENST00000380152\tp.N372H\tL
+'''
+
+
+@attr('unit')
+def test_add_cbioportal_maf_data():
+    with projecttest_context(set_up_project_stage='uniprot') as temp_dir:
+        maf_filepath = os.path.join(temp_dir, 'test.maf')
+        with open(maf_filepath, 'w') as maf_file:
+            maf_file.write(maf_text)
+        AddCbioportalMAFData(maf_filepath=maf_filepath, chunksize=2)
+        assert models.CbioportalCase.query.filter_by(study='internal').count() == 2
+        mutation_rows = models.CbioportalMutation.query.all()
+        assert len(mutation_rows) == 3
+        in_domain_row = models.CbioportalMutation.query.filter_by(in_uniprot_domain=True).one()
+        assert in_domain_row.oncotator_aa_pos == 171
+        assert in_domain_row.variant_dna_allele == 'T'
+        assert in_domain_row.uniprot_domain.description == 'SH2'
+        assert in_domain_row.cbioportal_case.case_id == 'SAMPLE-1'
+        silent_row = models.CbioportalMutation.query.filter_by(type='Silent').one()
+        assert silent_row.oncotator_aa_pos is None
+        assert silent_row.variant_dna_allele == 'A'
+        assert silent_row.db_entry.uniprot.first().entry_name == 'ABL1_HUMAN'
+        # SAMPLE-3 has no mutations in the db, but is part of the cohort
+        assert set([
+            case_row.num_in_cohort for case_row in models.CbioportalCase.query.all()
+        ]) == set([3])
+        percent_by_db_entry = calculate_mutation_frequencies(by='db_entry')
+        assert abs(percent_by_db_entry[silent_row.db_entry_id] - 200./3) < 1e-6
+        percent_by_domain = calculate_mutation_frequencies(by='uniprot_domain')
+        assert abs(percent_by_domain[in_domain_row.uniprot_domain_id] - 100./3) < 1e-6
+
+        # a second import, with a cohort of one case, does not change the first import's cases
+        with open(maf_filepath, 'w') as maf_file:
+            maf_file.write(''.join(maf_text.splitlines(True)[:3]))
+        AddCbioportalMAFData(maf_filepath=maf_filepath, chunksize=2)
+        num_in_cohort_by_case_row_id = dict([
+            (case_row.id, case_row.num_in_cohort)
+            for case_row in models.CbioportalCase.query.order_by(models.CbioportalCase.id)
+        ])
+        assert sorted(num_in_cohort_by_case_row_id.values()) == [1, 3, 3]
+
+
 @attr('network')
 def test_gather_cbioportal_using_network():
     with projecttest_context(set_up_project_stage='uniprot'):
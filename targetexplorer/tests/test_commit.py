@@ -1,6 +1,17 @@
-from targetexplorer.flaskapp import models
+import os
+import sqlite3
+from sqlalchemy.exc import OperationalError
+from targetexplorer.flaskapp import app, models, db
+from targetexplorer.core import safe_crawl_snapshot_filename
 from targetexplorer.tests.utils import projecttest_context, expected_failure
 from targetexplorer.commit import Commit
+from targetexplorer import commit
+from targetexplorer.crawls import get_crawl_partition_filepath, list_crawl_partitions
+from targetexplorer.crawls import export_crawl_partition, delete_crawl_partition
+from targetexplorer.crawls import delete_old_crawl_partitions, prune_working_database
+from targetexplorer.crawls import get_published_crawl_number, serve_safe_crawl_snapshot
+from targetexplorer.crawls import publish_crawl_partition
+from targetexplorer.crawls import CrawlHistory, crawl_history_filepath
 from nose.plugins.attrib import attr
 from targetexplorer.utils import DatabaseException
 
@@ -11,6 +22,218 @@ def test_commit():
         Commit()
         crawl_data_row = models.CrawlData.query.first()
         assert crawl_data_row.safe_crawl_number == 0
+        abl1_summary = models.DBEntrySummary.query.filter_by(crawl_number=0, ac='P00519').one()
+        assert abl1_summary.entry_name == 'ABL1_HUMAN'
+        assert abl1_summary.npubs == abl1_summary.db_entry.npubs
+        assert models.DBEntrySummary.query.count() == models.DBEntry.query.filter_by(
+            crawl_number=0
+        ).count()
+
+        assert list_crawl_partitions() == [0]
+        connection = sqlite3.connect(get_crawl_partition_filepath(0))
+        assert connection.execute(
+            'SELECT safe_crawl_number, current_crawl_number FROM crawldata'
+        ).fetchall() == [(0, 1)]
+        nuniprot_entries = models.UniProtEntry.query.filter_by(crawl_number=0).count()
+        assert nuniprot_entries > 0
+        assert connection.execute(
+            'SELECT COUNT(*) FROM uniprot_entries WHERE crawl_number = 0'
+        ).fetchone()[0] == nuniprot_entries
+        assert connection.execute(
+            'SELECT COUNT(*) FROM uniprot_entries WHERE crawl_number != 0'
+        ).fetchone()[0] == 0
+        connection.close()
+
+        assert get_published_crawl_number() == 0
+        working_database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        serve_safe_crawl_snapshot()
+        try:
+            assert models.CrawlData.query.first().safe_crawl_number == 0
+            assert models.UniProtEntry.query.count() == nuniprot_entries
+            try:
+                db.session.add(models.DateStamps(crawl_number=2))
+                db.session.commit()
+                raise Exception('Write to safe crawl snapshot was not supposed to be successful!')
+            except OperationalError:
+                db.session.rollback()
+        finally:
+            app.config.update(SQLALCHEMY_DATABASE_URI=working_database_uri)
+            db.use_sqlite_profile(None)
+        os.remove(safe_crawl_snapshot_filename)
+        delete_crawl_partition(0)
+        crawl_history = CrawlHistory(crawl_history_filepath)
+        assert crawl_history.list_crawls() == [0]
+        crawl_history.close()
+        os.remove(crawl_history_filepath)
+
+
+@attr('unit')
+def test_commit_publish_failure():
+    with projecttest_context(set_up_project_stage='cbioportal'):
+        def publish_crawl_partition(crawl_number):
+            raise IOError('No space left on device')
+        publish_crawl_partition_ref = commit.publish_crawl_partition
+        commit.publish_crawl_partition = publish_crawl_partition
+        try:
+            try:
+                Commit()
+                raise Exception('Commit was not supposed to be successful!')
+            except IOError:
+                pass
+        finally:
+            commit.publish_crawl_partition = publish_crawl_partition_ref
+        assert models.CrawlData.query.first().safe_crawl_number == 0
+        assert get_published_crawl_number() is None
+
+        # the next Commit publishes crawl 0, before finding that crawl 1 has not been gathered
+        try:
+            Commit()
+            raise Exception('Premature commit was not supposed to be successful!')
+        except DatabaseException:
+            pass
+        assert get_published_crawl_number() == 0
+        assert list_crawl_partitions() == [0]
+        crawl_history = CrawlHistory(crawl_history_filepath)
+        assert crawl_history.list_crawls() == [0]
+        crawl_history.close()
+
+        os.remove(crawl_history_filepath)
+        os.remove(safe_crawl_snapshot_filename)
+        delete_crawl_partition(0)
+
+
+@attr('unit')
+def test_crawl_partitions():
+    with projecttest_context(set_up_project_stage='uniprot'):
+        for crawl_number in [3, 1, 2, 0]:
+            export_crawl_partition(crawl_number)
+        assert list_crawl_partitions() == [0, 1, 2, 3]
+        publish_crawl_partition(2)
+        assert get_published_crawl_number() == 2
+        assert delete_old_crawl_partitions(1) == [0, 1]
+        assert list_crawl_partitions() == [2, 3]
+        publish_crawl_partition(3)
+        assert get_published_crawl_number() == 3
+        os.remove(safe_crawl_snapshot_filename)
+
+        # crawl 0 is the only crawl in the db
+        prune_working_database(1)
+        assert models.UniProtEntry.query.count() == 0
+        db.session.commit()
+        for crawl_number in list_crawl_partitions():
+            delete_crawl_partition(crawl_number)
+
+
+@attr('unit')
+def test_crawl_history():
+    with projecttest_context(set_up_project_stage='uniprot') as temp_dir:
+        crawl_partition_filepath = export_crawl_partition(0)
+        crawl_history = CrawlHistory(os.path.join(temp_dir, 'test-history.db'))
+        ninserted = crawl_history.add_crawl(crawl_partition_filepath, 0)
+        nuniprot_entries = models.UniProtEntry.query.count()
+        assert ninserted['uniprot_entries'] == nuniprot_entries > 0
+
+        # unchanged crawl
+        ninserted = crawl_history.add_crawl(crawl_partition_filepath, 1)
+        assert sum(ninserted.values()) == 0
+
+        # one changed row
+        connection = sqlite3.connect(crawl_partition_filepath)
+        connection.execute(
+            "UPDATE uniprot_entries SET family = 'XX' WHERE id = (SELECT MIN(id) FROM uniprot_entries)"
+        )
+        connection.commit()
+        connection.close()
+        ninserted = crawl_history.add_crawl(crawl_partition_filepath, 2)
+        assert sum(ninserted.values()) == 1
+        assert crawl_history.list_crawls() == [0, 1, 2]
+
+        restored_filepath = os.path.join(temp_dir, 'test-restored.db')
+        for crawl_number, family in [(1, models.UniProtEntry.query.first().family), (2, 'XX')]:
+            crawl_history.restore_crawl_partition(crawl_number, restored_filepath)
+            connection = sqlite3.connect(restored_filepath)
+            assert connection.execute(
+                'SELECT family, crawl_number FROM uniprot_entries ORDER BY id LIMIT 1'
+            ).fetchone() == (family, crawl_number)
+            assert connection.execute('SELECT COUNT(*) FROM uniprot_entries').fetchone()[0] == nuniprot_entries
+            # foreign keys point to the restored rows
+            assert connection.execute(
+                'SELECT COUNT(*) FROM uniprot_domains JOIN db_entries '
+                'ON uniprot_domains.db_entry_id = db_entries.id'
+            ).fetchone()[0] == models.UniProtDomain.query.count()
+            assert connection.execute('SELECT safe_crawl_number FROM crawldata').fetchone()[0] == crawl_number
+            connection.close()
+            os.remove(restored_filepath)
+
+        crawl_history.delete_crawls_before(2)
+        assert crawl_history.list_crawls() == [2]
+        assert crawl_history.connection.execute(
+            'SELECT COUNT(*) FROM uniprot_entries'
+        ).fetchone()[0] == nuniprot_entries
+        crawl_history.close()
+        os.remove(crawl_history.filepath)
+        delete_crawl_partition(0)
+
+
+@attr('unit')
+def test_crawl_history_inserted_and_deleted_rows():
+    with projecttest_context(set_up_project_stage='uniprot') as temp_dir:
+        crawl_partition_filepath = export_crawl_partition(0)
+        crawl_history = CrawlHistory(os.path.join(temp_dir, 'test-history.db'))
+        crawl_history.add_crawl(crawl_partition_filepath, 0)
+
+        # one row inserted in the middle of a table, with the ids of the later rows shifted, and
+        # the first row deleted, together with the rows referencing it
+        connection = sqlite3.connect(crawl_partition_filepath)
+        npdb_entries, insertion_id = connection.execute(
+            'SELECT COUNT(*), MIN(id) + COUNT(*) / 2 FROM pdb_entries'
+        ).fetchone()
+        connection.execute('UPDATE pdb_entries SET id = -id - 1 WHERE id >= ?', (insertion_id,))
+        connection.execute('UPDATE pdb_entries SET id = -id WHERE id < 0')
+        for referencing_table_name in ['pdb_chains', 'pdb_expression_data']:
+            connection.execute(
+                'UPDATE {0} SET pdb_entry_id = pdb_entry_id + 1 '
+                'WHERE pdb_entry_id >= ?'.format(referencing_table_name),
+                (insertion_id,)
+            )
+        connection.execute(
+            'INSERT INTO pdb_entries (id, crawl_number, pdb_id, method, resolution, db_entry_id) '
+            "SELECT ?, crawl_number, '0XXX', method, resolution, db_entry_id "
+            'FROM pdb_entries WHERE id = ?',
+            (insertion_id, insertion_id + 1)
+        )
+        first_id = connection.execute('SELECT MIN(id) FROM pdb_entries').fetchone()[0]
+        for table_name, column_name in [
+                ('pdb_chains', 'pdb_entry_id'), ('pdb_expression_data', 'pdb_entry_id'),
+                ('pdb_entries', 'id')]:
+            connection.execute(
+                'DELETE FROM {0} WHERE {1} = ?'.format(table_name, column_name), (first_id,)
+            )
+        connection.commit()
+        connection.close()
+        assert npdb_entries > 2
+        ninserted = crawl_history.add_crawl(crawl_partition_filepath, 1)
+        assert ninserted['pdb_entries'] == 1
+        assert sum(ninserted.values()) == 1
+
+        restored_filepath = os.path.join(temp_dir, 'test-restored.db')
+        for crawl_number, inserted_pdb_ids in [(0, []), (1, ['0XXX'])]:
+            crawl_history.restore_crawl_partition(crawl_number, restored_filepath)
+            connection = sqlite3.connect(restored_filepath)
+            assert [row[0] for row in connection.execute(
+                "SELECT pdb_id FROM pdb_entries WHERE pdb_id = '0XXX'"
+            )] == inserted_pdb_ids
+            # foreign keys point to the restored rows
+            assert connection.execute(
+                'SELECT COUNT(*) FROM pdb_entries JOIN db_entries '
+                'ON pdb_entries.db_entry_id = db_entries.id'
+            ).fetchone()[0] == npdb_entries
+            connection.close()
+            os.remove(restored_filepath)
+
+        crawl_history.close()
+        os.remove(crawl_history.filepath)
+        delete_crawl_partition(0)
 
 
 @attr('unit')
@@ -0,0 +1,57 @@
+from targetexplorer.flaskapp import db
+from targetexplorer.tests.utils import projecttest_context
+from targetexplorer.migrate import create_missing_indexes, add_missing_columns
+from targetexplorer.migrate import SchemaMigrationError
+from nose.plugins.attrib import attr
+
+
+@attr('unit')
+def test_create_missing_indexes():
+    with projecttest_context(set_up_project_stage='uniprot'):
+        db.engine.execute('DROP INDEX ix_uniprot_entries_crawl_number_ac')
+        db.engine.execute('CREATE INDEX ix_uniprot_entries_crawl_number ON uniprot_entries (crawl_number)')
+        created_index_names, dropped_index_names = create_missing_indexes()
+        assert created_index_names == ['ix_uniprot_entries_crawl_number_ac']
+        assert dropped_index_names == []
+
+        created_index_names, dropped_index_names = create_missing_indexes(drop_undeclared_indexes=True)
+        assert created_index_names == []
+        assert dropped_index_names == ['ix_uniprot_entries_crawl_number']
+        index_names = [index['name'] for index in db.inspect(db.engine).get_indexes('uniprot_entries')]
+        assert 'ix_uniprot_entries_crawl_number_ac' in index_names
+        assert 'ix_uniprot_entries_crawl_number' not in index_names
+
+
+@attr('unit')
+def test_add_missing_columns():
+    with projecttest_context(set_up_project_stage='uniprot'):
+        # a cbioportal_cases table from before num_in_cohort was added
+        column_names = [
+            column['name'] for column in db.inspect(db.engine).get_columns('cbioportal_cases')
+            if column['name'] != 'num_in_cohort'
+        ]
+        db.engine.execute('ALTER TABLE cbioportal_cases RENAME TO cbioportal_cases_old')
+        db.engine.execute('CREATE TABLE cbioportal_cases AS SELECT {0} FROM cbioportal_cases_old'.format(
+            ', '.join(column_names)
+        ))
+        db.engine.execute('DROP TABLE cbioportal_cases_old')
+
+        # and a bindingdb_bioassays table which still has a legacy ligand column
+        db.engine.execute('ALTER TABLE bindingdb_bioassays ADD COLUMN ligand_smiles_string TEXT')
+        try:
+            add_missing_columns()
+            assert False
+        except SchemaMigrationError as e:
+            assert 'bindingdb_bioassays.ligand_smiles_string' in str(e)
+        # nothing is changed if any column change can not be migrated
+        assert 'num_in_cohort' not in [
+            column['name'] for column in db.inspect(db.engine).get_columns('cbioportal_cases')
+        ]
+
+        db.engine.execute('DROP TABLE bindingdb_bioassays')
+        db.metadata.tables['bindingdb_bioassays'].create(bind=db.engine)
+        assert add_missing_columns() == ['cbioportal_cases.num_in_cohort']
+        assert 'num_in_cohort' in [
+            column['name'] for column in db.inspect(db.engine).get_columns('cbioportal_cases')
+        ]
+        assert add_missing_columns() == []
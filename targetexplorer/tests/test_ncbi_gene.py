@@ -1,6 +1,8 @@
+import os
 from targetexplorer.flaskapp import models
 from targetexplorer.tests.utils import projecttest_context
-from targetexplorer.ncbi_gene import GatherNCBIGene
+from targetexplorer.ncbi_gene import GatherNCBIGene, read_gene2pubmed
+from targetexplorer.utils import get_installed_resource_filepath
 from nose.plugins.attrib import attr
 
 
@@ -14,6 +16,28 @@ def test_gather_ncbi_gene():
         first_publication_row = models.NCBIGenePublication.query.first()
         assert isinstance(first_publication_row, models.NCBIGenePublication)
         assert first_publication_row.pmid == 1281542
+        assert first_ncbi_gene_row.publications.count() == 679
+        for db_entry_row in models.DBEntry.query.all():
+            npubs = sum([
+                ncbi_gene_row.publications.count()
+                for ncbi_gene_row in db_entry_row.ncbi_gene_entries
+            ])
+            assert db_entry_row.npubs == npubs
+
+
+@attr('unit')
+def test_read_gene2pubmed():
+    gene2pubmed_filepath = get_installed_resource_filepath(
+        os.path.join('resources', 'gene2pubmed-abl1.gz')
+    )
+    gene2pubmed_df = read_gene2pubmed(gene2pubmed_filepath, [9606], [25, 105667214], chunksize=100)
+    assert list(gene2pubmed_df.columns) == ['gene_id', 'pmid']
+    assert len(gene2pubmed_df) == 679
+    assert set(gene2pubmed_df.gene_id) == set([25])
+    assert gene2pubmed_df.pmid.dtype == 'int32'
+    assert gene2pubmed_df.pmid[0] == 1281542
+    # Gene ID 105667214 is not human
+    assert len(read_gene2pubmed(gene2pubmed_filepath, [9601], [25], chunksize=100)) == 0
 
 
 @attr('network')
@@ -0,0 +1,58 @@
+import os
+from targetexplorer.flaskapp import app, db, models
+from targetexplorer.tests.utils import projecttest_context
+from targetexplorer.sqlite_profiles import get_sqlite_profiles, connect_sqlite_immutable
+from targetexplorer.ncbi_gene import GatherNCBIGene
+from nose.plugins.attrib import attr
+
+
+@attr('unit')
+def test_get_sqlite_profiles():
+    profiles = get_sqlite_profiles(project_config={
+        'sqlite_profiles': {
+            'gather': {'pragmas': {'synchronous': False, 'cache_size': -1024}},
+            'benchmark': {'pragmas': {'temp_store': 'FILE'}},
+        }
+    })
+    assert profiles['gather']['pragmas']['synchronous'] is False
+    assert profiles['gather']['pragmas']['cache_size'] == -1024
+    assert profiles['gather']['pragmas']['journal_mode'] == 'WAL'
+    assert profiles['serve']['immutable']
+    assert profiles['benchmark'] == {'immutable': False, 'pragmas': {'temp_store': 'FILE'}}
+
+
+@attr('unit')
+def test_gather_sqlite_profile():
+    with projecttest_context(set_up_project_stage='uniprot'):
+        GatherNCBIGene(use_existing_gene2pubmed=True, run_main=False)
+        assert db.sqlite_profile_name == 'gather'
+        assert db.session.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert db.session.execute('PRAGMA synchronous').scalar() == 0
+        assert db.session.execute('PRAGMA temp_store').scalar() == 2
+        db.session.commit()
+
+
+@attr('unit')
+def test_serve_sqlite_profile():
+    with projecttest_context(set_up_project_stage='uniprot') as temp_dir:
+        snapshot_filepath = os.path.join(temp_dir, 'test-serve-snapshot.db')
+        engine = db.create_engine('sqlite:///' + snapshot_filepath)
+        db.metadata.create_all(bind=engine)
+        engine.execute(models.CrawlData.__table__.insert(), [{'current_crawl_number': 4}])
+        engine.dispose()
+
+        connection = connect_sqlite_immutable(snapshot_filepath)
+        assert connection.execute('SELECT current_crawl_number FROM crawldata').fetchall() == [(4,)]
+        connection.close()
+
+        working_database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + snapshot_filepath)
+        db.use_sqlite_profile('serve')
+        try:
+            assert models.CrawlData.query.first().current_crawl_number == 4
+            assert db.session.execute('PRAGMA query_only').scalar() == 1
+            assert db.session.execute('PRAGMA mmap_size').scalar() == 268435456
+        finally:
+            app.config.update(SQLALCHEMY_DATABASE_URI=working_database_uri)
+            db.use_sqlite_profile(None)
+        os.remove(snapshot_filepath)
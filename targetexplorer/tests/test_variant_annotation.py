@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+from targetexplorer.variant_annotation import SNVAnnotator, ChromosomeIntervals
+from nose.plugins.attrib import attr
+
+
+gtf_text = '''#!genome-build GRCh37.p13
+1\tprotein_coding\texon\t90\t110\t.\t+\t.\tgene_id "ENSG00000000001"; transcript_id "ENST00000000001";
+1\tprotein_coding\tCDS\t101\t106\t.\t+\t0\tgene_id "ENSG00000000001"; transcript_id "ENST00000000001";
+1\tprotein_coding\tCDS\t201\t206\t.\t+\t0\tgene_id "ENSG00000000001"; transcript_id "ENST00000000001";
+chr2\tprotein_coding\tCDS\t300\t305\t.\t-\t0\tgene_id "ENSG00000000002"; transcript_id "ENST00000000002";
+chr2\tprotein_coding\tCDS\t400\t405\t.\t-\t0\tgene_id "ENSG00000000002"; transcript_id "ENST00000000002";
+'''
+
+cds_fasta_text = '''>ENST00000000001.1 cds chromosome:GRCh37:1:101:206:1
+ATGGCCAAATGA
+>ENST00000000002.3 cds chromosome:GRCh37:2:300:405:-1
+ATGCGTTGGTAA
+'''
+
+
+def write_reference_files(temp_dir):
+    gtf_filepath = os.path.join(temp_dir, 'test.gtf')
+    cds_fasta_filepath = os.path.join(temp_dir, 'test.cds.fa')
+    with open(gtf_filepath, 'w') as gtf_file:
+        gtf_file.write(gtf_text)
+    with open(cds_fasta_filepath, 'w') as cds_fasta_file:
+        cds_fasta_file.write(cds_fasta_text)
+    return gtf_filepath, cds_fasta_filepath
+
+
+@attr('unit')
+def test_chromosome_intervals():
+    intervals = ChromosomeIntervals([(1, 100, 'a'), (10, 20, 'b'), (50, 60, 'c')])
+    assert sorted(intervals.overlapping(15)) == ['a', 'b']
+    assert intervals.overlapping(30) == ['a']
+    assert intervals.overlapping(101) == []
+
+
+@attr('unit')
+def test_snv_annotator():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        gtf_filepath, cds_fasta_filepath = write_reference_files(temp_dir)
+        annotator = SNVAnnotator(gtf_filepath, cds_fasta_filepath)
+        # plus strand: AAA => AAC (K3N)
+        assert annotator.annotate_snv(1, 203, 203, 'A', 'C') == {
+            'ensembl_transcript_id': 'ENST00000000001',
+            'reference_aa': 'K',
+            'aa_pos': 3,
+            'variant_aa': 'N',
+        }
+        # minus strand: CGT => AGT (R2S)
+        assert annotator.annotate_snv('chr2', 402, 402, 'G', 'T') == {
+            'ensembl_transcript_id': 'ENST00000000002',
+            'reference_aa': 'R',
+            'aa_pos': 2,
+            'variant_aa': 'S',
+        }
+        # synonymous, reference mismatch, non-coding and non-SNV variants
+        assert annotator.annotate_snvs([
+            (1, 106, 106, 'C', 'T'),
+            (1, 203, 203, 'G', 'C'),
+            (1, 150, 150, 'A', 'C'),
+            (1, 203, 204, 'AA', 'CC'),
+        ]) == [None, None, None, None]
+
+        annotator = SNVAnnotator(
+            gtf_filepath, cds_fasta_filepath, transcript_ids=['ENST00000000002']
+        )
+        assert annotator.annotate_snv(1, 203, 203, 'A', 'C') is None
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,127 @@
+import json
+from targetexplorer.flaskapp import app, db, models
+from targetexplorer.crawls import serve_safe_crawl_snapshot
+from targetexplorer.tests.utils import projecttest_context
+from nose.plugins.attrib import attr
+
+
+@attr('unit')
+def test_listall_and_search():
+    with projecttest_context(set_up_project_stage='committed'):
+        # views reads dbapi_name from the project config on import
+        from targetexplorer.flaskapp.views import dbapi_name
+        client = app.test_client()
+        nentries = models.DBEntry.query.filter_by(crawl_number=0).count()
+
+        response = client.get('/{0}/listall'.format(dbapi_name))
+        listall = json.loads(response.data)['listall']
+        assert len(listall) == nentries
+        assert {'ac': 'P00519', 'entry_name': 'ABL1_HUMAN'} in listall
+
+        response = client.get(
+            '/{0}/search'.format(dbapi_name), query_string={'query': 'family="TK" AND npubs>0'}
+        )
+        assert response.status_code == 200
+        results = json.loads(response.data)['results']
+        abl1_results = [result for result in results if result['ac'] == 'P00519']
+        assert len(abl1_results) == 1
+        assert abl1_results[0]['target_domains'] == ['ABL1_HUMAN_D0']
+        assert 'Protein kinase' in abl1_results[0]['domains']
+        assert all([result['family'] == 'TK' and result['npubs'] > 0 for result in results])
+
+        # fields with several values per entry are searched by joining their tables
+        response = client.get(
+            '/{0}/search'.format(dbapi_name),
+            query_string={'query': 'name="ABL1_HUMAN" AND domain_length>100'}
+        )
+        assert [result['ac'] for result in json.loads(response.data)['results']] == ['P00519']
+
+
+@attr('unit')
+def test_search_return_fields():
+    with projecttest_context(set_up_project_stage='committed'):
+        from targetexplorer.flaskapp.views import dbapi_name
+        client = app.test_client()
+        abl1_isoform = models.UniProtIsoform.query.join(models.UniProtEntry).filter(
+            models.UniProtIsoform.crawl_number == 0,
+            models.UniProtIsoform.is_canonical == True,
+            models.UniProtEntry.ac == 'P00519',
+        ).one()
+
+        def search_abl1(return_fields):
+            response = client.get(
+                '/{0}/search'.format(dbapi_name),
+                query_string={'query': 'name="ABL1_HUMAN"', 'return': return_fields}
+            )
+            assert response.status_code == 200
+            results = json.loads(response.data)['results']
+            assert [result['ac'] for result in results] == ['P00519']
+            return results[0]
+
+        result = search_abl1('seqs')
+        assert result['sequence'] == abl1_isoform.sequence
+        assert 'pdbs' not in result
+        # not matched as a substring of domain_seqs
+        assert 'sequence' not in search_abl1('domain_seqs')
+
+        result = search_abl1('domain_seqs')
+        abl1_domains = models.UniProtDomain.query.filter_by(
+            db_entry_id=abl1_isoform.db_entry_id
+        ).all()
+        assert result['domains'] == [
+            {'targetid': domain.target_id, 'sequence': domain.sequence} for domain in abl1_domains
+        ]
+        assert len(abl1_domains) > 0
+
+        result = search_abl1('pdb_data')
+        assert len(result['pdbs']) == models.PDBEntry.query.filter_by(crawl_number=0).join(
+            models.DBEntry
+        ).join(models.UniProtEntry).filter(models.UniProtEntry.ac == 'P00519').count() > 0
+        assert all(['pdbid' in pdb and 'pdbchains' in pdb for pdb in result['pdbs']])
+
+        result = search_abl1('"seqs", pdb_data')
+        assert result['sequence'] == abl1_isoform.sequence
+        assert 'pdbs' in result
+
+
+@attr('unit')
+def test_fulltext_search():
+    with projecttest_context(set_up_project_stage='committed'):
+        from targetexplorer.flaskapp.views import dbapi_name
+        client = app.test_client()
+
+        # the full-text index is only built for crawl partitions
+        response = client.get('/{0}/fulltext'.format(dbapi_name), query_string={'query': 'leukemia'})
+        assert response.status_code == 501
+
+        working_database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        serve_safe_crawl_snapshot()
+        try:
+            response = client.get(
+                '/{0}/fulltext'.format(dbapi_name),
+                query_string={'query': 'disease_associations:leukemia'}
+            )
+            assert response.status_code == 200
+            results = json.loads(response.data)['results']
+            assert results[0]['ac'] == 'P00519'
+            assert '[' in results[0]['snippet']
+            assert results == sorted(results, key=lambda result: -result['score'])
+
+            response = client.get(
+                '/{0}/fulltext'.format(dbapi_name), query_string={'query': 'kinase AND ('}
+            )
+            assert response.status_code == 400
+
+            for limit in ['-1', '0', '1000000', 'all']:
+                response = client.get(
+                    '/{0}/fulltext'.format(dbapi_name),
+                    query_string={'query': 'kinase', 'limit': limit}
+                )
+                assert response.status_code == 400
+            response = client.get(
+                '/{0}/fulltext'.format(dbapi_name), query_string={'query': 'kinase', 'limit': '1'}
+            )
+            assert len(json.loads(response.data)['results']) == 1
+        finally:
+            app.config.update(SQLALCHEMY_DATABASE_URI=working_database_uri)
+            db.use_sqlite_profile(None)
@@ -34,17 +34,22 @@ def projecttest_context(set_up_project_stage='init'):
     with open(installation_testdir_filepath) as installation_testdir_file:
         temp_dir = installation_testdir_file.read()
     cwd = os.getcwd()
+    database_uri = app.config['SQLALCHEMY_DATABASE_URI']
     os.chdir(temp_dir)
 
-    set_up_sample_project(stage=set_up_project_stage)
+    try:
+        set_up_sample_project(stage=set_up_project_stage)
 
-    # Test is run at this point
-    yield temp_dir
+        # Test is run at this point
+        yield temp_dir
 
-    # Tear down
-    db.drop_all()
-    db.create_all()
-    os.chdir(cwd)
+    finally:
+        # Tear down, also if the test failed, so that later tests start from a clean project
+        app.config.update(SQLALCHEMY_DATABASE_URI=database_uri)
+        db.use_sqlite_profile(None)
+        db.drop_all()
+        db.create_all()
+        os.chdir(cwd)
 
 
 def set_up_sample_project(stage='init'):
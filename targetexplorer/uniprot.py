@@ -48,6 +48,7 @@ class GatherUniProt(object):
         self.uniprot_domain_regex = uniprot_domain_regex
         self.use_existing_data = use_existing_data
         self.count_nonselected_domain_names = count_nonselected_domain_names
+        db.use_sqlite_profile('gather')
         if run_main:
             self.setup()
             self.setup_manual_overrides()
@@ -0,0 +1,273 @@
+import re
+import gzip
+import bisect
+from collections import namedtuple
+import numpy as np
+import Bio.SeqIO
+from Bio.Data.CodonTable import standard_dna_table
+from targetexplorer.core import logger
+
+gtf_transcript_id_regex = re.compile('transcript_id "([^"]+)"')
+
+complementary_bases = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+
+TranscriptModel = namedtuple(
+    'TranscriptModel', ['transcript_id', 'chromosome', 'strand', 'cds_segments', 'cds_sequence']
+)
+
+
+def open_maybe_gzipped(filepath):
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath)
+    return open(filepath)
+
+
+def normalize_chromosome_name(chromosome):
+    """
+    e.g. 'chr7' => '7'; 7 => '7'
+    """
+    chromosome = str(chromosome)
+    if chromosome.startswith('chr'):
+        chromosome = chromosome[3:]
+    return chromosome
+
+
+def translate_codon(codon):
+    if codon in standard_dna_table.stop_codons:
+        return '*'
+    return standard_dna_table.forward_table.get(codon)
+
+
+class ChromosomeIntervals(object):
+    """
+    Static interval index for a single chromosome.
+    Intervals are sorted by start position, and the running maximum of the end positions is
+    stored, so that a point query only needs to scan back from the first interval starting
+    after the query position until no earlier interval can reach the query position.
+    """
+    def __init__(self, intervals):
+        """
+        Parameters
+        ----------
+        intervals: list of (start, end, value) tuples
+            1-based inclusive coordinates
+        """
+        intervals = sorted(intervals, key=lambda interval: interval[0])
+        self.starts = [interval[0] for interval in intervals]
+        self.ends = [interval[1] for interval in intervals]
+        self.values = [interval[2] for interval in intervals]
+        self.max_ends = np.maximum.accumulate(self.ends).tolist() if intervals else []
+
+    def overlapping(self, position):
+        """
+        Returns the values of all intervals containing the given position.
+        """
+        i = bisect.bisect_right(self.starts, position) - 1
+        values = []
+        while i >= 0 and self.max_ends[i] >= position:
+            if self.ends[i] >= position:
+                values.append(self.values[i])
+            i -= 1
+        return values
+
+
+class SNVAnnotator(object):
+    """
+    Maps genomic SNVs to protein changes, using local transcript models, as an offline
+    replacement for querying Oncotator for each variant.
+
+    CDS coordinates are read from a GTF file (e.g. Homo_sapiens.GRCh37.75.gtf.gz from Ensembl),
+    and CDS sequences from a FASTA file keyed by transcript ID (e.g.
+    Homo_sapiens.GRCh37.75.cds.all.fa.gz). Both files may be gzipped. The two files must be from
+    the same Ensembl release and genome build as the variant coordinates.
+
+    >>> annotator = SNVAnnotator(gtf_filepath, cds_fasta_filepath, transcript_ids=['ENST00000318560'])
+    >>> annotator.annotate_snv(9, 133760665, 133760665, 'G', 'T')
+    {'ensembl_transcript_id': 'ENST00000318560', 'reference_aa': 'Q', 'aa_pos': 996, 'variant_aa': 'H'}
+
+    Annotations are returned in the same form as GatherCbioportalData.get_oncotator_data.
+    """
+    def __init__(self, gtf_filepath, cds_fasta_filepath, transcript_ids=None):
+        """
+        Parameters
+        ----------
+        gtf_filepath: str
+        cds_fasta_filepath: str
+        transcript_ids: list of str or None
+            Only load these Ensembl transcripts (unversioned IDs, e.g. 'ENST00000318560').
+            If None, all protein-coding transcripts are loaded.
+        """
+        if transcript_ids is not None:
+            transcript_ids = set(transcript_ids)
+        self.transcript_ids = transcript_ids
+        cds_segments_by_transcript_id = self._read_gtf_cds_segments(gtf_filepath)
+        cds_sequences_by_transcript_id = self._read_cds_sequences(cds_fasta_filepath)
+        self.transcript_models = {}
+        intervals_by_chromosome = {}
+        for transcript_id, (chromosome, strand, cds_segments) in cds_segments_by_transcript_id.iteritems():
+            cds_sequence = cds_sequences_by_transcript_id.get(transcript_id)
+            if cds_sequence is None:
+                continue
+            cds_length = sum([end - start + 1 for start, end in cds_segments])
+            if cds_length > len(cds_sequence):
+                logger.debug(
+                    'CDS length in GTF file ({0}) exceeds CDS sequence length ({1}) for {2}; '
+                    'skipping'.format(cds_length, len(cds_sequence), transcript_id)
+                )
+                continue
+            # order segments 5' to 3' along the transcript
+            cds_segments = sorted(cds_segments, reverse=(strand == '-'))
+            transcript_model = TranscriptModel(
+                transcript_id, chromosome, strand, cds_segments, cds_sequence
+            )
+            self.transcript_models[transcript_id] = transcript_model
+            cds_offset = 0
+            for start, end in cds_segments:
+                intervals_by_chromosome.setdefault(chromosome, []).append(
+                    (start, end, (transcript_model, cds_offset))
+                )
+                cds_offset += end - start + 1
+
+        self.intervals_by_chromosome = {
+            chromosome: ChromosomeIntervals(intervals)
+            for chromosome, intervals in intervals_by_chromosome.iteritems()
+        }
+        logger.info('Loaded CDS models for {0} transcripts'.format(len(self.transcript_models)))
+
+    def _read_gtf_cds_segments(self, gtf_filepath):
+        """
+        Returns
+        -------
+        dict of {transcript_id: (chromosome, strand, [(start, end), ...])}
+        """
+        cds_segments_by_transcript_id = {}
+        skipped_transcript_ids = set()
+        with open_maybe_gzipped(gtf_filepath) as gtf_file:
+            for line in gtf_file:
+                if line.startswith('#'):
+                    continue
+                words = line.rstrip('\n').split('\t')
+                if len(words) < 9 or words[2] != 'CDS':
+                    continue
+                transcript_id_match = re.search(gtf_transcript_id_regex, words[8])
+                if transcript_id_match is None:
+                    continue
+                transcript_id = transcript_id_match.group(1).split('.')[0]
+                if self.transcript_ids is not None and transcript_id not in self.transcript_ids:
+                    continue
+                chromosome = normalize_chromosome_name(words[0])
+                start = int(words[3])
+                end = int(words[4])
+                strand = words[6]
+                # Transcripts with an incomplete 5' CDS do not start with a complete codon
+                if 'cds_start_NF' in words[8]:
+                    skipped_transcript_ids.add(transcript_id)
+                    continue
+                if transcript_id not in cds_segments_by_transcript_id:
+                    cds_segments_by_transcript_id[transcript_id] = (chromosome, strand, [])
+                cds_segments_by_transcript_id[transcript_id][2].append((start, end))
+
+        for transcript_id in skipped_transcript_ids:
+            cds_segments_by_transcript_id.pop(transcript_id, None)
+        return cds_segments_by_transcript_id
+
+    def _read_cds_sequences(self, cds_fasta_filepath):
+        cds_sequences_by_transcript_id = {}
+        with open_maybe_gzipped(cds_fasta_filepath) as cds_fasta_file:
+            for record in Bio.SeqIO.parse(cds_fasta_file, 'fasta'):
+                transcript_id = record.id.split('.')[0]
+                if self.transcript_ids is not None and transcript_id not in self.transcript_ids:
+                    continue
+                cds_sequences_by_transcript_id[transcript_id] = str(record.seq).upper()
+        return cds_sequences_by_transcript_id
+
+    def annotate_snv(self, chromosome, startpos, endpos, reference_allele, variant_allele):
+        """
+        Returns the first missense annotation found among the loaded transcripts, or None if
+        the variant is not a single-nucleotide missense substitution within a loaded CDS.
+
+        Returns
+        -------
+        dict with keys 'ensembl_transcript_id', 'reference_aa', 'aa_pos', 'variant_aa'; or None
+        """
+        annotations = self.annotate_snv_all_transcripts(
+            chromosome, startpos, endpos, reference_allele, variant_allele
+        )
+        if len(annotations) == 0:
+            return None
+        return annotations[0]
+
+    def annotate_snv_all_transcripts(self, chromosome, startpos, endpos, reference_allele,
+                                     variant_allele):
+        """
+        Returns a list of missense annotations, one for each loaded transcript whose CDS
+        contains the variant, sorted by transcript ID.
+        """
+        if startpos != endpos or reference_allele is None or variant_allele is None:
+            return []
+        reference_allele = reference_allele.upper()
+        variant_allele = variant_allele.upper()
+        if reference_allele not in complementary_bases or variant_allele not in complementary_bases:
+            return []
+        intervals = self.intervals_by_chromosome.get(normalize_chromosome_name(chromosome))
+        if intervals is None:
+            return []
+
+        annotations = []
+        for transcript_model, segment_cds_offset in intervals.overlapping(startpos):
+            annotation = self._annotate_snv_in_transcript(
+                transcript_model, segment_cds_offset, startpos, reference_allele, variant_allele
+            )
+            if annotation is not None:
+                annotations.append(annotation)
+        return sorted(annotations, key=lambda annotation: annotation['ensembl_transcript_id'])
+
+    def _annotate_snv_in_transcript(self, transcript_model, segment_cds_offset, position,
+                                    reference_allele, variant_allele):
+        for start, end in transcript_model.cds_segments:
+            if start <= position <= end:
+                break
+        if transcript_model.strand == '-':
+            cds_offset = segment_cds_offset + (end - position)
+            reference_base = complementary_bases[reference_allele]
+            variant_base = complementary_bases[variant_allele]
+        else:
+            cds_offset = segment_cds_offset + (position - start)
+            reference_base = reference_allele
+            variant_base = variant_allele
+
+        codon_index = cds_offset // 3
+        codon_position = cds_offset % 3
+        reference_codon = transcript_model.cds_sequence[codon_index*3: codon_index*3 + 3]
+        if len(reference_codon) != 3 or reference_codon[codon_position] != reference_base:
+            # reference allele does not match the transcript sequence
+            return None
+        variant_codon = (
+            reference_codon[:codon_position] + variant_base + reference_codon[codon_position+1:]
+        )
+        reference_aa = translate_codon(reference_codon)
+        variant_aa = translate_codon(variant_codon)
+        if reference_aa is None or variant_aa is None:
+            return None
+        if reference_aa == variant_aa or '*' in [reference_aa, variant_aa]:
+            return None
+        return {
+            'ensembl_transcript_id': transcript_model.transcript_id,
+            'reference_aa': reference_aa,
+            'aa_pos': codon_index + 1,
+            'variant_aa': variant_aa,
+        }
+
+    def annotate_snvs(self, variants):
+        """
+        Annotate a batch of variants.
+
+        Parameters
+        ----------
+        variants: iterable of (chromosome, startpos, endpos, reference_allele, variant_allele)
+
+        Returns
+        -------
+        list of annotations (dicts or None), in the same order as the input variants
+        """
+        return [self.annotate_snv(*variant) for variant in variants]